@@ -1,3 +1,7 @@
+\ save-everything-high and save-everything-low save a fixed set of
+\ registers. save-context and restore-context, used in a handler, save
+\ only what the handler and the words it calls may change.
+
 cvariable high-wtemp
 cvariable high-fsr0ltemp
 cvariable high-fsr0htemp
@@ -0,0 +1,948 @@
+#! /usr/bin/env python
+#
+# rforth1 is released under the GNU General Public License (see the
+# file COPYING in this directory)
+
+"""PIC18 instruction set: encoding, decoding, a minimal assembler for the
+code produced by rforth1 and a cycle-accurate simulator.
+
+The simulator models the W register, STATUS, BSR, the three FSR with their
+indirect access registers (INDF, POSTINC, POSTDEC, PREINC and PLUSW), the
+31 levels hardware return stack with its fast register stack, PCL writes,
+TBLPTR/TABLAT table reads and writes, the hardware multiplier and the data
+EEPROM. Peripherals and interrupts are not simulated: other special
+function registers behave as plain memory, except for the serial port:
+TXIF is always set and the bytes written to TXREG are collected in the
+serial attribute. EEPROM and flash writes complete immediately."""
+
+import optparse, sys
+
+# Instruction kinds and their operands:
+#   fda:   f, d, a          fa:   f, a          fba:  f, b, a
+#   k8:    k                n8:   n (8 bits)    n11:  n (11 bits)
+#   none:  -                s:    s             k4:   k
+#   call:  k, s             goto: k             lfsr: f, k
+#   movff: fs, fd
+instructions = {
+  'addwf': ('fda', 0x2400), 'addwfc': ('fda', 0x2000),
+  'andwf': ('fda', 0x1400), 'comf': ('fda', 0x1c00),
+  'decf': ('fda', 0x0400), 'decfsz': ('fda', 0x2c00),
+  'dcfsnz': ('fda', 0x4c00), 'incf': ('fda', 0x2800),
+  'incfsz': ('fda', 0x3c00), 'infsnz': ('fda', 0x4800),
+  'iorwf': ('fda', 0x1000), 'movf': ('fda', 0x5000),
+  'rlcf': ('fda', 0x3400), 'rlncf': ('fda', 0x4400),
+  'rrcf': ('fda', 0x3000), 'rrncf': ('fda', 0x4000),
+  'subfwb': ('fda', 0x5400), 'subwf': ('fda', 0x5c00),
+  'subwfb': ('fda', 0x5800), 'swapf': ('fda', 0x3800),
+  'xorwf': ('fda', 0x1800),
+  'clrf': ('fa', 0x6a00), 'cpfseq': ('fa', 0x6200),
+  'cpfsgt': ('fa', 0x6400), 'cpfslt': ('fa', 0x6000),
+  'movwf': ('fa', 0x6e00), 'mulwf': ('fa', 0x0200),
+  'negf': ('fa', 0x6c00), 'setf': ('fa', 0x6800),
+  'tstfsz': ('fa', 0x6600),
+  'bcf': ('fba', 0x9000), 'bsf': ('fba', 0x8000),
+  'btfsc': ('fba', 0xb000), 'btfss': ('fba', 0xa000),
+  'btg': ('fba', 0x7000),
+  'addlw': ('k8', 0x0f00), 'andlw': ('k8', 0x0b00),
+  'iorlw': ('k8', 0x0900), 'movlw': ('k8', 0x0e00),
+  'mullw': ('k8', 0x0d00), 'retlw': ('k8', 0x0c00),
+  'sublw': ('k8', 0x0800), 'xorlw': ('k8', 0x0a00),
+  'bz': ('n8', 0xe000), 'bnz': ('n8', 0xe100),
+  'bc': ('n8', 0xe200), 'bnc': ('n8', 0xe300),
+  'bov': ('n8', 0xe400), 'bnov': ('n8', 0xe500),
+  'bn': ('n8', 0xe600), 'bnn': ('n8', 0xe700),
+  'bra': ('n11', 0xd000), 'rcall': ('n11', 0xd800),
+  'nop': ('none', 0x0000), 'sleep': ('none', 0x0003),
+  'clrwdt': ('none', 0x0004), 'push': ('none', 0x0005),
+  'pop': ('none', 0x0006), 'daw': ('none', 0x0007),
+  'reset': ('none', 0x00ff),
+  'tblrd*': ('none', 0x0008), 'tblrd*+': ('none', 0x0009),
+  'tblrd*-': ('none', 0x000a), 'tblrd+*': ('none', 0x000b),
+  'tblwt*': ('none', 0x000c), 'tblwt*+': ('none', 0x000d),
+  'tblwt*-': ('none', 0x000e), 'tblwt+*': ('none', 0x000f),
+  'retfie': ('s', 0x0010), 'return': ('s', 0x0012),
+  'movlb': ('k4', 0x0100),
+  'call': ('call', 0xec00), 'goto': ('goto', 0xef00),
+  'lfsr': ('lfsr', 0xee00), 'movff': ('movff', 0xc000),
+}
+
+masks = {'fda': 0xfc00, 'fa': 0xfe00, 'fba': 0xf000, 'k8': 0xff00,
+         'n8': 0xff00, 'n11': 0xf800, 'none': 0xffff, 's': 0xfffe,
+         'k4': 0xfff0, 'call': 0xfe00, 'goto': 0xff00, 'lfsr': 0xffc0,
+         'movff': 0xf000}
+
+# Most specific encodings are tried first when decoding
+decoding = sorted([(masks[kind], base, name)
+                   for name, (kind, base) in instructions.items()],
+                  reverse = True)
+
+def size(name):
+  """Return the size in words of an instruction."""
+  if instructions[name][0] in ['call', 'goto', 'lfsr', 'movff']:
+    return 2
+  return 1
+
+class Error(Exception):
+
+  def __init__(self, msg):
+    Exception.__init__(self, msg)
+    self.msg = msg
+
+def encode(name, operands, addr = 0):
+  """Return the list of words for an instruction located at addr. Branch
+  operands are absolute target addresses."""
+  kind, base = instructions[name]
+  o = list(operands)
+  if kind == 'fda':
+    return [base | (o[1] & 1) << 9 | (o[2] & 1) << 8 | o[0] & 0xff]
+  elif kind == 'fa':
+    return [base | (o[1] & 1) << 8 | o[0] & 0xff]
+  elif kind == 'fba':
+    return [base | (o[1] & 7) << 9 | (o[2] & 1) << 8 | o[0] & 0xff]
+  elif kind == 'k8':
+    return [base | o[0] & 0xff]
+  elif kind in ['n8', 'n11']:
+    n = (o[0] - addr - 2) >> 1
+    bits = kind == 'n8' and 8 or 11
+    if n < -(1 << (bits-1)) or n >= 1 << (bits-1):
+      raise Error('%s target 0x%x out of range' % (name, o[0]))
+    return [base | n & ((1 << bits) - 1)]
+  elif kind == 'none':
+    return [base]
+  elif kind == 's':
+    return [base | (o and o[0] & 1 or 0)]
+  elif kind == 'k4':
+    return [base | o[0] & 0xf]
+  elif kind == 'call':
+    k = o[0] >> 1
+    s = len(o) > 1 and o[1] & 1 or 0
+    return [base | s << 8 | k & 0xff, 0xf000 | (k >> 8) & 0xfff]
+  elif kind == 'goto':
+    k = o[0] >> 1
+    return [base | k & 0xff, 0xf000 | (k >> 8) & 0xfff]
+  elif kind == 'lfsr':
+    return [base | (o[0] & 3) << 4 | (o[1] >> 8) & 0xf, 0xf000 | o[1] & 0xff]
+  elif kind == 'movff':
+    return [base | o[0] & 0xfff, 0xf000 | o[1] & 0xfff]
+
+def signed(value, bits):
+  if value & (1 << (bits-1)):
+    return value - (1 << bits)
+  return value
+
+def decode(word, next_word, addr = 0):
+  """Decode the instruction at addr made of word (and next_word for two
+  words instructions). Return the name, the operands and the size in words.
+  Branch operands are decoded as absolute target addresses."""
+  for mask, base, name in decoding:
+    if word & mask == base:
+      break
+  else:
+    if word & 0xf000 == 0xf000:
+      # Second word of a two words instruction, executed as a nop
+      return 'nop', (), 1
+    raise Error('unknown opcode 0x%04x at 0x%x' % (word, addr))
+  kind = instructions[name][0]
+  if kind == 'fda':
+    return name, (word & 0xff, (word >> 9) & 1, (word >> 8) & 1), 1
+  elif kind == 'fa':
+    return name, (word & 0xff, (word >> 8) & 1), 1
+  elif kind == 'fba':
+    return name, (word & 0xff, (word >> 9) & 7, (word >> 8) & 1), 1
+  elif kind == 'k8':
+    return name, (word & 0xff,), 1
+  elif kind == 'n8':
+    return name, (addr + 2 + 2 * signed(word & 0xff, 8),), 1
+  elif kind == 'n11':
+    return name, (addr + 2 + 2 * signed(word & 0x7ff, 11),), 1
+  elif kind == 'none':
+    return name, (), 1
+  elif kind == 's':
+    return name, (word & 1,), 1
+  elif kind == 'k4':
+    return name, (word & 0xf,), 1
+  elif kind == 'call':
+    return name, ((((next_word & 0xfff) << 8) | word & 0xff) << 1,
+                  (word >> 8) & 1), 2
+  elif kind == 'goto':
+    return name, ((((next_word & 0xfff) << 8) | word & 0xff) << 1,), 2
+  elif kind == 'lfsr':
+    return name, ((word >> 4) & 3, (word & 0xf) << 8 | next_word & 0xff), 2
+  elif kind == 'movff':
+    return name, (word & 0xfff, next_word & 0xfff), 2
+
+class Expression:
+  """Evaluate gpasm expressions as emitted by rforth1: numbers, symbols,
+  parentheses, unary minus, +, -, *, << and the LOW, HIGH and UPPER
+  operators."""
+
+  def __init__(self, text, symbols):
+    self.tokens = []
+    self.symbols = symbols
+    i = 0
+    while i < len(text):
+      c = text[i]
+      if c.isspace():
+        i += 1
+      elif text[i:i+2] in ['<<', '>>']:
+        self.tokens.append(text[i:i+2])
+        i += 2
+      elif c in '()+-*':
+        self.tokens.append(c)
+        i += 1
+      else:
+        j = i
+        while j < len(text) and (text[j].isalnum() or text[j] in '_.?'):
+          j += 1
+        if j == i:
+          raise Error('unexpected character in %s' % text)
+        self.tokens.append(text[i:j])
+        i = j
+    self.text = text
+
+  def value(self):
+    v = self.shift()
+    if self.tokens:
+      raise Error('trailing garbage in %s' % self.text)
+    return v
+
+  def next(self):
+    if not self.tokens:
+      raise Error('unexpected end of %s' % self.text)
+    return self.tokens.pop(0)
+
+  def shift(self):
+    v = self.sum()
+    while self.tokens and self.tokens[0] in ['<<', '>>']:
+      if self.next() == '<<':
+        v <<= self.sum()
+      else:
+        v >>= self.sum()
+    return v
+
+  def sum(self):
+    v = self.product()
+    while self.tokens and self.tokens[0] in '+-':
+      if self.next() == '+':
+        v += self.product()
+      else:
+        v -= self.product()
+    return v
+
+  def product(self):
+    v = self.unary()
+    while self.tokens and self.tokens[0] == '*':
+      self.next()
+      v *= self.unary()
+    return v
+
+  def unary(self):
+    t = self.next()
+    if t == '-':
+      return -self.unary()
+    if t == '(':
+      v = self.shift()
+      if self.next() != ')':
+        raise Error('missing parenthesis in %s' % self.text)
+      return v
+    if t.upper() in ['LOW', 'HIGH', 'UPPER'] and self.tokens[:1] == ['(']:
+      v = self.unary()
+      return {'LOW': v & 0xff, 'HIGH': (v >> 8) & 0xff,
+              'UPPER': (v >> 16) & 0xff}[t.upper()]
+    for prefix, base in [('0x', 16), ('0X', 16), ('0b', 2), ('', 10)]:
+      if t.startswith(prefix):
+        try:
+          return int(t[len(prefix):], base)
+        except ValueError:
+          pass
+    try:
+      v = self.symbols[t]
+    except KeyError:
+      raise Error('undefined symbol %s' % t)
+    if isinstance(v, str):
+      # Symbols defined by equ are evaluated when first used
+      v = self.symbols[t] = Expression(v, self.symbols).value()
+    return v
+
+class Assembler:
+  """Two passes assembler for the subset of gpasm used by rforth1. Code is
+  added with org(), label(), instruction() and db(), constants with equ();
+  operands are integers or expression strings. The assembled program memory
+  is returned by program() as a dictionary from addresses to bytes."""
+
+  def __init__(self):
+    self.symbols = {}
+    self.items = []
+    self.here = 0
+
+  def org(self, addr):
+    self.here = addr
+
+  def equ(self, name, value):
+    self.symbols[name] = value
+
+  def label(self, name):
+    self.symbols[name] = self.here
+
+  def instruction(self, name, operands = []):
+    if name not in instructions:
+      raise Error('unknown instruction %s' % name)
+    self.items.append((self.here, name, list(operands)))
+    self.here += 2 * size(name)
+
+  def db(self, data):
+    data = list(data)
+    if len(data) % 2:
+      data.append(0)
+    self.items.append((self.here, None, data))
+    self.here += len(data)
+
+  def evaluate(self, value):
+    if not isinstance(value, str):
+      return value
+    return Expression(value, self.symbols).value()
+
+  def program(self):
+    memory = {}
+    for addr, name, operands in self.items:
+      if name is None:
+        bytes = [self.evaluate(v) & 0xff for v in operands]
+      else:
+        operands = [self.evaluate(v) for v in operands]
+        kind = instructions[name][0]
+        if kind in ['fda', 'fa'] and len(operands) < 3:
+          # Default destination is F and access bank is deduced from the
+          # address
+          if kind == 'fda' and len(operands) == 1:
+            operands.append(1)
+          f = operands[0]
+          operands.append(int(not (f < 0x60 or f >= 0xf60)))
+        bytes = []
+        for w in encode(name, operands, addr):
+          bytes += [w & 0xff, w >> 8]
+      for b in bytes:
+        memory[addr] = b
+        addr += 1
+    return memory
+
+def assemble(text, asm = None):
+  """Assemble the text of an assembly file produced by rforth1 and return
+  the program memory. The symbols are left in asm if one is given."""
+  if asm is None:
+    asm = Assembler()
+  for line in text.splitlines():
+    line = line.split(';', 1)[0].rstrip()
+    if not line or line == 'END':
+      continue
+    if not line[0].isspace():
+      words = line.split(None, 2)
+      if len(words) == 3 and words[1].lower() in ['equ', 'set']:
+        asm.equ(words[0], words[2])
+        continue
+      asm.label(words[0])
+      line = ' '.join(words[1:])
+      if not line:
+        continue
+    words = line.split(None, 1)
+    name = words[0].lower()
+    operands = len(words) > 1 and [o.strip() for o in words[1].split(',')] \
+               or []
+    if name == 'org':
+      asm.org(asm.evaluate(operands[0]))
+    elif name == 'db':
+      asm.db(operands)
+    elif name in ['processor', 'radix', 'config', 'list']:
+      pass
+    else:
+      asm.instruction(name, operands)
+  return asm.program()
+
+def read_hex(lines):
+  """Read the lines of an Intel hex file. Return the program memory and the
+  EEPROM content as dictionaries. Configuration bits are ignored."""
+  program = {}
+  eeprom = {}
+  base = 0
+  for l in lines:
+    l = l.strip()
+    if l[:1] != ':':
+      continue
+    data = [int(l[i:i+2], 16) for i in range(1, len(l), 2)]
+    if sum(data) & 0xff:
+      raise Error('bad checksum in %s' % l)
+    count, addr, kind = data[0], data[1] << 8 | data[2], data[3]
+    payload = data[4:4+count]
+    if kind == 0:
+      for i in range(count):
+        a = base + addr + i
+        if a >= 0xf00000:
+          eeprom[a - 0xf00000] = payload[i]
+        elif a < 0x200000:
+          program[a] = payload[i]
+    elif kind == 4:
+      base = (payload[0] << 8 | payload[1]) << 16
+    elif kind == 1:
+      break
+  return program, eeprom
+
+# Special function registers
+TOSU, TOSH, TOSL, STKPTR = 0xfff, 0xffe, 0xffd, 0xffc
+PCLATU, PCLATH, PCL = 0xffb, 0xffa, 0xff9
+TBLPTRU, TBLPTRH, TBLPTRL, TABLAT = 0xff8, 0xff7, 0xff6, 0xff5
+PRODH, PRODL = 0xff4, 0xff3
+WREG, BSR, STATUS = 0xfe8, 0xfe0, 0xfd8
+FSRL = [0xfe9, 0xfe1, 0xfd9]
+INDF = [0xfef, 0xfe7, 0xfdf]
+POSTINC = [0xfee, 0xfe6, 0xfde]
+POSTDEC = [0xfed, 0xfe5, 0xfdd]
+PREINC = [0xfec, 0xfe4, 0xfdc]
+PLUSW = [0xfeb, 0xfe3, 0xfdb]
+EEADR, EEDATA, EECON2, EECON1 = 0xfa9, 0xfa8, 0xfa7, 0xfa6
+PIR1, PIR2, TXREG = 0xf9e, 0xfa1, 0xfad
+
+C, DC, Z, OV, N = 1, 2, 4, 8, 16
+
+indirect = {}
+for n in range(3):
+  for reg, kind in [(INDF, 'indf'), (POSTINC, 'postinc'),
+                    (POSTDEC, 'postdec'), (PREINC, 'preinc'),
+                    (PLUSW, 'plusw')]:
+    indirect[reg[n]] = (n, kind)
+
+# Instructions taking two cycles, not counting skips and taken branches
+two_cycles = ['bra', 'rcall', 'call', 'goto', 'return', 'retfie', 'retlw',
+              'lfsr', 'movff', 'tblrd*', 'tblrd*+', 'tblrd*-', 'tblrd+*',
+              'tblwt*', 'tblwt*+', 'tblwt*-', 'tblwt+*']
+
+class Simulator(object):
+  """Cycle-accurate PIC18 core simulator."""
+
+  # Return address used by call() to detect the end of the called code
+  SENTINEL = 0x1ffffe
+
+  def __init__(self, program = {}, eeprom = {}, flash_size = 0x8000):
+    self.flash = bytearray(b'\xff' * flash_size)
+    for a, b in program.items():
+      if a < flash_size:
+        self.flash[a] = b
+    self.eeprom = bytearray(b'\xff' * 256)
+    for a, b in eeprom.items():
+      self.eeprom[a & 0xff] = b
+    self.reset()
+
+  def reset(self):
+    self.ram = [0] * 0x1000
+    self.ram[PIR1] = 0x10
+    self.stack = []
+    self.shadow = (0, 0, 0)
+    self.holding = [0xff] * 8
+    self.eecon2 = []
+    self.serial = bytearray()
+    self.pc = 0
+    self.cycles = 0
+    self.halted = False
+    self.decoded = {}
+    # Number of transfers of control, indexed by (address following the
+    # instruction, target address)
+    self.jumps = {}
+
+  # Registers
+
+  def get_w(self):
+    return self.ram[WREG]
+
+  def set_w(self, value):
+    self.ram[WREG] = value & 0xff
+
+  w = property(get_w, set_w)
+
+  def fsr(self, n):
+    return (self.ram[FSRL[n]+1] & 0xf) << 8 | self.ram[FSRL[n]]
+
+  def set_fsr(self, n, value):
+    self.ram[FSRL[n]] = value & 0xff
+    self.ram[FSRL[n]+1] = (value >> 8) & 0xf
+
+  def flag(self, bit):
+    return int(self.ram[STATUS] & bit != 0)
+
+  def set_flags(self, mask, flags):
+    self.ram[STATUS] = self.ram[STATUS] & ~mask & 0x1f | flags & mask
+
+  def tblptr(self):
+    return (self.ram[TBLPTRU] & 0x3f) << 16 | self.ram[TBLPTRH] << 8 | \
+           self.ram[TBLPTRL]
+
+  def set_tblptr(self, value):
+    self.ram[TBLPTRU] = (value >> 16) & 0x3f
+    self.ram[TBLPTRH] = (value >> 8) & 0xff
+    self.ram[TBLPTRL] = value & 0xff
+
+  # Data memory
+
+  def address(self, f, a):
+    """Return the data memory address designated by f and the access bit."""
+    if a:
+      return (self.ram[BSR] & 0xf) << 8 | f
+    if f < 0x60:
+      return f
+    return 0xf00 | f
+
+  def effective(self, addr):
+    """Resolve indirect accesses, updating the FSR if needed, and return
+    the address which will really be accessed."""
+    if addr not in indirect:
+      return addr
+    n, kind = indirect[addr]
+    fsr = self.fsr(n)
+    if kind == 'postinc':
+      self.set_fsr(n, fsr + 1)
+    elif kind == 'postdec':
+      self.set_fsr(n, fsr - 1)
+    elif kind == 'preinc':
+      fsr = (fsr + 1) & 0xfff
+      self.set_fsr(n, fsr)
+    elif kind == 'plusw':
+      fsr = (fsr + signed(self.w, 8)) & 0xfff
+    if fsr in indirect:
+      # Indirect access to an indirect register reads as 0
+      return None
+    return fsr
+
+  def load(self, addr):
+    if addr is None:
+      return 0
+    if addr == PCL:
+      pc = self.pc
+      self.ram[PCLATH] = (pc >> 8) & 0xff
+      self.ram[PCLATU] = (pc >> 16) & 0x1f
+      return pc & 0xff
+    if addr in [TOSL, TOSH, TOSU]:
+      tos = self.stack and self.stack[-1] or 0
+      return (tos >> {TOSL: 0, TOSH: 8, TOSU: 16}[addr]) & 0xff
+    if addr == STKPTR:
+      return len(self.stack) | self.ram[STKPTR] & 0xc0
+    return self.ram[addr]
+
+  def store(self, addr, value):
+    if addr is None:
+      return
+    value &= 0xff
+    if addr == PCL:
+      self.pc = (self.ram[PCLATU] & 0x1f) << 16 | self.ram[PCLATH] << 8 | \
+                value & 0xfe
+      self.cycles += 1
+      return
+    if addr in [TOSL, TOSH, TOSU] and self.stack:
+      shift = {TOSL: 0, TOSH: 8, TOSU: 16}[addr]
+      self.stack[-1] = self.stack[-1] & ~(0xff << shift) | value << shift
+      return
+    if addr == STATUS:
+      value &= 0x1f
+    self.ram[addr] = value
+    if addr == EECON2:
+      self.eecon2 = (self.eecon2 + [value])[-2:]
+    elif addr == EECON1:
+      self.eeprom_control(value)
+    elif addr == TXREG:
+      self.serial.append(value)
+
+  def eeprom_control(self, value):
+    eepgd, cfgs, free = value & 0x80, value & 0x40, value & 0x10
+    if value & 1 and not cfgs:
+      if not eepgd:
+        self.ram[EEDATA] = self.eeprom[self.ram[EEADR]]
+      self.ram[EECON1] &= ~1
+    if value & 2:
+      if value & 4 and self.eecon2 == [0x55, 0xaa] and not cfgs:
+        if not eepgd:
+          self.eeprom[self.ram[EEADR]] = self.ram[EEDATA]
+        elif free:
+          block = self.tblptr() & ~63
+          for a in range(block, block + 64):
+            self.write_flash(a, 0xff)
+        else:
+          block = self.tblptr() & ~7
+          for i in range(8):
+            self.write_flash(block + i, self.holding[i])
+          self.holding = [0xff] * 8
+        self.ram[PIR2] |= 0x10
+      self.ram[EECON1] &= ~2
+      self.eecon2 = []
+
+  def write_flash(self, addr, value):
+    if addr < len(self.flash):
+      self.flash[addr] = value
+      self.decoded.pop(addr & ~1, None)
+      self.decoded.pop((addr & ~1) - 2, None)
+
+  def read_flash(self, addr):
+    if addr < len(self.flash):
+      return self.flash[addr]
+    return 0
+
+  # Execution
+
+  def fetch(self, addr):
+    if addr not in self.decoded:
+      word = self.read_flash(addr) | self.read_flash(addr+1) << 8
+      next_word = self.read_flash(addr+2) | self.read_flash(addr+3) << 8
+      self.decoded[addr] = decode(word, next_word, addr)
+    return self.decoded[addr]
+
+  def push(self, addr):
+    if len(self.stack) >= 31:
+      raise Error('hardware stack overflow at 0x%x' % self.pc)
+    self.stack.append(addr)
+
+  def pop(self):
+    if not self.stack:
+      raise Error('hardware stack underflow at 0x%x' % self.pc)
+    return self.stack.pop()
+
+  def skip(self):
+    """Skip the next instruction, which costs one or two more cycles."""
+    self.cycles += size(self.fetch(self.pc)[0])
+    self.pc += 2 * size(self.fetch(self.pc)[0])
+
+  def add(self, a, b, carry = 0, mask = C|DC|Z|OV|N):
+    r = a + b + carry
+    flags = 0
+    if r > 0xff:
+      flags |= C
+    if (a & 0xf) + (b & 0xf) + carry > 0xf:
+      flags |= DC
+    if (a ^ r) & (b ^ r) & 0x80:
+      flags |= OV
+    r &= 0xff
+    self.set_flags(mask, flags | self.zn(r))
+    return r
+
+  def zn(self, r):
+    return (r == 0 and Z or 0) | (r & 0x80 and N or 0)
+
+  def step(self):
+    """Execute one instruction."""
+    pc = self.pc
+    name, o, words = self.fetch(pc)
+    self.pc = pc + 2 * words
+    self.cycles += name in two_cycles and 2 or 1
+    kind = instructions[name][0]
+    if kind in ['fda', 'fa', 'fba']:
+      getattr(self, 'op_' + kind)(name, self.effective(self.address(o[0],
+                                                                    o[-1])),
+                                  o)
+    else:
+      getattr(self, 'op_' + name.replace('*', '_').replace('+', 'p')
+                                .replace('-', 'm'))(*o)
+
+  def op_fda(self, name, addr, o):
+    f = self.load(addr)
+    w = self.w
+    c = self.flag(C)
+    logic = Z|N
+    if name == 'addwf':
+      r = self.add(f, w)
+    elif name == 'addwfc':
+      r = self.add(f, w, c)
+    elif name == 'andwf':
+      r = f & w
+    elif name == 'comf':
+      r = ~f & 0xff
+    elif name == 'decf':
+      r = self.add(f, 0xff)
+    elif name == 'incf':
+      r = self.add(f, 1)
+    elif name == 'iorwf':
+      r = f | w
+    elif name == 'movf':
+      r = f
+    elif name == 'xorwf':
+      r = f ^ w
+    elif name == 'subwf':
+      r = self.add(f, ~w & 0xff, 1)
+    elif name == 'subwfb':
+      r = self.add(f, ~w & 0xff, c)
+    elif name == 'subfwb':
+      r = self.add(w, ~f & 0xff, c)
+    elif name == 'swapf':
+      r = (f << 4 | f >> 4) & 0xff
+    elif name == 'rlcf':
+      r = (f << 1 | c) & 0xff
+      self.set_flags(C, f >> 7 and C)
+    elif name == 'rrcf':
+      r = f >> 1 | c << 7
+      self.set_flags(C, f & 1 and C)
+    elif name == 'rlncf':
+      r = (f << 1 | f >> 7) & 0xff
+    elif name == 'rrncf':
+      r = (f >> 1 | f << 7) & 0xff
+    else:
+      r = (f + (name[0] == 'i' and 1 or -1)) & 0xff
+      if (r == 0) == name.endswith('fsz'):
+        self.skip()
+    if name in ['andwf', 'comf', 'iorwf', 'movf', 'xorwf', 'rlcf', 'rrcf',
+                'rlncf', 'rrncf']:
+      self.set_flags(Z|N, self.zn(r))
+    if o[1]:
+      self.store(addr, r)
+    else:
+      self.w = r
+
+  def op_fa(self, name, addr, o):
+    if name == 'clrf':
+      self.store(addr, 0)
+      self.set_flags(Z, Z)
+    elif name == 'setf':
+      self.store(addr, 0xff)
+    elif name == 'movwf':
+      self.store(addr, self.w)
+    elif name == 'negf':
+      self.store(addr, self.add(0, ~self.load(addr) & 0xff, 1))
+    elif name == 'mulwf':
+      p = self.load(addr) * self.w
+      self.ram[PRODL], self.ram[PRODH] = p & 0xff, p >> 8
+    else:
+      f = self.load(addr)
+      w = self.w
+      if name == 'cpfseq':
+        taken = f == w
+      elif name == 'cpfsgt':
+        taken = f > w
+      elif name == 'cpfslt':
+        taken = f < w
+      else:
+        taken = f == 0
+      if taken:
+        self.skip()
+
+  def op_fba(self, name, addr, o):
+    bit = 1 << o[1]
+    if name in ['btfsc', 'btfss']:
+      if bool(self.load(addr) & bit) == (name == 'btfss'):
+        self.skip()
+      return
+    f = self.load(addr)
+    if name == 'bsf':
+      f |= bit
+    elif name == 'bcf':
+      f &= ~bit
+    else:
+      f ^= bit
+    self.store(addr, f)
+
+  def op_addlw(self, k):
+    self.w = self.add(self.w, k)
+
+  def op_sublw(self, k):
+    self.w = self.add(k, ~self.w & 0xff, 1)
+
+  def op_andlw(self, k):
+    self.w &= k
+    self.set_flags(Z|N, self.zn(self.w))
+
+  def op_iorlw(self, k):
+    self.w |= k
+    self.set_flags(Z|N, self.zn(self.w))
+
+  def op_xorlw(self, k):
+    self.w ^= k
+    self.set_flags(Z|N, self.zn(self.w))
+
+  def op_movlw(self, k):
+    self.w = k
+
+  def op_mullw(self, k):
+    p = self.w * k
+    self.ram[PRODL], self.ram[PRODH] = p & 0xff, p >> 8
+
+  def op_retlw(self, k):
+    self.w = k
+    self.pc = self.pop()
+
+  def op_movlb(self, k):
+    self.ram[BSR] = k
+
+  def branch(self, condition, target):
+    if condition:
+      self.pc = target
+      self.cycles += 1
+
+  def op_bz(self, n):
+    self.branch(self.flag(Z), n)
+
+  def op_bnz(self, n):
+    self.branch(not self.flag(Z), n)
+
+  def op_bc(self, n):
+    self.branch(self.flag(C), n)
+
+  def op_bnc(self, n):
+    self.branch(not self.flag(C), n)
+
+  def op_bov(self, n):
+    self.branch(self.flag(OV), n)
+
+  def op_bnov(self, n):
+    self.branch(not self.flag(OV), n)
+
+  def op_bn(self, n):
+    self.branch(self.flag(N), n)
+
+  def op_bnn(self, n):
+    self.branch(not self.flag(N), n)
+
+  def count_jump(self, target):
+    key = (self.pc, target)
+    self.jumps[key] = self.jumps.get(key, 0) + 1
+
+  def op_bra(self, n):
+    self.count_jump(n)
+    self.pc = n
+
+  def op_rcall(self, n):
+    self.count_jump(n)
+    self.push(self.pc)
+    self.pc = n
+
+  def op_call(self, k, s):
+    self.count_jump(k)
+    self.push(self.pc)
+    if s:
+      self.shadow = (self.w, self.ram[STATUS], self.ram[BSR])
+    self.pc = k
+
+  def op_goto(self, k):
+    self.count_jump(k)
+    self.pc = k
+
+  def op_return(self, s):
+    self.pc = self.pop()
+    if s:
+      self.w, self.ram[STATUS], self.ram[BSR] = self.shadow
+
+  def op_retfie(self, s):
+    self.op_return(s)
+    self.ram[0xff2] |= 0x80
+
+  def op_lfsr(self, f, k):
+    self.set_fsr(f, k)
+
+  def op_movff(self, fs, fd):
+    value = self.load(self.effective(fs))
+    self.store(self.effective(fd), value)
+
+  def op_nop(self):
+    pass
+
+  def op_clrwdt(self):
+    pass
+
+  def op_sleep(self):
+    self.halted = True
+
+  def op_reset(self):
+    raise Error('reset executed at 0x%x' % (self.pc - 2))
+
+  def op_push(self):
+    self.push(self.pc)
+
+  def op_pop(self):
+    self.pop()
+
+  def op_daw(self):
+    w = self.w
+    c = self.flag(C)
+    if w & 0xf > 9 or self.flag(DC):
+      w += 6
+    if w >> 4 > 9 or c or w > 0xff:
+      w += 0x60
+    self.set_flags(C, w > 0xff and C or c)
+    self.w = w
+
+  def table_read(self, pre, post):
+    p = (self.tblptr() + pre) & 0x3fffff
+    self.ram[TABLAT] = self.read_flash(p)
+    self.set_tblptr(p + post)
+
+  def table_write(self, pre, post):
+    p = (self.tblptr() + pre) & 0x3fffff
+    self.holding[p & 7] = self.ram[TABLAT]
+    self.set_tblptr(p + post)
+
+  def op_tblrd_(self):
+    self.table_read(0, 0)
+
+  def op_tblrd_p(self):
+    self.table_read(0, 1)
+
+  def op_tblrd_m(self):
+    self.table_read(0, -1)
+
+  def op_tblrdp_(self):
+    self.table_read(1, 0)
+
+  def op_tblwt_(self):
+    self.table_write(0, 0)
+
+  def op_tblwt_p(self):
+    self.table_write(0, 1)
+
+  def op_tblwt_m(self):
+    self.table_write(0, -1)
+
+  def op_tblwtp_(self):
+    self.table_write(1, 0)
+
+  def run(self, max_cycles = None, until = None):
+    """Execute instructions until sleep, until the program counter reaches
+    until or until max_cycles have elapsed. Return the number of cycles
+    used."""
+    start = self.cycles
+    while not self.halted and self.pc != until:
+      if max_cycles is not None and self.cycles - start >= max_cycles:
+        raise Error('no completion after %d cycles, pc is 0x%x' %
+                    (max_cycles, self.pc))
+      self.step()
+    return self.cycles - start
+
+  def call(self, addr, max_cycles = 1000000):
+    """Call the code at addr as a subroutine and return the number of
+    cycles spent, including the call and the return instructions."""
+    self.push(Simulator.SENTINEL)
+    self.pc = addr
+    self.halted = False
+    return self.run(max_cycles, Simulator.SENTINEL) + 2
+
+def main():
+  parser = optparse.OptionParser(usage = '%prog [options] FILE.hex|FILE.asm')
+  parser.add_option('-a', '--address', metavar = 'ADDR', default = '0',
+                    help = 'call the code at ADDR (address or symbol '
+                    'when loading an assembly file) [0]')
+  parser.add_option('-c', '--cycles', metavar = 'N', type = 'int',
+                    default = 1000000,
+                    help = 'stop after N cycles [1000000]')
+  opts, args = parser.parse_args()
+  if len(args) != 1:
+    parser.print_help()
+    sys.exit(1)
+  try:
+    if args[0].endswith('.hex'):
+      program, eeprom = read_hex(open(args[0]).readlines())
+      addr = int(opts.address, 0)
+    else:
+      asm = Assembler()
+      program = assemble(open(args[0]).read(), asm)
+      eeprom = {}
+      addr = asm.evaluate(opts.address)
+    sim = Simulator(program, eeprom)
+    cycles = sim.call(addr, opts.cycles)
+  except Error as e:
+    sys.stderr.write('ERROR: %s\n' % e.msg)
+    sys.exit(1)
+  sys.stdout.write('%d cycles, W=0x%02x STATUS=0x%02x FSR0=0x%03x '
+                   'FSR2=0x%03x\n' % (cycles, sim.w, sim.ram[STATUS],
+                                      sim.fsr(0), sim.fsr(2)))
+
+if __name__ == '__main__':
+  main()
@@ -8,7 +8,9 @@
 """Forth compiler targetting the PIC18Fxxx microcontrollers family.
 
 Memory usage:
-   - BSR always points onto bank 1 where variables will be preferably stored
+   - BSR always points onto bank 1 where variables will be preferably stored;
+     at -O2 and -Os, it may point onto another bank within a word, but holds
+     1 again before any call, return or jump to another word
    - for a 16 bits value, low byte is stored at the lowest address
    - data stack is indexed by FSR0; stack grows upward; low byte is pushed
      first and high byte next; INDF0 points onto the latest high byte pushed
@@ -23,15 +25,36 @@ Memory usage:
      use bounds of 0x8000 and 0xFFFF.
    - core defined variables are located between 0x000 and 0x05f (in the first
      bank) and are not zero-initialized; they are typically temporary
-     variables used in computations
-   - user-defined variables are located starting at 0x0100"""
+     variables used in computations; at -O2 and -Os, cfor loops whose
+     body leaves the return stack alone count in such a variable rather
+     than on the return stack, or get unrolled when short enough
+   - user-defined variables are located starting at 0x0100; at -O2 and
+     -Os, the most used ones are moved into the access bank bytes left
+     free by the core ones, and unused ones are removed
+   - initial values of user-defined variables are stored by init_runtime;
+     at -O2 and -Os, long runs are copied from flash or cleared by a loop"""
 
-import optparse, os, re, string, sys
+import json, optparse, os, pic18, re, string, sys, traceback
+
+try:
+  from StringIO import StringIO
+except ImportError:
+  from io import StringIO
 
 compiler = None
 
 DEFAULT_PROCESSOR = '18f248'
 
+# Bytes of code a cfor loop with a known count may grow to when unrolled
+# at -O2
+UNROLL_BUDGET = 32
+
+# Number of iterations assumed for loops of unknown count, and cycles a
+# call site is expected to gain from the optimizations inlining enables,
+# when estimating the benefit of automatic inlining
+LOOP_WEIGHT = 10
+INLINE_BONUS = 2
+
 # Setup Forth search path. The search path is the current directory
 # then the directories in RFORTH1_PATH (if any) then rforth1 directory
 forth_search_path = ['.']
@@ -78,6 +101,28 @@ def error(str):
   """Print a fatal error on standard error."""
   stderror('ERROR: ' + str)
 
+def opcodes_size(opcodes):
+  """Return the number of instructions and of bytes used by a list of
+  opcodes. Labels, comments and markers take no room."""
+  instructions = size = 0
+  for name, _params in opcodes:
+    if name in ['LABEL', 'COMMENT'] or name.startswith('MARKER_'):
+      continue
+    instructions += 1
+    if name in ['call', 'goto', 'lfsr', 'movff']:
+      size += 4
+    else:
+      size += 2
+  return instructions, size
+
+def push_size(value):
+  """Return the number of bytes pushing a constant cell usually takes."""
+  low, high = value & 0xff, (value >> 8) & 0xff
+  size = low in [0, 0xff] and 2 or 4
+  if high in [0, 0xff, low]:
+    return size + 2
+  return size + 4
+
 def make_tuple(insn, parameters):
   return insn, tuple(parameters)
 
@@ -128,6 +173,8 @@ access = Number(0)
 no_access = Number(1)
 no_fast = Number(0)
 fast = Number(1)
+# Marks a jump to a label which must stay a goto, bra being out of reach
+far = Number(1)
 
 def in_access_bank(addr):
   """Check whether an address can be accessed through the access bank."""
@@ -146,8 +193,10 @@ def in_bank_1(addr):
 
 def short_addr(addr):
   """Check whether an address can be accessed using a short reference, with
-  or without an access bank."""
-  return in_access_bank(addr) or in_bank_1(addr)
+  or without an access bank. At -O2 and -Os, Word.expand_banks() selects
+  the bank of variables outside of bank 1."""
+  return in_access_bank(addr) or in_bank_1(addr) or \
+         (compiler.optimization in ['2', 's'] and banked_ram(addr))
 
 def access_bit(addr):
   """Return the right access bit depending on whether the address is present
@@ -167,12 +216,245 @@ def eeprom_addr(addr):
   addr = addr.static_value()
   return addr is not None and(addr & 0xf000 == 0x1000)
 
+def variables_in(value):
+  """Return the variables whose address value is computed from."""
+  if isinstance(value, Variable):
+    return [value]
+  if isinstance(value, Binary):
+    return variables_in(value.v1) + variables_in(value.v2)
+  if isinstance(value, Unary):
+    return variables_in(value.value)
+  if isinstance(value, Constant) and isinstance(value.value, LiteralValue):
+    return variables_in(value.value)
+  return []
+
 def is_static_push(opcode):
   return opcode[0] == 'OP_PUSH' and opcode[1][0].static_value() is not None
 
+def constant_calls(opcodes):
+  """Return the (word, value) pairs of the calls made right after pushing
+  a constant, value being the constant."""
+  calls = []
+  for i, (name, params) in enumerate(opcodes):
+    if name == 'call' and i and is_static_push(opcodes[i-1]):
+      calls.append((params[0], opcodes[i-1][1][0].static_value() & 0xffff))
+  return calls
+
 def is_ram_fetch(opcode):
   return opcode[0] == 'OP_FETCH' and ram_addr(opcode[1][0])
 
+def written_register(name, params):
+  """Return the address of the register written by an instruction, or None
+  if it does not write a register or it cannot be known."""
+  if name == 'movff':
+    return params[1].static_value()
+  if name == 'lfsr':
+    return compiler['FSR%dL' % params[0].static_value()].static_value()
+  if name not in pic18.instructions:
+    return None
+  kind = pic18.instructions[name][0]
+  if kind == 'fda' and len(params) > 1 and params[1].static_value() == 0:
+    return None
+  if kind in ['fda', 'fa', 'fba']:
+    return params[0].static_value()
+  return None
+
+def literal_byte(k):
+  """Return the byte loaded by a literal operand, or its text if it is
+  not known yet."""
+  if k.static_value() is None:
+    return repr(k)
+  return k.static_value() & 0xff
+
+def reads_w(name, params):
+  """Check whether an instruction may use the content of W."""
+  if name in ['addwf', 'addwfc', 'andwf', 'cpfseq', 'cpfsgt', 'cpfslt',
+              'iorwf', 'movwf', 'mulwf', 'subfwb', 'subwf', 'subwfb',
+              'xorwf', 'addlw', 'andlw', 'iorlw', 'mullw', 'sublw', 'xorlw',
+              'daw']:
+    return True
+  return [r for r in accessed_registers(name, params)
+          if r in [compiler[n].static_value() for n in
+                   ['WREG', 'PLUSW0', 'PLUSW1', 'PLUSW2']]] != []
+
+def written_operand(name, params):
+  """Return the operand designating the register an instruction may write,
+  or None if it writes no register."""
+  if name == 'movff':
+    return params[1]
+  if name not in pic18.instructions or \
+     name in ['btfsc', 'btfss', 'cpfseq', 'cpfsgt', 'cpfslt', 'mulwf',
+              'tstfsz']:
+    return None
+  kind = pic18.instructions[name][0]
+  if kind in ['fa', 'fba'] or \
+     (kind == 'fda' and params[1].static_value() != 0):
+    return params[0]
+  return None
+
+def writes_w(name, params):
+  """Check whether an instruction may change W."""
+  if name in ['movlw', 'addlw', 'andlw', 'iorlw', 'sublw', 'xorlw', 'retlw',
+              'daw', 'call', 'rcall']:
+    return True
+  if name in pic18.instructions and pic18.instructions[name][0] == 'fda' \
+     and len(params) > 1 and params[1].static_value() == 0:
+    return True
+  return written_register(name, params) == compiler['WREG'].static_value()
+
+def accessed_registers(name, params):
+  """Return the addresses of the registers an instruction works on."""
+  if name == 'movff':
+    return [p.static_value() for p in params]
+  if name in pic18.instructions and \
+     pic18.instructions[name][0] in ['fda', 'fa', 'fba']:
+    return [params[0].static_value()]
+  return []
+
+def banked_ram(addr):
+  """Check whether an address is a RAM byte outside of bank 0 that a
+  banked access can reach once BSR selects its bank."""
+  a = addr.static_value()
+  return a is not None and 0x100 <= a < 0xf00
+
+def required_bank(name, params):
+  """Return the bank BSR must select for a banked access, or None if the
+  instruction does not depend on BSR. Banked accesses outside of the
+  variables area keep assuming that BSR holds 1."""
+  if name not in pic18.instructions or \
+     pic18.instructions[name][0] not in ['fda', 'fa', 'fba']:
+    return None
+  if len(params) == {'fda': 3, 'fa': 2, 'fba': 3}[pic18.instructions[name][0]]:
+    if params[-1].static_value() == 0:
+      return None
+  elif in_access_bank(params[0]):
+    return None
+  if banked_ram(params[0]):
+    return params[0].static_value() >> 8
+  return 1
+
+def clobbered_registers(name, params):
+  """Return the operands designating the registers an instruction may
+  change, or None if its effect cannot be known. Words it calls are not
+  looked at."""
+  if name in ['LABEL', 'COMMENT', 'OP_SAVE_CONTEXT', 'OP_RESTORE_CONTEXT',
+              'OP_INTR_PROTECT', 'OP_INTR_UNPROTECT']:
+    return []
+  if name not in pic18.instructions or \
+     (name in ['call', 'rcall', 'goto', 'bra'] and
+      not isinstance(params[0], (Label, Word))):
+    return None
+  r = []
+  if name not in ['call', 'rcall'] and writes_w(name, params):
+    r.append(compiler['WREG'])
+  if name in ['addwf', 'addwfc', 'andwf', 'clrf', 'comf', 'decf', 'incf',
+              'iorwf', 'movf', 'negf', 'rlcf', 'rlncf', 'rrcf', 'rrncf',
+              'subfwb', 'subwf', 'subwfb', 'xorwf', 'addlw', 'andlw',
+              'iorlw', 'sublw', 'xorlw', 'daw']:
+    r.append(compiler['STATUS'])
+  if name == 'movlb':
+    r.append(compiler['BSR'])
+  if name in ['mullw', 'mulwf']:
+    r += [compiler['PRODL'], compiler['PRODH']]
+  if name[:5] == 'tblrd':
+    r.append(compiler['TABLAT'])
+  if name[:5] in ['tblrd', 'tblwt'] and name[5:] != '*':
+    r += [compiler['TBLPTRL'], compiler['TBLPTRH'], compiler['TBLPTRU']]
+  accessed = accessed_registers(name, params)
+  for fsr in range(3):
+    if (name == 'lfsr' and params[0].static_value() == fsr) or \
+       [n for n in ['POSTINC', 'POSTDEC', 'PREINC']
+        if compiler['%s%d' % (n, fsr)].static_value() in accessed]:
+      r += [compiler['FSR%dL' % fsr], compiler['FSR%dH' % fsr]]
+  written = written_operand(name, params)
+  if written is not None:
+    if written.static_value() is None or \
+       written.static_value() in [compiler[n].static_value() for n in
+                                  ['PCL', 'TOSL', 'TOSH', 'TOSU',
+                                   'STKPTR']]:
+      return None
+    r.append(written)
+  return r
+
+def clobbered_by(words):
+  """Return the operands designating the registers the words may change,
+  by address, or None if it cannot be known."""
+  clobbered = {}
+  for w in words:
+    for i, (name, params) in enumerate(w.opcodes):
+      if jump_table(w.opcodes, i) is not None:
+        continue
+      c = clobbered_registers(name, params)
+      if c is None:
+        return None
+      for r in c:
+        clobbered[r.static_value()] = r
+  return clobbered
+
+def reachable_words(words):
+  """Return the words in the list and the ones they may call or jump to,
+  preparing the latter if needed."""
+  words = words[:]
+  for w in words:
+    for r in w.references:
+      if isinstance(r, Word) and r not in words:
+        r.prepare()
+        words.append(r)
+  return words
+
+def flags_dead(opcodes, i):
+  """Check that the Z and N flags set at i are never looked at. Removed
+  instructions may be left as None in opcodes."""
+  for o in opcodes[i+1:]:
+    if o is None or o[0] == 'COMMENT':
+      continue
+    name, params = o
+    if name in CycleAnalysis.conditional_branches or \
+       compiler['STATUS'].static_value() in accessed_registers(name, params):
+      return False
+    if name in ['addwf', 'addwfc', 'andwf', 'comf', 'decf', 'incf',
+                'iorwf', 'movf', 'negf', 'rlcf', 'rlncf', 'rrcf',
+                'rrncf', 'subfwb', 'subwf', 'subwfb', 'xorwf', 'addlw',
+                'andlw', 'iorlw', 'sublw', 'xorlw']:
+      return True
+    if name not in pic18.instructions or name in \
+       ['bra', 'goto', 'call', 'rcall', 'return', 'retlw', 'retfie']:
+      return False
+  return False
+
+def indirect_registers():
+  """Return the addresses of the registers accessing RAM through FSR1 and
+  FSR2."""
+  return [compiler['%s%d' % (n, i)].static_value()
+          for n in ['INDF', 'POSTINC', 'POSTDEC', 'PREINC', 'PLUSW']
+          for i in [1, 2]]
+
+def tracked_byte(addr):
+  """Check that addr is a RAM byte outside of the stacks, which are also
+  changed by indirect accesses."""
+  a = addr.static_value()
+  return a is not None and (a < 0x60 or 0x100 <= a < 0xf60)
+
+def w_dead(opcodes, i, returns_w = True):
+  """Check that the content of W set at i is overwritten before being
+  used. Removed instructions may be left as None in opcodes. Unless
+  returns_w is False, W is considered as used by a return."""
+  skipping = False
+  for o in opcodes[i+1:]:
+    if o is None or o[0] in ['COMMENT', 'LABEL']:
+      continue
+    name, params = o
+    conditional, skipping = skipping, name in CycleAnalysis.skips
+    if name == 'return' and not returns_w:
+      return not conditional
+    if reads_w(name, params) or name not in pic18.instructions or \
+       name in CycleAnalysis.conditional_branches or name in \
+       ['bra', 'goto', 'call', 'rcall', 'return', 'retfie', 'reset']:
+      return False
+    if writes_w(name, params) and not conditional:
+      return True
+  return False
+
 class Named:
 
   immediate = True
@@ -317,6 +599,13 @@ class LeftShift(Binary):
   def compute(self, a1, a2):
     return a1 << a2
 
+class RightShift(Binary):
+
+  op = '>>'
+
+  def compute(self, a1, a2):
+    return (a1 & 0xffff) >> a2
+
 class Unary(LiteralValue):
 
   r = None
@@ -395,9 +684,22 @@ class NamedReference(Named):
 
 class Label(NamedReference):
 
+  # Maximum number of iterations of the loop starting at this label if
+  # known, and whether this number is exact
+  loop_bound = None
+  loop_exact = False
+
   def makes_reference_to(self, l):
     return self == l
 
+class JumpTable(Label):
+  """Label of a table of size bra instructions a computed jump goes
+  through."""
+
+  def __init__(self, size):
+    Label.__init__(self)
+    self.size = size
+
 class FlashData(NamedReference):
 
   section = 'static data'
@@ -447,14 +749,31 @@ class Forward(Label):
   def can_inline(self):
     return False
 
-def make_primitive(runfunc):
+# Primitives which rewrite the previous opcodes when they are statically
+# known, along with the generic code they would emit otherwise. This is only
+# used to gather optimization statistics.
+static_rewrites = {'primitive_to_w': 'OP_POP_W',
+                   'primitive_dup': 'OP_DUP',
+                   'primitive_drop': 'OP_POP_W',
+                   'primitive_store': 'op_store',
+                   'primitive_c_store': 'op_cstore',
+                   'primitive_bit_set': 'op_bit_set',
+                   'primitive_bit_clr': 'op_bit_clr',
+                   'primitive_bit_toggle': 'op_bit_toggle',
+                   'primitive_bit_is_set': 'op_bit_set_q',
+                   'primitive_bit_is_clr': 'op_bit_clr_q'}
+
+def make_primitive(runfunc, rule = None):
   class _primitive(Primitive):
     def run(self, *args):
-      runfunc(*args)
+      if rule in static_rewrites and compiler.stats is not None:
+        compiler.measure_rewrite(rule, runfunc, args)
+      else:
+        runfunc(*args)
   return _primitive
 
 def register_primitives():
-  return [(data.__doc__ or name[10:], make_primitive(data))
+  return [(data.__doc__ or name[10:], make_primitive(data, name))
           for (name, data) in globals().items()
           if name.startswith('primitive_')]
 
@@ -473,6 +792,16 @@ def primitive_intr_unprotect():
   "intr-unprotect"
   compiler.add_instruction('OP_INTR_UNPROTECT', [])
 
+def primitive_save_context():
+  "save-context"
+  compiler.check_interrupts()
+  compiler.add_instruction('OP_SAVE_CONTEXT', [])
+
+def primitive_restore_context():
+  "restore-context"
+  compiler.check_interrupts()
+  compiler.add_instruction('OP_RESTORE_CONTEXT', [])
+
 def primitive_literal_char():
   "[char]"
   char = Number(ord(compiler.parse_word()[0]))
@@ -506,6 +835,14 @@ def primitive_literal():
 
 def primitive_to_w(warn = True):
   ">w"
+  expression = compiler.last_expression()
+  if expression:
+    start, tree, references = expression
+    compiler.current_object.opcodes = compiler.current_object.opcodes[:start]
+    compiler.current_object.references = references[:]
+    for instruction, params in byte_code(tree):
+      compiler.add_instruction(instruction, params)
+    return
   name, params = compiler.last_instruction()
   if name == 'OP_PUSH':
     compiler.rewind()
@@ -536,6 +873,8 @@ def primitive_to_w(warn = True):
 def primitive_dup():
   name, params = compiler.last_instruction()
   if name in ['OP_PUSH', 'OP_PUSH_W']:
+    compiler.rewind()
+    compiler.add_instruction(name, params)
     compiler.add_instruction(name, params)
   elif name in ['OP_CFETCH']:
     compiler.rewind()
@@ -585,9 +924,11 @@ def primitive_to_r():
   ">r"
   name, params = compiler.last_instruction()
   if name == 'OP_PUSH':
+    # movff would read the literal as an address, go through W instead
     compiler.rewind()
-    compiler.add_instruction('movff', [high(params[0]), compiler['PREINC2']])
-    compiler.add_instruction('movff', [low(params[0]), compiler['PREINC2']])
+    for b in [high(params[0]), low(params[0])]:
+      compiler.add_instruction('movlw', [b])
+      compiler.add_instruction('movwf', [compiler['PREINC2'], access])
   else:
     compiler.add_instruction('movff', [compiler['POSTDEC0'], compiler['PREINC2']])
     compiler.add_instruction('movff', [compiler['POSTDEC0'], compiler['PREINC2']])
@@ -626,8 +967,10 @@ def primitive_cfor():
       compiler.warning('loop index may be larger than one byte')
     compiler.add_instruction('movwf', [compiler['PREINC2'], access])
     compiler.add_instruction('bz', [label_uncfor])
+    bound = None
   else:
     bound_checks = True
+    bound = None
     if name == 'OP_PUSH':
       value = params[0].static_value()
       if value == 0:
@@ -638,6 +981,7 @@ def primitive_cfor():
         compiler.error('loop limit does not fit in a byte')
       elif value is not None:
         bound_checks = False
+        bound = value
     compiler.eval('>w')
     compiler.add_instruction('movwf',
                                    [compiler['PREINC2'], access])
@@ -647,6 +991,10 @@ def primitive_cfor():
         compiler.add_instruction('iorlw', [Number(0)])
       compiler.add_instruction('bz', [label_uncfor])
   compiler.eval('begin')
+  label = compiler.ct_pop()
+  label.loop_bound = bound or 255
+  label.loop_exact = bound is not None
+  compiler.ct_push(label)
 
 def primitive_ob_ob():
   "[["
@@ -675,7 +1023,344 @@ def primitive_repeat():
   for _ in range(counter):
     compiler.eval('then')
 
+def shift_code(count, kind):
+  """Return the instructions shifting the top of the data stack by count
+  bits to the left (kind 'l'), or to the right copying (kind 'a') or
+  clearing (kind 'r') the sign bit. Rotations through the carry are used
+  for small counts, the multiplier or byte moves otherwise."""
+  l = []
+  def append(name, *params):
+    l.append((name, list(params)))
+  status, indf = compiler['STATUS'], compiler['INDF0']
+  postinc, postdec = compiler['POSTINC0'], compiler['POSTDEC0']
+  prodl, prodh = compiler['PRODL'], compiler['PRODH']
+  if kind == 'a':
+    count = min(count, 15)
+  if count >= 16:
+    append('clrf', postdec, access)
+    append('clrf', postinc, access)
+  elif count >= 8:
+    # Move a byte, then shift it
+    k = count - 8
+    if kind == 'l':
+      append('movf', postdec, dst_f, access)
+      append('movf', indf, dst_w, access)
+      append('clrf', postinc, access)
+      if k:
+        append('mullw', Number(1 << k))
+        append('movff', prodl, indf)
+      else:
+        append('movwf', indf, access)
+    else:
+      # N holds the sign of the MSB
+      append('movf', postdec, dst_w, access)
+      if k:
+        append('mullw', Number(1 << (8 - k)))
+        if kind == 'a':
+          append('movlw', Number(1 << (8 - k)))
+          append('btfsc', status, Number(4), access)
+          append('subwf', prodh, dst_f, access)
+        append('movff', prodh, postinc)
+      else:
+        append('movwf', postinc, access)
+      append('clrf', indf, access)
+      if kind == 'a':
+        append('btfsc', status, Number(4), access)
+        append('setf', indf, access)
+  elif kind == 'l' and count < 3:
+    append('movf', postdec, dst_f, access)
+    for i in range(count):
+      append('bcf', status, Number(0), access)
+      append('rlcf', postinc, dst_f, access)
+      append('rlcf', (i < count - 1 and postdec) or indf, dst_f, access)
+  elif kind == 'l':
+    # The bits leaving the LSB are added to the shifted MSB
+    append('movlw', Number(1 << count))
+    append('mulwf', indf, access)
+    append('movff', prodl, postdec)
+    append('mulwf', indf, access)
+    append('movff', prodl, postinc)
+    append('movf', prodh, dst_w, access)
+    append('addwf', indf, dst_f, access)
+  elif count < 4 or (kind == 'a' and count < 5):
+    for i in range(count):
+      if kind == 'a':
+        append('rlcf', indf, dst_w, access)
+      else:
+        append('bcf', status, Number(0), access)
+      append('rrcf', postdec, dst_f, access)
+      append('rrcf', postinc, dst_f, access)
+  else:
+    # The bits leaving the MSB are added to the shifted LSB
+    append('movf', postdec, dst_f, access)
+    append('movlw', Number(1 << (8 - count)))
+    append('mulwf', indf, access)
+    append('movff', prodh, indf)
+    append('mulwf', compiler['PREINC0'], access)
+    append('movff', prodh, postdec)
+    append('movf', prodl, dst_w, access)
+    append('addwf', postinc, dst_f, access)
+    if kind == 'a':
+      append('movlw', Number(~(0xff >> count) & 0xff, 16))
+      append('btfsc', indf, Number(7 - count), access)
+      append('iorwf', indf, dst_f, access)
+  return l
+
+def byte_operand(opcode):
+  """Return the expression tree of the value pushed by opcode if its low byte
+  can be read without going through the data stack, or None."""
+  name, params = opcode
+  if is_static_push(opcode):
+    return 'lit', params[0].static_value() & 0xffff, params[0]
+  if name in ['OP_FETCH', 'OP_CFETCH'] and ram_addr(params[0]) and \
+     short_addr(params[0]):
+    if name == 'OP_CFETCH':
+      return 'c@', params[0]
+    if not is_special_register(params[0]):
+      return '@', params[0]
+  return None
+
+def byte_valued(tree):
+  """Check whether the value of an expression tree always fits in a byte."""
+  kind = tree[0]
+  if kind == 'lit':
+    return octet(tree[1])
+  if kind in ['c@', 'lsb']:
+    return True
+  if kind == 'and':
+    return byte_valued(tree[1]) or byte_valued(tree[2])
+  if kind in ['or', 'xor']:
+    return byte_valued(tree[1]) and byte_valued(tree[2])
+  return False
+
+def constant_tree(tree):
+  """Check whether an expression tree only contains literals."""
+  if tree[0] in ['c@', '@']:
+    return False
+  return tree[0] == 'lit' or not [t for t in tree[1:] if not constant_tree(t)]
+
+def movable(tree):
+  """Check whether an expression tree is a leaf which can be read before
+  the code preceding it."""
+  return tree[0] == 'lit' or \
+         (tree[0] in ['c@', '@'] and tree[1].static_value() < 0xf60)
+
+def leaf_literal(leaf):
+  """Return the low byte of a literal leaf, keeping the literal as written
+  if it is one."""
+  if leaf[2] is not None and octet(leaf[2].static_value()):
+    return leaf[2]
+  return Number(leaf[1] & 0xff)
+
+def with_w(kind, leaf, dst = dst_w):
+  """Return the instruction combining W with leaf, computing leaf - W for
+  a subtraction."""
+  if leaf[0] == 'lit':
+    literals = {'+': 'addlw', 'and': 'andlw', 'or': 'iorlw', 'xor': 'xorlw',
+                '-': 'sublw'}
+    return literals[kind], [leaf_literal(leaf)]
+  registers = {'+': 'addwf', 'and': 'andwf', 'or': 'iorwf', 'xor': 'xorwf',
+               '-': 'subwf'}
+  return registers[kind], [leaf[1], dst, access_bit(leaf[1])]
+
+def in_place(tree, dst = dst_w):
+  """Return a single instruction computing a unary operation on a register
+  leaf, or None."""
+  kind, a, b = tree
+  if kind == '-' and b[0] == 'lit':
+    kind, b = '+', ('lit', -b[1] & 0xffff, None)
+  if kind in ['+', 'xor'] and a[0] == 'lit':
+    a, b = b, a
+  if a[0] not in ['c@', '@'] or b[0] != 'lit':
+    return None
+  single = {('+', 1): 'incf', ('+', 0xff): 'decf', ('xor', 0xff): 'comf'}
+  name = single.get((kind, b[1] & 0xff))
+  return name and (name, [a[1], dst, access_bit(a[1])])
+
+def byte_code(tree):
+  """Return the instructions computing the low byte of an expression tree
+  into W, or None if it cannot be done with W alone."""
+  kind = tree[0]
+  if kind == 'lit':
+    return [('movlw', [leaf_literal(tree)])]
+  if kind in ['c@', '@']:
+    return [('movf', [tree[1], dst_w, access_bit(tree[1])])]
+  if kind == 'lsb':
+    return byte_code(tree[1])
+  if kind == '2*':
+    code = byte_code(tree[1])
+    return code and code + [('addwf', [compiler['WREG'], dst_w, access])]
+  a, b = tree[1], tree[2]
+  single = in_place(tree)
+  if single:
+    return [single]
+  if kind == '-' and b[0] == 'lit':
+    kind, b = '+', ('lit', -b[1] & 0xffff, None)
+  if kind != '-' and b[0] in ['lit', 'c@', '@']:
+    code = byte_code(a)
+    return code and code + [with_w(kind, b)]
+  if movable(a):
+    code = byte_code(b)
+    return code and code + [with_w(kind, a)]
+  if kind == '-' and b[0] in ['c@', '@']:
+    # W = b - a, then negate it
+    code = byte_code(a)
+    return code and code + [with_w(kind, b),
+                            ('negf', [compiler['WREG'], access])]
+  return None
+
+def byte_store_code(tree, addr):
+  """Return the instructions storing the low byte of an expression tree at
+  addr, working directly on addr if the tree is an operation on it."""
+  same = lambda t: t[0] in ['c@', '@'] and \
+                   t[1].static_value() == addr.static_value()
+  kind = tree[0]
+  if kind in ['+', '-', 'and', 'or', 'xor'] and short_addr(addr):
+    a, b = tree[1], tree[2]
+    if kind != '-' and same(b) and not same(a):
+      a, b = b, a
+    if same(a) and movable(a):
+      single = in_place((kind, a, b), dst_f)
+      if single:
+        return [single]
+      code = byte_code(b)
+      if code:
+        return code + [with_w(kind, a, dst_f)]
+  code = byte_code(tree)
+  if code and short_addr(addr):
+    return code + [('movwf', [addr, access_bit(addr)])]
+  return code and code + [('movff', [compiler['WREG'], addr])]
+
+def comparison_operand(opcode):
+  """Return the low and high bytes of the value pushed by opcode, as integers
+  for literal bytes and addresses for bytes in RAM, or None if they cannot
+  be read without going through the data stack."""
+  name, params = opcode
+  if is_static_push(opcode):
+    value = params[0].static_value() & 0xffff
+    return [value & 0xff, value >> 8]
+  if name == 'OP_CFETCH' and ram_addr(params[0]):
+    return [params[0], 0]
+  if name == 'OP_FETCH' and ram_addr(params[0]) and \
+     not is_special_register(params[0]):
+    return [params[0], Add(params[0], Number(1))]
+  return None
+
+def operate_w(instruction, byte):
+  """Add instruction working on W and byte, using its literal form if the
+  byte is known."""
+  if isinstance(byte, int):
+    literals = {'movf': 'movlw', 'xorwf': 'xorlw', 'subwf': 'sublw'}
+    compiler.add_instruction(literals[instruction], [Number(byte)])
+  else:
+    compiler.add_instruction(instruction, [byte, dst_w, access_bit(byte)])
+
+def skip_or_jump(instruction, bit, label):
+  compiler.add_instruction(instruction, bit + [access])
+  compiler.add_instruction('bra', [label])
+
+def fuse_comparison(kind, operands, invert):
+  """Emit the test and jump of an if on comparison kind between operands
+  (bytes given by comparison_operand, or None for the top of the data stack)
+  without building a flag, and return True, or return False if it cannot
+  be done this way."""
+  negations = {'eq': 'ne', 'ne': 'eq', 'lt': 'ge', 'ge': 'lt',
+               'ult': 'uge', 'uge': 'ult', 'zeq': 'zne', 'zne': 'zeq',
+               'zlt': 'zge', 'zge': 'zlt'}
+  known = lambda x: isinstance(x, int)
+  if invert:
+    kind = negations[kind]
+  if len(operands) == 2:
+    a, b = operands
+    if known(a[0]) and known(a[1]) and known(b[0]) and known(b[1]):
+      return False
+    if kind in ['eq', 'ne'] and [0, 0] in operands:
+      kind = 'z' + kind
+      operands = [a == [0, 0] and b or a]
+    elif kind in ['eq', 'ne']:
+      pairs = [(x, y) for x, y in zip(a, b)
+               if not known(x) or not known(y) or x != y]
+      if [1 for x, y in pairs if known(x) and known(y)]:
+        return False
+    elif a[1] != 0 or b[1] != 0:
+      # a - b needs the high byte of a in a register: if a is a literal,
+      # compare b with a+1 using the opposite condition instead
+      if known(a[1]) and known(a[0]):
+        value = a[0] | (a[1] << 8)
+        if kind in ['lt', 'ge'] and value == 0x7fff:
+          return False
+        value = (value + 1) & 0xffff
+        a, b = b, [value & 0xff, value >> 8]
+        kind = negations[kind]
+      if known(a[1]) and (a[1] != 0 or b[1] != 0):
+        return False
+  if len(operands) == 1:
+    x = operands[0]
+    if kind in ['zeq', 'zne'] and (x is None or known(x[0])):
+      return False
+    if kind in ['zlt', 'zge'] and x is not None and known(x[1]):
+      return False
+  label = Label()
+  z, n, c = compiler['Z'], compiler['N'], compiler['C']
+  if kind in ['zeq', 'zne']:
+    x = operands[0]
+    operate_w('movf', x[0])
+    if not known(x[1]):
+      compiler.add_instruction('iorwf', [x[1], dst_w, access_bit(x[1])])
+    skip_or_jump(kind == 'zeq' and 'btfss' or 'btfsc', z, label)
+  elif kind in ['zlt', 'zge']:
+    x = operands[0]
+    if x is None:
+      compiler.add_instruction('movf', [compiler['POSTDEC0'], dst_w, access])
+      compiler.add_instruction('movf', [compiler['POSTDEC0'], dst_f, access])
+      bit = [compiler['WREG'], Number(7), access]
+    else:
+      bit = [x[1], Number(7), access_bit(x[1])]
+    compiler.add_instruction(kind == 'zlt' and 'btfss' or 'btfsc', bit)
+    compiler.add_instruction('bra', [label])
+  elif kind in ['eq', 'ne']:
+    different = Label()
+    for i in range(len(pairs)):
+      x, y = pairs[i]
+      if known(x):
+        x, y = y, x
+      operate_w('movf', y)
+      operate_w('xorwf', x)
+      if kind == 'eq':
+        skip_or_jump('btfss', z, label)
+      elif i < len(pairs) - 1:
+        skip_or_jump('btfss', z, different)
+      else:
+        skip_or_jump('btfsc', z, label)
+    if kind == 'ne' and len(pairs) > 1:
+      compiler.add_instruction('LABEL', [different])
+  else:
+    # W gets a - b, with the carry cleared on borrow
+    operate_w('movf', b[0])
+    operate_w('subwf', a[0])
+    if a[1] == 0 and b[1] == 0:
+      skip_or_jump(kind in ['lt', 'ult'] and 'btfsc' or 'btfss', c, label)
+    else:
+      operate_w('movf', b[1])
+      compiler.add_instruction('subwfb', [a[1], dst_w, access_bit(a[1])])
+      if kind in ['lt', 'ge']:
+        # Signed comparison: the sign of the result is wrong on overflow
+        compiler.add_instruction('btfsc', compiler['OV'] + [access])
+        compiler.add_instruction('btg', n + [access])
+      skip_or_jump(kind in ['lt', 'ult'] and 'btfss' or 'btfsc', n, label)
+  compiler.ct_push(label)
+  return True
+
 def primitive_if(invert = False):
+  comparison = compiler.last_comparison()
+  if comparison:
+    kind, operands, prefix, references = comparison
+    word = compiler.current_object
+    opcodes, word.opcodes = word.opcodes, prefix
+    word_references, word.references = word.references, references
+    if fuse_comparison(kind, operands, invert):
+      return
+    word.opcodes, word.references = opcodes, word_references
   name, params = compiler.last_instruction()
   if name == 'OP_PUSH':
     value = params[0].static_value()
@@ -730,10 +1415,16 @@ def primitive_question_if():
   compiler.eval('ahead')
 
 # Structure of the switch statement on the compile stack is:
+#   - cases as (value, index of the test, label of the code) and the
+#     default label at -O2 and -Os, None otherwise
 #   - next label or None for the first case
 #   - switch end label
 #   - xored value
 def primitive_switchw():
+  if compiler.optimization in ['2', 's']:
+    compiler.ct_push([[], None])
+  else:
+    compiler.ct_push(None)
   compiler.ct_push(None)
   compiler.ct_push(Label())
   compiler.ct_push(0)
@@ -748,18 +1439,27 @@ def primitive_casew(is_default = False):
   xored = compiler.ct_pop()
   label = compiler.ct_pop()
   nlabel = compiler.ct_pop()
+  cases = compiler.ct_pop()
   if nlabel is not None:
     compiler.add_instruction('bra', [label])
     compiler.add_instruction('LABEL', [nlabel])
+  if cases is not None and is_default:
+    cases[1] = nlabel or label
+  compiler.ct_push(cases)
   nlabel = Label()
   compiler.ct_push(nlabel)
   compiler.ct_push(label)
   if not is_default:
+    start = len(compiler.current_object.opcodes)
     xored ^= params[0].static_value()
     compiler.add_instruction('xorlw', [Number(xored)])
     value, bit = compiler['Z']
     compiler.add_instruction('btfss', [value, bit, access])
     compiler.add_instruction('bra', [nlabel])
+    if cases is not None:
+      code = Label()
+      compiler.add_instruction('LABEL', [code])
+      cases[0].append((params[0].static_value(), start, code))
     compiler.ct_push(params[0].static_value())
   else:
     compiler.ct_push(xored)
@@ -774,8 +1474,49 @@ def primitive_endswitchw():
   _xored = compiler.ct_pop()
   label = compiler.ct_pop()
   nlabel = compiler.ct_pop()
+  cases = compiler.ct_pop()
   compiler.add_instruction('LABEL', [nlabel])
   compiler.add_instruction('LABEL', [label])
+  if cases is not None:
+    jump_table_dispatch(cases[0], cases[1] or label)
+
+def jump_table_dispatch(cases, default):
+  """Replace the chain of tests of a switchw by a jump through a table
+  when the cases are dense enough for the table not to be longer, the
+  dispatch then taking the same time for every case."""
+  opcodes = compiler.current_object.opcodes
+  values = [v & 0xff for v, _start, _code in cases]
+  if len(set(values)) != len(values) or not values:
+    return
+  low = min(values)
+  span = max(values) - low + 1
+  if span > 128 or span + 12 > 3 * len(values):
+    return
+  for _v, start, _code in cases:
+    if opcodes[start][0] != 'xorlw' or opcodes[start+1][0] != 'btfss' or \
+       opcodes[start+2][0] != 'bra':
+      return
+  # The index is reversed by sublw, which checks both bounds at once
+  targets = [default] * span
+  for v, _start, code in cases:
+    targets[span - 1 - ((v & 0xff) - low)] = code
+  dispatch = []
+  if low:
+    dispatch.append(('addlw', [Number(-low & 0xff)]))
+  dispatch += [('sublw', [Number(span - 1)]),
+               ('bnc', [default]),
+               ('OP_JUMP_TABLE', targets)]
+  starts = [start for _v, start, _code in cases]
+  new = []
+  for i, o in enumerate(opcodes):
+    if i == starts[0]:
+      new += dispatch
+    if not [start for start in starts if start <= i < start + 3]:
+      new.append(o)
+  compiler.current_object.opcodes = new
+  for o in dispatch:
+    for p in o[1]:
+      compiler.current_object.refers_to(p)
 
 def primitive_literal_address():
   "[']"
@@ -805,7 +1546,186 @@ def primitive_until():
   compiler['while'].run(True)
   compiler.eval('repeat')
 
+def primitive_for():
+  name, params = compiler.last_instruction()
+  label_unfor = Label()
+  label_noloop = Label()
+  compiler.ct_push(label_noloop)
+  compiler.ct_push(label_unfor)
+  value = name == 'OP_PUSH' and params[0].static_value()
+  if value is not False and value is not None:
+    compiler.rewind()
+    if value == 0:
+      compiler.warning('empty loop will not execute')
+      compiler.add_instruction('bra', [label_noloop])
+    elif value < 0 or value > 0xffff:
+      compiler.error('loop limit does not fit in a cell')
+    # The high byte counts the passes through the low byte loop
+    for b in [(value >> 8) + (value & 0xff and 1 or 0), value & 0xff]:
+      compiler.push(Number(b))
+      compiler.eval('>w')
+      compiler.add_instruction('movwf', [compiler['PREINC2'], access])
+  else:
+    compiler.eval('>r')
+    compiler.add_instruction('movf', [compiler['POSTDEC2'], dst_w, access])
+    compiler.add_instruction('btfss', compiler['Z'] + [access])
+    compiler.add_instruction('incf', [compiler['INDF2'], dst_f, access])
+    compiler.add_instruction('iorwf',
+                             [compiler['POSTINC2'], dst_w, access])
+    compiler.add_instruction('bz', [label_unfor])
+  compiler.eval('begin')
+
+def primitive_next():
+  label = compiler.ct_pop()
+  assert(compiler.ct_pop() == 0)
+  compiler.add_instruction('decfsz', [compiler['INDF2'], dst_f, access])
+  compiler.add_instruction('bra', [label])
+  compiler.add_instruction('movf', [compiler['POSTDEC2'], dst_f, access])
+  compiler.add_instruction('decfsz', [compiler['POSTINC2'], dst_f, access])
+  compiler.add_instruction('bra', [label])
+  compiler.add_instruction('LABEL', [compiler.ct_pop()])
+  compiler.add_instruction('movf', [compiler['POSTDEC2'], dst_f, access])
+  compiler.add_instruction('movf', [compiler['POSTDEC2'], dst_f, access])
+  compiler.add_instruction('LABEL', [compiler.ct_pop()])
+
+def return_stack_effect(opcodes, word, effects, counters):
+  """Return the lowest depth of the return stack reached by opcodes, relative
+  to the one they start with, along with the depth they end with, following
+  jumps and calls. Return None if this cannot be told, if opcodes look at
+  the return addresses or may get back into word. The effects of the called
+  words are cached in effects and the cfor loop counters used are added to
+  counters."""
+  stack = dict([(compiler[r].static_value(), r) for r in
+                ['INDF2', 'POSTINC2', 'POSTDEC2', 'PREINC2', 'PLUSW2',
+                 'FSR2L', 'FSR2H']])
+  forbidden = [compiler[r].static_value() for r in
+               ['PCL', 'PCLATH', 'PCLATU', 'TOSL', 'TOSH', 'TOSU', 'STKPTR']]
+  targets = [p for n, ps in opcodes if n != 'LABEL'
+             for p in ps if isinstance(p, Label)]
+  depths = {}
+  ends = []
+  low = depth = 0
+  live, skipped = True, False
+  for name, params in opcodes:
+    if name == 'LABEL':
+      label = params[0]
+      if label in depths and live and depths[label] != depth:
+        return None
+      if label in depths:
+        depth = depths[label]
+      elif not live and label in targets:
+        # Only reached by a jump backwards
+        return None
+      depths[label] = depth
+      live = True
+      continue
+    before = depth
+    for p in params:
+      if isinstance(p, Forward) or p is word:
+        return None
+      if isinstance(p, Word):
+        if p not in effects:
+          effects[p] = None
+          effects[p] = return_stack_effect(p.opcodes, word, effects,
+                                           counters)
+        if effects[p] is None:
+          return None
+        low = min(low, depth + effects[p][0])
+        depth += effects[p][1]
+      elif isinstance(p, Label):
+        if name in ['call', 'rcall']:
+          return None
+        if depths.setdefault(p, depth) != depth:
+          return None
+      elif p in compiler.loop_counters:
+        if p not in counters:
+          counters.append(p)
+      elif isinstance(p, LiteralValue):
+        a = p.static_value()
+        if a in forbidden:
+          return None
+        if a in stack:
+          if name.startswith('OP_'):
+            return None
+          if stack[a] == 'PREINC2':
+            depth += 1
+          elif stack[a] in ['INDF2', 'POSTDEC2']:
+            low = min(low, depth - 1)
+            if stack[a] == 'POSTDEC2':
+              depth -= 1
+          else:
+            return None
+    if skipped and depth != before:
+      return None
+    if name in ['return', 'retlw', 'retfie'] or \
+       (name == 'goto' and isinstance(params[0], Word)):
+      ends.append(depth)
+    live = skipped or name not in ['bra', 'goto', 'return', 'retlw',
+                                   'retfie', 'reset']
+    skipped = name in CycleAnalysis.skips
+  if live:
+    ends.append(depth)
+  if [d for d in ends if d != ends[0]]:
+    return None
+  return low, ends and ends[0] or 0
+
+def close_cfor():
+  """Close the cfor loop being compiled without keeping its counter on the
+  return stack when nothing in its body can notice: a short enough loop
+  with a known count is unrolled, another one counts in a byte of the
+  access bank. Return False if the loop has to be closed as usual."""
+  word = compiler.current_object
+  label = compiler.data_stack[0]
+  start = word.opcodes.index(('LABEL', [label]))
+  setup, body = word.opcodes[:start], word.opcodes[start+1:]
+  labels = [p[0] for n, p in body if n == 'LABEL']
+  for name, params in body:
+    if name in ['return', 'retlw', 'retfie', 'reset'] or \
+       [p for p in params if isinstance(p, Label) and p not in labels]:
+      return False
+  used = []
+  if return_stack_effect(body, word, {}, used) != (0, 0):
+    return False
+  push = ('movwf', [compiler['PREINC2'], access])
+  if setup[-1] == push:
+    k = start - 1
+  elif setup[-2] == push and setup[-1][0] == 'bz':
+    k = start - 2
+  else:
+    return False
+  # The labels of inlined words are left out of the unrolled copies
+  body = [o for o in body if o[0] != 'LABEL']
+  if label.loop_exact and k == start - 1 and setup[k-1][0] == 'movlw' and \
+     not [n for n, p in body if [x for x in p if isinstance(x, Label)]] and \
+     not (body and body[-1][0] in CycleAnalysis.skips):
+    # Counting takes 4 instructions
+    size = opcodes_size(word.expanded(body))[1]
+    unrolled = label.loop_bound * size
+    if unrolled <= size + 8 or \
+       (compiler.optimization == '2' and unrolled <= UNROLL_BUDGET):
+      word.opcodes = setup[:k-1]
+      for i in range(label.loop_bound):
+        word.opcodes += [(n, p[:]) for n, p in body]
+      word.references.remove(compiler['PREINC2'])
+      for i in range(4):
+        compiler.ct_pop()
+      return True
+  counters = [c for c in compiler.loop_counters if c not in used]
+  counter = counters and counters[0] or compiler.new_loop_counter()
+  if not counter:
+    return False
+  word.opcodes[k] = ('movwf', [counter, access])
+  word.references.remove(compiler['PREINC2'])
+  word.refers_to(counter)
+  compiler.add_instruction('decfsz', [counter, dst_f, access])
+  compiler.eval('again')
+  compiler.add_instruction('LABEL', [compiler.ct_pop()])
+  compiler.add_instruction('LABEL', [compiler.ct_pop()])
+  return True
+
 def primitive_cnext():
+  if compiler.optimization in ['2', 's'] and close_cfor():
+    return
   compiler.add_instruction('decfsz',
                                  [compiler['INDF2'], dst_f, access])
   compiler.eval('again')
@@ -1090,6 +2010,12 @@ def primitive_lshift():
       _name, operand = compiler.last_instruction()
       compiler.rewind()
       compiler.push(LeftShift(operand[0], nsteps[0]))
+    elif compiler.optimization in ['2', 's'] and \
+         is_static_push(compiler.last_instruction()) and \
+         compiler.last_instruction()[1][0].static_value() >= 0:
+      _name, nsteps = compiler.last_instruction()
+      compiler.rewind()
+      compiler.add_shift(nsteps[0].static_value(), 'l')
     else:
       compiler.eval('cfor 2* cnext')
   else:
@@ -1097,6 +2023,30 @@ def primitive_lshift():
     operand = compiler.ct_pop()
     compiler.ct_push(LeftShift(operand, nsteps))
 
+def primitive_rshift():
+  if compiler.state:
+    if is_static_push(compiler.last_instruction()) and \
+       is_static_push(compiler.before_last_instruction()):
+      _name, nsteps = compiler.last_instruction()
+      compiler.rewind()
+      _name, operand = compiler.last_instruction()
+      compiler.rewind()
+      compiler.push(RightShift(operand[0], nsteps[0]))
+    elif compiler.optimization in ['2', 's'] and \
+         is_static_push(compiler.last_instruction()) and \
+         compiler.last_instruction()[1][0].static_value() >= 0:
+      _name, nsteps = compiler.last_instruction()
+      compiler.rewind()
+      compiler.add_shift(nsteps[0].static_value(), 'r')
+    else:
+      compiler.eval('cfor')
+      compiler.add_instruction('OP_SHIFT', [Number(1), 'r'])
+      compiler.eval('cnext')
+  else:
+    nsteps = compiler.ct_pop()
+    operand = compiler.ct_pop()
+    compiler.ct_push(RightShift(operand, nsteps))
+
 def primitive_equal():
   "="
   if is_static_push(compiler.last_instruction()) and \
@@ -1110,14 +2060,20 @@ def primitive_colon():
   ":"
   compiler.state = 1
   name = compiler.parse_word()
-  Word(name).end_label = Label()
+  end_label = Label()
+  word = Word(name)
+  word.end_label = end_label
+  word.body_start = compiler.source_position()
 
 def primitive_semicolon():
   ";"
-  compiler.add_instruction('LABEL', [compiler.current_object.end_label])
+  word = compiler.current_object
+  compiler.add_instruction('LABEL', [word.end_label])
   compiler.add_instruction('return', [no_fast])
+  word.source = compiler.definition_source(word)
   compiler.enter()
   compiler.state = 0
+  compiler.specialize(word)
 
 def primitive_recurse():
   assert(compiler.current_object.opcodes[0][0] == 'LABEL')
@@ -1261,8 +2217,17 @@ def primitive_c_store():
     # The store tries to write at a statically known address in RAM
     compiler.rewind()
     addr = params[0]
+    expression = compiler.last_expression()
     name, params = compiler.last_instruction()
-    if name == 'OP_PUSH':
+    if expression:
+      # Byte computation done in W or in place
+      start, tree, references = expression
+      compiler.current_object.opcodes = \
+        compiler.current_object.opcodes[:start]
+      compiler.current_object.references = references[:]
+      for instruction, params in byte_store_code(tree, addr):
+        compiler.add_instruction(instruction, params)
+    elif name == 'OP_PUSH':
       # Constant write
       compiler.rewind()
       const = params[0]
@@ -1287,16 +2252,32 @@ def primitive_c_store():
     compiler.eval('op_cstore')
 
 def primitive_allot():
+  compiler.extend_variable()
   compiler.allot(compiler.ct_pop().static_value())
 
 class Variable(Constant):
 
   section = 'memory'
 
+  # Whether link() may move the variable elsewhere in RAM, and the
+  # structure a create is part of
+  movable = False
+  enclosing = None
+
   def __init__(self, name, size, initial_value = None, zone = 'RAM'):
+    self.size = size
     if zone == 'RAM':
-      self.addr = compiler.here
-      compiler.allot(size)
+      key = (compiler.current_location(), name)
+      if compiler.placements and key in compiler.placements:
+        self.addr = compiler.placements[key]
+        if self.addr is None:
+          # Unused, do not even initialize it
+          self.addr = compiler.here
+          size = 0
+      else:
+        self.addr = compiler.here
+        compiler.allot(size)
+      compiler.place_variable(self)
     elif zone == 'EEPROM':
       self.addr = compiler.eehere
       compiler.eehere += size
@@ -1305,9 +2286,15 @@ class Variable(Constant):
     Constant.__init__(self, name, Number(self.addr, 16))
     if compiler.initialize_variables and size > 0 and \
            initial_value != 'NO_INIT':
-      compiler.push_init_runtime()
       if not initial_value:
         initial_value = Number(0)
+      if compiler.optimization in ['2', 's'] and \
+         initial_value.static_value() is not None:
+        # Done all at once by link()
+        compiler.initial_values.append((self, size,
+                                        initial_value.static_value()))
+        return
+      compiler.push_init_runtime()
       compiler.push(initial_value)
       compiler.push(self)
       if size == 1:
@@ -1359,7 +2346,8 @@ class Comma(Primitive):
   def run(self, size = 2):
     value = compiler.ct_pop()
     name = '_unnamed_%d' % self.next_count()
-    Variable(name, size, value)
+    compiler.extend_variable()
+    Variable(name, size, value).movable = False
 
 def primitive_c_comma():
   "c,"
@@ -1463,9 +2451,31 @@ def is_external_jump(opcode):
     return True
   return opcode[0] == 'goto' and isinstance(opcode[1][0], (Label, Word))
 
+def references_label(opcode, label):
+  """Check whether an opcode refers to label. A jump table refers to all
+  its entries."""
+  name, params = opcode
+  if name == 'OP_JUMP_TABLE':
+    return label in params
+  return params and params[0].makes_reference_to(label)
+
+def jump_table(opcodes, i):
+  """Return the indices of the bra instructions of the jump table the
+  computed jump at i goes through, or None if this is not the case."""
+  if i + 1 < len(opcodes) and opcodes[i+1][0] == 'LABEL' and \
+     isinstance(opcodes[i+1][1][0], JumpTable) and \
+     written_register(*opcodes[i]) == compiler['PCL'].static_value():
+    return list(range(i + 2, i + 2 + opcodes[i+1][1][0].size))
+  return None
+
 def is_jump(opcode):
   return opcode[0] in ['goto', 'bra', 'return', 'retfie', 'retlw']
 
+def ends_with_skip(opcodes):
+  """Check whether the last instruction of a list of opcodes is a skip."""
+  instructions = [o for o in opcodes if o[0] not in ['LABEL', 'COMMENT']]
+  return bool(instructions) and instructions[-1][0] in CycleAnalysis.skips
+
 def last_goto(x):
   """Check whether the last instruction of x is a real goto to somewhere
   else."""
@@ -1589,6 +2599,10 @@ class Word(Named, LiteralValue):
     self.prepared = None
     self.substitute = None
     self.nrefs = 0                  # Number of references to this word
+    self.saved_context = set()      # Registers restored by restore-context
+    self.banks_selected = False     # Whether expand_banks() ran
+    self.source = None              # Body text, see definition_source()
+    self.constant_calls = []        # Calls with a constant argument
 
   def __repr__(self):
     if self.substitute:
@@ -1616,7 +2630,10 @@ class Word(Named, LiteralValue):
     for n, p in self.opcodes[:-1]:
       if is_external_jump((n, p)):
         return False
-    return self.opcodes[-1] != ('return', [fast])
+    # The last opcode is dropped by inline_call(), which only knows how to
+    # get rid of a return
+    return self.opcodes[-1][0] == 'return' and \
+           self.opcodes[-1] != ('return', [fast])
 
   def should_inline(self):
     if self.inlined or not self.from_source or \
@@ -1639,9 +2656,329 @@ class Word(Named, LiteralValue):
     if self.prepared:
       return
     self.prepared = True
+    self.constant_calls = constant_calls(self.opcodes)
     self.expand()
     self.remove_markers()
     self.optimize()
+    self.expand_jump_tables()
+    self.expand_banks()
+    self.expand_context()
+    self.expand_long_branches()
+
+  def expand_long_branches(self):
+    """Replace the short conditional branches whose target ended up out of
+    their reach, which inlining large words may cause, by a bit-test
+    skipping over a bra, and jumps going further than bra can by a goto.
+    Jump table entries must keep their size."""
+    tests = {'bz': ('btfsc', 'Z'), 'bnz': ('btfss', 'Z'),
+             'bc': ('btfsc', 'C'), 'bnc': ('btfss', 'C'),
+             'bn': ('btfsc', 'N'), 'bnn': ('btfss', 'N'),
+             'bov': ('btfsc', 'OV'), 'bnov': ('btfss', 'OV')}
+    changed = True
+    while changed:
+      changed = False
+      addresses = []
+      labels = {}
+      address = 0
+      for name, params in self.opcodes:
+        addresses.append(address)
+        if name == 'LABEL':
+          labels[params[0]] = address
+        if is_internal_jump((name, params)) and len(params) == 1:
+          address += 2
+        else:
+          address += opcodes_size([(name, params)])[1]
+      new = []
+      table = False
+      for (name, params), address in zip(self.opcodes, addresses):
+        table = (table and name == 'bra') or \
+                (name == 'LABEL' and isinstance(params[0], JumpTable))
+        offset = name != 'LABEL' and params and params[0] in labels and \
+                 (labels[params[0]] - address - 2) // 2
+        if name in tests and not -128 <= offset <= 127:
+          test, bit = tests[name]
+          new.append((test, compiler[bit] + [access]))
+          new.append(('bra', [params[0]]))
+          changed = True
+        elif is_internal_jump((name, params)) and len(params) == 1 and \
+             not table and not -1024 <= offset <= 1023:
+          new.append(('goto', [params[0], far]))
+          changed = True
+        else:
+          new.append((name, params))
+      self.opcodes = new
+
+  def expand_jump_tables(self):
+    """Expand the jump tables once the optimizations, which do not know
+    about computed jumps, are done. The table holds bra instructions
+    indexed by W."""
+    opcodes = []
+    for name, params in self.opcodes:
+      if name != 'OP_JUMP_TABLE':
+        opcodes.append((name, params))
+        continue
+      table = JumpTable(len(params))
+      code = [('rlncf', [compiler['WREG'], dst_w, access]),
+              ('addlw', [Low(table)]),
+              ('movwf', [compiler['PREINC0'], access]),
+              ('movlw', [High(table)]),
+              ('btfsc', compiler['C'] + [access]),
+              ('addlw', [Number(1)]),
+              ('movwf', [compiler['PCLATH'], access]),
+              ('clrf', [compiler['PCLATU'], access]),
+              ('movf', [compiler['POSTDEC0'], dst_w, access]),
+              ('movwf', [compiler['PCL'], access]),
+              ('LABEL', [table])] + [('bra', [l]) for l in params]
+      for o in code:
+        for p in o[1]:
+          self.refers_to(p)
+      opcodes += code
+    self.opcodes = opcodes
+
+  def expand_banks(self):
+    """Insert movlb before the banked accesses to another bank than the one
+    BSR holds. BSR holds 1 when entering or leaving a word and around
+    calls; in between, it keeps the last bank selected as long as the
+    branches of the word agree on it, so that consecutive accesses to the
+    same bank share a single movlb. Done at -O2 and -Os only."""
+    if compiler.optimization not in ['2', 's']:
+      return
+    bsr = compiler['BSR'].static_value()
+    handler = self in [compiler.low_interrupt, compiler.high_interrupt]
+    # An interrupt handler may interrupt code running with another bank
+    # selected
+    entry = 1
+    if handler and \
+       (compiler.banks_switched or
+        (self == compiler.high_interrupt and compiler.low_interrupt and
+         not compiler.low_interrupt.banks_selected)):
+      entry = None
+    self.banks_selected = True
+    banks = [required_bank(n, p) for n, p in self.opcodes]
+    if entry == 1 and not [b for b in banks if b not in [None, 1]]:
+      return
+    self.split_banked_skips()
+    opcodes = self.opcodes
+    n = len(opcodes)
+    labels = {self: 0}
+    for i, (name, params) in enumerate(opcodes):
+      if name == 'LABEL':
+        labels[params[0]] = i
+
+    def next_instruction(i):
+      i += 1
+      while i < n and opcodes[i][0] in ['LABEL', 'COMMENT']:
+        i += 1
+      return i
+
+    # Bank needed before each opcode, and opcodes following it
+    needed, successors = [], []
+    for i, (name, params) in enumerate(opcodes):
+      need, succ = required_bank(name, params), [i + 1]
+      if name in CycleAnalysis.conditional_branches:
+        if params[0] in labels:
+          succ.append(labels[params[0]])
+        else:
+          need = 1
+      elif name in ['bra', 'goto']:
+        if params[0] in labels:
+          succ = [labels[params[0]]]
+        else:
+          need, succ = 1, []
+      elif name in ['call', 'rcall', 'return', 'retlw', 'reset']:
+        need = 1
+        if name not in ['call', 'rcall']:
+          succ = []
+      elif name == 'retfie':
+        need, succ = entry, []
+      elif jump_table(opcodes, i) is not None:
+        succ = jump_table(opcodes, i)
+      elif written_register(name, params) == compiler['PCL'].static_value():
+        need, succ = 1, []
+      elif name in CycleAnalysis.skips:
+        j = next_instruction(i)
+        if j < n:
+          need = need or required_bank(*opcodes[j])
+          succ.append(j + 1)
+      needed.append(need)
+      successors.append(succ)
+    # Falling through the next word
+    needed.append(1)
+    successors.append([])
+
+    # Bank held by BSR before each opcode: missing if not reached yet,
+    # None if unknown
+    held = {0: entry}
+    work = [0]
+    while work:
+      i = work.pop()
+      if i == n:
+        continue
+      name, params = opcodes[i]
+      bank = held[i]
+      if needed[i] is not None:
+        bank = needed[i]
+      if name in ['call', 'rcall']:
+        bank = 1
+      elif name == 'movlb':
+        bank = params[0].static_value()
+      elif written_register(name, params) == bsr:
+        bank = None
+      for j in successors[i]:
+        if j not in held:
+          held[j] = bank
+        elif held[j] is not None and held[j] != bank:
+          held[j] = None
+        else:
+          continue
+        work.append(j)
+
+    result = []
+    switched = False
+    for i, o in enumerate(opcodes + [None]):
+      if i in held and needed[i] is not None and held[i] != needed[i]:
+        if result and result[-1][0] == 'movlb':
+          result.pop()
+        result.append(('movlb', [Number(needed[i])]))
+        switched = True
+        if needed[i] != 1:
+          compiler.banks_switched = True
+      if o:
+        result.append(o)
+    if switched and entry is None and 'OP_SAVE_CONTEXT' not in \
+       [o[0] for o in opcodes]:
+      # Give the interrupted code its bank back
+      compiler.push_object(self)
+      slot = Variable('%s-bsr' % (self == compiler.high_interrupt and 'high'
+                                  or 'low'), 1, 'NO_INIT')
+      compiler.pop_object()
+      self.refers_to(slot)
+      opcodes, result = result, [('movff', [compiler['BSR'], slot])]
+      for o in opcodes:
+        if o[0] == 'retfie':
+          result.append(('movff', [slot, compiler['BSR']]))
+        result.append(o)
+    self.opcodes = result
+
+  def split_banked_skips(self):
+    """Make sure that no movlb will have to be inserted between a skip
+    instruction and the instruction it skips: when both depend on different
+    banks, or labels lie in between, the skip jumps over a branch to the
+    skipped instruction instead."""
+    opcodes = self.opcodes
+    result = []
+    i = 0
+    while i < len(opcodes):
+      name, params = opcodes[i]
+      result.append(opcodes[i])
+      i += 1
+      if name not in CycleAnalysis.skips:
+        continue
+      j = i
+      while j < len(opcodes) and opcodes[j][0] in ['LABEL', 'COMMENT']:
+        j += 1
+      if j == len(opcodes):
+        continue
+      own, skipped = required_bank(name, params), required_bank(*opcodes[j])
+      if skipped is None or \
+         ((own is None or own == skipped) and
+          not [o for o in opcodes[i:j] if o[0] == 'LABEL']):
+        continue
+      target, after = Label(), Label()
+      result += [('bra', [target]), ('bra', [after])] + opcodes[i:j] + \
+                [('LABEL', [target]), opcodes[j], ('LABEL', [after])]
+      i = j + 1
+    self.opcodes = result
+
+  def expand_protection(self):
+    """Expand intr-protect and intr-unprotect left aside until the
+    interrupt handlers were known."""
+    opcodes = []
+    for o in self.opcodes:
+      if o[0] in ['OP_INTR_PROTECT', 'OP_INTR_UNPROTECT']:
+        opcodes += self.expand_opcode(o, None)
+      else:
+        opcodes.append(o)
+    self.opcodes = opcodes
+
+  context_registers = ['WREG', 'STATUS', 'BSR', 'FSR0L', 'FSR0H', 'FSR1L',
+                       'FSR1H', 'FSR2L', 'FSR2H', 'PRODL', 'PRODH',
+                       'TBLPTRL', 'TBLPTRH', 'TBLPTRU', 'TABLAT', 'PCLATH',
+                       'PCLATU']
+
+  def expand_context(self):
+    """Replace save-context and restore-context by the code saving and
+    restoring what the interrupt handler and the words it calls may
+    change. This runs after the optimizations, so that the code being
+    looked at is the final one."""
+    names = [o[0] for o in self.opcodes]
+    if 'OP_SAVE_CONTEXT' not in names and 'OP_RESTORE_CONTEXT' not in names:
+      return
+    if self == compiler.high_interrupt:
+      kind, other = 'high', compiler.low_interrupt
+    elif self == compiler.low_interrupt:
+      kind, other = 'low', compiler.high_interrupt
+    else:
+      raise Compiler.FATAL_ERROR("%s: save-context and restore-context "
+                                 "must be used in an interrupt handler" %
+                                 self.definition)
+    clobbered = clobbered_by(reachable_words([self]))
+    if clobbered is None:
+      # Computed jumps or unknown code: save what save-everything-high
+      # and save-everything-low do
+      regs = ['WREG', 'STATUS', 'FSR0L', 'FSR0H', 'FSR1L', 'FSR1H',
+              'FSR2L', 'FSR2H']
+      if compiler.banks_switched:
+        # The interrupted code may have another bank selected, which
+        # expand_banks() left to this context to give back
+        regs.insert(2, 'BSR')
+      temps = []
+    else:
+      regs = [n for n in Word.context_registers
+              if compiler[n].static_value() in clobbered]
+      # Core temporaries also used by the code which can be interrupted.
+      # temp_gie only matters while interrupts are disabled.
+      accessed = set()
+      for w in reachable_words([x for x in [compiler.find_main(), other]
+                                if x]):
+        for name, params in w.opcodes:
+          accessed.update(accessed_registers(name, params))
+      temps = [clobbered[a] for a in sorted(clobbered.keys())
+               if a < compiler.free_access and a in accessed and
+               a != compiler['temp_gie'].static_value()]
+    if kind == 'high' and 'OP_RESTORE_CONTEXT' in names:
+      # The shadow registers hold W, STATUS and BSR
+      regs = [n for n in regs if n not in ['WREG', 'STATUS', 'BSR']]
+      self.opcodes = [(o == ('retfie', [no_fast]) and ('retfie', [fast]))
+                      or o for o in self.opcodes]
+    saved = [compiler[n] for n in regs] + temps
+    slots = []
+    if saved:
+      compiler.push_object(self)
+      area = Variable('%s-context' % kind, len(saved), 'NO_INIT')
+      compiler.pop_object()
+      slots = [area] + [Add(area, Number(i)) for i in range(1, len(saved))]
+    save = [('movff', [r, s]) for r, s in zip(saved, slots)]
+    for fsr, stack in [(0, 'secstack'), (2, 'secrstack')]:
+      if 'FSR%dL' % fsr in regs:
+        save.append(('lfsr', [Number(fsr),
+                              compiler['%s-%s' % (stack, kind)]]))
+    restore = [('movff', [s, r]) for r, s in zip(saved, slots)]
+    if 'OP_RESTORE_CONTEXT' in names:
+      self.saved_context = set([r.static_value() for r in saved])
+    restore.reverse()
+    opcodes = []
+    for o in self.opcodes:
+      if o[0] == 'OP_SAVE_CONTEXT':
+        opcodes += save
+      elif o[0] == 'OP_RESTORE_CONTEXT':
+        opcodes += restore
+      else:
+        opcodes.append(o)
+    self.opcodes = opcodes
+    for name, params in save:
+      for p in params:
+        self.refers_to(p)
 
   def dump(self, msg = ''):
     if msg:
@@ -1654,22 +2991,27 @@ class Word(Named, LiteralValue):
     self.opcodes = [o for o in self.opcodes if o[0][:7] != 'MARKER_']
 
   def optimize(self):
-    """Apply optimizations at the opcode level."""
+    """Apply optimizations at the opcode level until nothing changes. This
+    is skipped altogether at -O0."""
+    if compiler.optimization == '0':
+      return
     while True:
       old_opcodes = self.opcodes[:]
-      self.optimize_tail_calls()
-      self.optimize_chained_calls()
-      self.optimize_retlw()
-      self.optimize_dead_labels()
-      self.optimize_dead_code()
-      self.optimize_small_gotos()
-      self.optimize_short_conditions()
-      self.optimize_useless_gotos()
-      self.optimize_duplicate_labels()
-      self.optimize_single_goto()
+      for p in Word.passes:
+        before = self.opcodes[:]
+        getattr(self, p)()
+        if compiler.stats is not None and self.opcodes != before:
+          compiler.record(p, self, before, self.opcodes)
       if self.opcodes == old_opcodes:
         break
 
+  passes = ['optimize_tail_calls', 'optimize_chained_calls',
+            'optimize_retlw', 'optimize_dead_labels', 'optimize_dead_code',
+            'optimize_small_gotos', 'optimize_short_conditions',
+            'optimize_useless_gotos', 'optimize_duplicate_labels',
+            'optimize_single_goto', 'optimize_cached_stack',
+            'optimize_forwarding', 'optimize_wreg', 'optimize_flags']
+
   def optimize_tail_calls(self):
     new = []
     o = 0
@@ -1728,7 +3070,7 @@ class Word(Named, LiteralValue):
         label = o[1][0]
         used = False
         for i in self.opcodes:
-          if i != o and i[1] and i[1][0].makes_reference_to(label):
+          if i != o and references_label(i, label):
             used = True
             break
         if used:
@@ -1748,7 +3090,7 @@ class Word(Named, LiteralValue):
           # a forward reference.
           label = self.opcodes[o][1][0]
           for no in new:
-            if no[1] and no[1][0].makes_reference_to(label):
+            if references_label(no, label):
               dead = False
               break
           else:
@@ -1759,7 +3101,7 @@ class Word(Named, LiteralValue):
             for oo in self.opcodes[o+1:]:
               if oo[0] == 'LABEL':
                 hit_label = True
-              elif hit_label and oo[1] and oo[1][0].makes_reference_to(label):
+              elif hit_label and references_label(oo, label):
                 dead = False
                 exit
         if not dead:
@@ -1772,7 +3114,8 @@ class Word(Named, LiteralValue):
         o += 1
         new.append(self.opcodes[o])
       elif not dead and self.opcodes[o][0] in ['goto', 'bra', 'retlw',
-                                               'return', 'retfie', 'reset']:
+                                               'return', 'retfie', 'reset',
+                                               'OP_JUMP_TABLE']:
         new.append(self.opcodes[o])
         dead = True
       elif not dead and self.opcodes[o][0] == 'movwf' and \
@@ -1823,7 +3166,8 @@ class Word(Named, LiteralValue):
 
   def optimize_short_conditions(self):
     """Use short conditions bc, bnc, bz and bnz if a bit-test is followed
-    by a local jump and one of the Z or C bit is tested. Also, if such
+    by a local jump and one of the Z or C bit is tested, and bn and bnn for
+    the N bit at -O2 and -Os. Also, if such
     a test jumps over a single external goto, rewrite it using an explicit
     bit-test."""
     new = []
@@ -1831,6 +3175,9 @@ class Word(Named, LiteralValue):
                         make_tuple('btfsc', compiler['Z'] + [access]): 'bz',
                         make_tuple('btfss', compiler['C'] + [access]): 'bnc',
                         make_tuple('btfsc', compiler['C'] + [access]): 'bc'}
+    if compiler.optimization in ['2', 's']:
+      short_conditions[make_tuple('btfss', compiler['N'] + [access])] = 'bnn'
+      short_conditions[make_tuple('btfsc', compiler['N'] + [access])] = 'bn'
     o = 0
     while o < len(self.opcodes):
       t = make_tuple(self.opcodes[o][0], self.opcodes[o][1])
@@ -1898,6 +3245,10 @@ class Word(Named, LiteralValue):
       elif self.opcodes[i][0] == 'call' and \
           self.opcodes[i][1][0] == source:
         self.opcodes[i] = ('call', [target] + self.opcodes[i][1][1:])
+      elif self.opcodes[i][0] == 'OP_JUMP_TABLE':
+        self.opcodes[i] = ('OP_JUMP_TABLE',
+                           [(l == source and target) or l
+                            for l in self.opcodes[i][1]])
 
   def optimize_duplicate_labels(self):
     """If two labels follow each other, use the first one in place of
@@ -1912,6 +3263,9 @@ class Word(Named, LiteralValue):
          self.opcodes[o+1][0] == 'LABEL':
         source = self.opcodes[o+1][1][0]
         target = self.opcodes[o][1][0]
+        if target.loop_bound is None:
+          target.loop_bound = source.loop_bound
+          target.loop_exact = source.loop_exact
         self.replace_label(source, target)
 
   def optimize_single_goto(self):
@@ -1925,6 +3279,593 @@ class Word(Named, LiteralValue):
                           ['replaced by equivalent %s' %
                            self.substitute])
 
+  def straight_sequences(self):
+    """Return the (start, end) bounds of the straight sequences of
+    instructions, which are only entered at their start and left at their
+    end."""
+    opcodes = self.opcodes
+    sequences = []
+    start = 0
+    while start < len(opcodes):
+      end = start
+      while end < len(opcodes) and \
+            (end == start or opcodes[end][0] != 'LABEL'):
+        name, params = opcodes[end]
+        end += 1
+        if name in CycleAnalysis.conditional_branches or name in \
+           ['bra', 'goto', 'call', 'rcall', 'return', 'retlw', 'retfie',
+            'reset'] or \
+           written_register(name, params) == compiler['PCL'].static_value():
+          break
+      sequences.append((start, end))
+      start = end
+    return sequences
+
+  def optimize_cached_stack(self):
+    """Within a straight sequence of instructions, keep a byte which is
+    pushed then popped in W, in the register it comes from or as a literal
+    instead of going through the data stack. Done at -O2 and -Os only."""
+    if compiler.optimization not in ['2', 's']:
+      return
+    stack = dict([(n, compiler[n].static_value()) for n in
+                  ['PREINC0', 'POSTDEC0', 'POSTINC0', 'INDF0', 'PLUSW0',
+                   'FSR0L', 'FSR0H']])
+    indirect = indirect_registers()
+    wreg = compiler['WREG']
+    opcodes = self.opcodes
+    replaced = {}
+
+    def is_push(name, params):
+      return (name in ['movwf', 'clrf', 'setf'] and
+              params[0].static_value() == stack['PREINC0']) or \
+             (name == 'movff' and
+              params[1].static_value() == stack['PREINC0'] and
+              params[0].static_value() not in stack.values())
+
+    def is_pop(name, params):
+      if name == 'movff':
+        return params[0].static_value() == stack['POSTDEC0'] and \
+               params[1].static_value() not in stack.values()
+      if not accessed_registers(name, params) == [stack['POSTDEC0']]:
+        return False
+      kind = pic18.instructions[name][0]
+      return (kind == 'fda' and (name == 'movf' or
+                                 params[1].static_value() == 0)) or \
+             name in ['cpfseq', 'cpfsgt', 'cpfslt', 'tstfsz', 'mulwf',
+                      'btfsc', 'btfss']
+
+    def operand(name, params, r):
+      """Return the parameters of an instruction using register r instead
+      of its first one."""
+      if pic18.instructions[name][0] == 'fa':
+        return [r, access_bit(r)]
+      return [r, params[1], access_bit(r)]
+
+    def pop(i, name, params, cell):
+      """Return the instructions replacing the pop at i, or None if the
+      cell cannot be used there."""
+      reading = name == 'movf' and params[1].static_value() == 0
+      dropping = name == 'movf' and not reading
+      if name == 'movff':
+        dst = params[1]
+        if cell['w'] and short_addr(dst):
+          return [('movwf', [dst, access_bit(dst)])]
+        if cell['w']:
+          return [('movff', [wreg, dst])]
+        if cell['f']:
+          return [('movff', [cell['f'], dst])]
+        return None
+      if (reading or dropping) and flags_dead(opcodes, i) and \
+         (cell['w'] or cell['f'] or cell['k'] is not None):
+        if cell['w'] or dropping:
+          return []
+        if cell['f'] and short_addr(cell['f']):
+          return [('movf', operand(name, params, cell['f']))]
+        if cell['f']:
+          return [('movff', [cell['f'], wreg])]
+        return [('movlw', [cell['k']])]
+      if cell['w']:
+        return [(name, operand(name, params, wreg))]
+      if cell['f'] and short_addr(cell['f']):
+        return [(name, operand(name, params, cell['f']))]
+      literal = {'addwf': 'addlw', 'andwf': 'andlw', 'iorwf': 'iorlw',
+                 'subwf': 'sublw', 'xorwf': 'xorlw'}
+      if cell['k'] is not None and name in literal and \
+         params[1].static_value() == 0:
+        return [(literal[name], [cell['k']])]
+      return None
+
+    for start, end in self.straight_sequences():
+      # Follow the stack pointer along the sequence. A byte pushed within
+      # it is a candidate if the only access to it is a single pop.
+      cells = []
+      candidates = []
+      memory = {}
+      sp = 0
+      w = None
+      skipping = False
+      for i in range(start, end):
+        name, params = opcodes[i]
+        if name == 'COMMENT':
+          continue
+        conditional, skipping = skipping, name in CycleAnalysis.skips
+        accesses = [r for r in accessed_registers(name, params) if r in stack.values()]
+        if accesses and (conditional or
+                         [r for r in accesses if r in
+                          [stack['PLUSW0'], stack['FSR0L'], stack['FSR0H']]]):
+          # The stack pointer cannot be followed further
+          for cell in cells:
+            cell['pinned'] = True
+          break
+        if is_push(name, params):
+          cell = {'push': i, 'w': False, 'k': None, 'f': None,
+                  'popped': False, 'pinned': False, 'sp': sp + 1}
+          if name == 'movwf':
+            cell['w'], cell['k'] = True, w
+          elif name == 'clrf' and flags_dead(opcodes, i):
+            cell['k'] = Number(0)
+          elif name == 'setf':
+            cell['k'] = Number(0xff)
+          elif name == 'movff' and ram_addr(params[0]) and \
+               params[0].static_value() < 0xf60:
+            cell['f'] = params[0]
+          sp += 1
+          memory[sp] = cell
+          cells.append(cell)
+          continue
+        if is_pop(name, params):
+          cell = memory.get(sp)
+          sp -= 1
+          if cell and cell['popped']:
+            cell['pinned'] = True
+          elif cell:
+            cell['popped'] = True
+            candidates.append((i, dict(cell), cell))
+        else:
+          # Any other access keeps the bytes it reaches in memory. When it
+          # reads back above bytes already popped, their push and pop must
+          # stay as well or the bytes above them would move down.
+          for r in accesses:
+            if r == stack['PREINC0']:
+              sp += 1
+            if memory.get(sp):
+              memory[sp]['pinned'] = True
+            for cell in cells:
+              if cell['popped'] and cell['sp'] < sp:
+                cell['pinned'] = True
+            if r == stack['POSTINC0']:
+              sp += 1
+            elif r == stack['POSTDEC0']:
+              sp -= 1
+        if name == 'movlw' and not conditional:
+          w = params[0]
+        elif writes_w(name, params):
+          w = None
+        for cell in cells:
+          if cell['popped']:
+            continue
+          if writes_w(name, params):
+            cell['w'] = False
+          if cell['f'] and written_register(name, params) in \
+             [cell['f'].static_value()] + indirect:
+            cell['f'] = None
+      for i, cell, final in candidates:
+        if final['pinned']:
+          continue
+        replacement = pop(i, opcodes[i][0], opcodes[i][1], cell)
+        if replacement is not None:
+          replaced[cell['push']] = []
+          replaced[i] = replacement
+    if replaced:
+      new = []
+      for i, o in enumerate(opcodes):
+        for n, p in replaced.get(i, [o]):
+          new.append((n, p))
+          for x in p:
+            self.refers_to(x)
+      self.opcodes = new
+
+  def optimize_forwarding(self):
+    """Within a straight sequence of instructions, follow the values held
+    by W, RAM and data stack bytes, and remove loads and stores which do
+    not change anything as well as pushes of a byte just popped. SFRs
+    other than WREG are never assumed to keep their value. Done at -O2 and
+    -Os only."""
+    if compiler.optimization not in ['2', 's']:
+      return
+    stack = dict([(n, compiler[n].static_value()) for n in
+                  ['PREINC0', 'POSTDEC0', 'POSTINC0', 'INDF0', 'PLUSW0',
+                   'FSR0L', 'FSR0H']])
+    pointer = [stack['PREINC0'], stack['POSTDEC0'], stack['POSTINC0'],
+               stack['INDF0']]
+    indirect = indirect_registers()
+    wreg = compiler['WREG'].static_value()
+    bsr = compiler['BSR'].static_value()
+    opcodes = self.opcodes[:]
+    fresh = [0]
+    values = {}
+
+    def value(l):
+      """Return the value held at location l, a new one if unknown."""
+      if l is None:
+        fresh[0] += 1
+        return ('value', fresh[0])
+      if l not in values:
+        values[l] = value(None)
+      return values[l]
+
+    def forget_stack():
+      for l in list(values.keys()):
+        if l != 'w' and not isinstance(l, int):
+          del values[l]
+
+    def location(r, sp):
+      """Return what is known as the content of register r, or None."""
+      if r in pointer:
+        return ('stack', sp)
+      if r == wreg:
+        return 'w'
+      if r is not None and (r < 0x60 or 0x100 <= r < 0xf60):
+        return r
+      return None
+
+    def with_register(name, params, old, new):
+      self.refers_to(compiler[new])
+      return (name, [p.static_value() == stack[old] and compiler[new] or p
+                     for p in params])
+
+    for start, end in self.straight_sequences():
+      values.clear()
+      sp = 0
+      last = None
+      skipping = False
+      for i in range(start, end):
+        name, params = opcodes[i]
+        if name == 'COMMENT':
+          continue
+        conditional, skipping = skipping, name in CycleAnalysis.skips
+        registers = accessed_registers(name, params)
+        if name == 'movlb' or bsr in registers:
+          break
+        accesses = [r for r in registers if r in stack.values()]
+        if [r for r in accesses if r not in pointer] or \
+           (conditional and accesses):
+          # The stack pointer cannot be followed further
+          forget_stack()
+          last = None
+          continue
+        # Locations read and written by the instruction
+        locations = []
+        for r in registers:
+          if r == stack['PREINC0']:
+            sp += 1
+          locations.append(location(r, sp))
+          if r == stack['POSTDEC0']:
+            sp -= 1
+          elif r == stack['POSTINC0']:
+            sp += 1
+        previous = last
+        if accesses:
+          last = i
+        kind = name in pic18.instructions and pic18.instructions[name][0]
+        dst, target = None, None
+        if name == 'movff':
+          v, dst = value(locations[0]), locations[1]
+          target = params[1]
+        elif name in ['movwf', 'clrf', 'setf']:
+          v = {'movwf': value('w'), 'clrf': 0, 'setf': 0xff}[name]
+          dst, target = locations[0], params[0]
+        elif name == 'movlw':
+          v, dst, target = literal_byte(params[0]), 'w', None
+        elif name == 'movf' and params[1].static_value() == 0:
+          v, dst, target = value(locations[0]), 'w', None
+        elif name == 'movf':
+          v = value(locations[0])
+          dst, target = locations[0], params[0]
+        else:
+          v = None
+          if name in CycleAnalysis.skips:
+            pass
+          elif kind in ['fa', 'fba'] or \
+               (kind == 'fda' and params[1].static_value() != 0):
+            dst, target = locations[0], params[0]
+          elif writes_w(name, params):
+            dst, target = 'w', None
+        if dst is None and target is not None:
+          # Unknown or special register: indirect accesses may alias
+          # anything, a direct access to the stacks loses them
+          r = target.static_value()
+          if r is None or r in indirect:
+            values.clear()
+            last = None
+          elif 0x60 <= r < 0x100:
+            forget_stack()
+          continue
+        if name == 'lfsr' and params[0].static_value() == 0:
+          forget_stack()
+          last = None
+        if dst is None:
+          continue
+        old = values.get(dst)
+        if v is None or conditional:
+          values[dst] = value(None)
+        else:
+          values[dst] = v
+        if conditional or v is None or old != v or \
+           (name in ['clrf', 'movf'] and not flags_dead(opcodes, i)):
+          continue
+        if not accesses:
+          # Nothing changes
+          opcodes[i] = None
+        elif accesses == [stack['PREINC0']] and previous is not None:
+          # Push of a byte just popped: have the previous access to the
+          # stack leave the pointer where the push would
+          n, p = opcodes[previous]
+          used = [r for r in accessed_registers(n, p) if r in stack.values()]
+          if used == [stack['POSTDEC0']]:
+            opcodes[previous] = with_register(n, p, 'POSTDEC0', 'INDF0')
+          elif used == [stack['INDF0']]:
+            opcodes[previous] = with_register(n, p, 'INDF0', 'POSTINC0')
+          else:
+            continue
+          opcodes[i] = None
+          last = previous
+    self.opcodes = [o for o in opcodes if o is not None]
+
+  # State of a dataflow analysis at an instruction which cannot be reached
+  unreached = 'unreached'
+
+  def flow(self, unknown, transfer, join):
+    """Run a forward dataflow analysis over the word and return the state
+    before each opcode, or None if the word writes PCL. transfer(state,
+    name, params) gives the state after an instruction, join(a, b) the
+    state where paths meet. Labels which may be entered from elsewhere
+    than local branches start with the unknown state."""
+    opcodes = self.opcodes
+    pcl = compiler['PCL'].static_value()
+    if [o for o in opcodes if written_register(o[0], o[1]) == pcl]:
+      return None
+    top = Word.unreached
+    branches = CycleAnalysis.conditional_branches + ['bra', 'goto']
+    ends = ['bra', 'goto', 'return', 'retlw', 'retfie', 'reset']
+    labels = [o[1][0] for o in opcodes if o[0] == 'LABEL']
+    entries = [l for l in labels if l.from_source or l == labels[0]]
+    for name, params in opcodes:
+      if name not in branches and name != 'LABEL':
+        entries += [p for p in params if p in labels]
+    # Compute the states until nothing changes
+    incoming = {}
+    while True:
+      before = []
+      changed = False
+      state = unknown
+      skipping = False
+      for name, params in opcodes:
+        if name == 'LABEL':
+          if params[0] in entries:
+            state = unknown
+          else:
+            state = join(state, incoming.get(params[0], top))
+        before.append(state)
+        if name == 'COMMENT' or name == 'LABEL':
+          continue
+        conditional, skipping = skipping, name in CycleAnalysis.skips
+        after = state
+        if state != top:
+          after = transfer(state, name, params)
+          if conditional:
+            after = join(state, after)
+        if name in branches and params[0] in labels:
+          new = join(incoming.get(params[0], top), after)
+          if new != incoming.get(params[0], top):
+            incoming[params[0]] = new
+            changed = True
+        if name in ends and not conditional:
+          state = top
+        else:
+          state = after
+      if not changed:
+        return before
+
+  def optimize_wreg(self):
+    """Follow what W holds, a literal or the content of a RAM byte, across
+    the whole word. Remove loads of W which are already satisfied and
+    stores of W into a byte which already holds it, copy a byte W holds
+    from W, store known 0 and 0xff with clrf and setf, and remove literal
+    loads whose value is never used. Done at -O2 and -Os only."""
+    if compiler.optimization not in ['2', 's']:
+      return
+    opcodes = self.opcodes
+    wreg = compiler['WREG'].static_value()
+    indirect = indirect_registers()
+    top = Word.unreached
+    # State: the literal W holds if known and the bytes it equals
+    unknown = (None, frozenset())
+
+    def join(a, b):
+      if a == top:
+        return b
+      if b == top:
+        return a
+      if a[0] != b[0]:
+        return (None, a[1] & b[1])
+      return (a[0], a[1] & b[1])
+
+    def transfer(state, name, params):
+      k, same = state
+      if name == 'movlw':
+        return (literal_byte(params[0]), frozenset())
+      if (name == 'movf' and params[1].static_value() == 0) or \
+         (name == 'movff' and params[1].static_value() == wreg):
+        if params[0].static_value() in same:
+          return state
+        if tracked_byte(params[0]):
+          return (None, frozenset([params[0].static_value()]))
+        return unknown
+      if name in ['call', 'rcall'] or writes_w(name, params):
+        return unknown
+      written = written_operand(name, params)
+      if written is None:
+        return state
+      if written.static_value() is None or \
+         written.static_value() in indirect:
+        return (k, frozenset())
+      if tracked_byte(written) and \
+         (name == 'movwf' or
+          (name == 'movff' and (params[0].static_value() in same or
+                                params[0].static_value() == wreg))):
+        return (k, same | frozenset([written.static_value()]))
+      return (k, same - frozenset([written.static_value()]))
+
+    before = self.flow(unknown, transfer, join)
+    if before is None:
+      return
+    # Rewrite instructions whose effect on W is known
+    new = opcodes[:]
+    skipping = False
+    for i, (name, params) in enumerate(opcodes):
+      if name in ['COMMENT', 'LABEL']:
+        continue
+      conditional, skipping = skipping, name in CycleAnalysis.skips
+      if conditional or before[i] == top:
+        continue
+      k, same = before[i]
+      if name == 'movlw' and k is not None and k == literal_byte(params[0]):
+        new[i] = None
+      elif name == 'movf' and params[1].static_value() == 0 and \
+           params[0].static_value() in same and flags_dead(opcodes, i):
+        new[i] = None
+      elif name == 'movff' and params[0].static_value() in same:
+        if params[1].static_value() in same | frozenset([wreg]):
+          new[i] = None
+        elif short_addr(params[1]):
+          new[i] = ('movwf', [params[1], access_bit(params[1])])
+      elif name == 'movwf' and params[0].static_value() in same:
+        new[i] = None
+      elif name == 'movwf' and k == 0xff:
+        new[i] = ('setf', params)
+      elif name == 'movwf' and k == 0 and flags_dead(opcodes, i):
+        new[i] = ('clrf', params)
+    # Remove literal loads which are overwritten before being used
+    skipping = False
+    for i, o in enumerate(new):
+      if o is None or o[0] in ['COMMENT', 'LABEL']:
+        continue
+      conditional, skipping = skipping, o[0] in CycleAnalysis.skips
+      if o[0] == 'movlw' and not conditional and w_dead(new, i):
+        new[i] = None
+    self.opcodes = [o for o in new if o is not None]
+
+  # Instructions setting both the Z and N flags from their result
+  flag_setters = ['addwf', 'addwfc', 'andwf', 'comf', 'decf', 'incf',
+                  'iorwf', 'movf', 'negf', 'rlcf', 'rlncf', 'rrcf', 'rrncf',
+                  'subfwb', 'subwf', 'subwfb', 'xorwf', 'addlw', 'andlw',
+                  'iorlw', 'sublw', 'xorlw']
+
+  def optimize_flags(self):
+    """Follow which values the Z and N flags describe, W or RAM bytes,
+    across the whole word. Remove tests of a value the flags already
+    describe, and turn bit tests of such a value into tests of Z or N so
+    that they become short conditional branches. Done at -O2 and -Os
+    only."""
+    if compiler.optimization not in ['2', 's']:
+      return
+    opcodes = self.opcodes
+    wreg = compiler['WREG'].static_value()
+    status = compiler['STATUS'].static_value()
+    indirect = indirect_registers()
+    top = Word.unreached
+    nothing = frozenset()
+
+    def subject(r):
+      """Return how the flags refer to register r, or None."""
+      if r.static_value() == wreg:
+        return 'w'
+      if tracked_byte(r):
+        return r.static_value()
+      return None
+
+    def transfer(state, name, params):
+      if name in Word.flag_setters:
+        if name in ['addlw', 'andlw', 'iorlw', 'sublw', 'xorlw'] or \
+           params[1].static_value() == 0:
+          if name == 'movf' and subject(params[0]) is not None:
+            return frozenset(['w', subject(params[0])])
+          return frozenset(['w'])
+        return frozenset([subject(params[0])]) - frozenset([None])
+      if name in ['call', 'rcall', 'clrf'] and not \
+         (name == 'clrf' and params[0].static_value() == wreg):
+        return nothing
+      written = written_operand(name, params)
+      if written is not None:
+        r = written.static_value()
+        if r is None or r in indirect or r == status:
+          return nothing
+        if subject(written) is not None and \
+           ((name == 'movwf' and 'w' in state) or
+            (name == 'movff' and subject(params[0]) in state)):
+          return state | frozenset([subject(written)])
+        state = state - frozenset([subject(written)])
+      if writes_w(name, params) and written is None:
+        state = state - frozenset(['w'])
+      return state
+
+    def join(a, b):
+      if a == top:
+        return b
+      if b == top:
+        return a
+      return a & b
+
+    before = self.flow(nothing, transfer, join)
+    if before is None:
+      return
+    new = opcodes[:]
+    skipping = False
+    for i, (name, params) in enumerate(opcodes):
+      if name in ['COMMENT', 'LABEL']:
+        continue
+      conditional, skipping = skipping, name in CycleAnalysis.skips
+      if conditional or before[i] == top:
+        continue
+      state = before[i]
+      following = [o for o in opcodes[i+1:] if o[0] != 'COMMENT'][:1]
+      if (name == 'iorlw' or name == 'xorlw') and \
+         params[0].static_value() == 0 and 'w' in state:
+        new[i] = None
+      elif name == 'andlw' and params[0].static_value() & 0xff == 0xff and \
+           'w' in state:
+        new[i] = None
+      elif name == 'movf' and subject(params[0]) in state and \
+           (params[1].static_value() != 0 or
+            params[0].static_value() == wreg or
+            w_dead(opcodes, i, self.outw)):
+        new[i] = None
+      elif name in ['btfsc', 'btfss'] and subject(params[0]) in state and \
+           params[1].static_value() == 7 and following and \
+           is_internal_jump(following[0]):
+        new[i] = (name, compiler['N'] + [access])
+      elif name == 'tstfsz' and subject(params[0]) in state and \
+           following and is_internal_jump(following[0]):
+        new[i] = ('btfss', compiler['Z'] + [access])
+      elif name == 'movlw' and params[0].static_value() == 0 and \
+           following and following[0][0] in ['iorwf', 'xorwf'] and \
+           following[0][1][1].static_value() == 0:
+        # W | f and W ^ f are f when W is 0
+        new[i] = None
+        j = opcodes.index(following[0], i + 1)
+        new[j] = ('movf', following[0][1])
+      elif name == 'movwf' and 'w' in state and \
+           params[0].static_value() == compiler['PREINC0'].static_value() \
+           and following and following[0][0] == 'movf' and \
+           following[0][1][0].static_value() == \
+           compiler['POSTDEC0'].static_value() and \
+           following[0][1][1].static_value() == 0:
+        # Pushing W then popping it back does not change W or the flags
+        new[i] = None
+        new[opcodes.index(following[0], i + 1)] = None
+    self.opcodes = [o for o in new if o is not None]
+
   def output(self, outfd):
     outfd.write('%s\n' % self.unsubstituted())
     for o in self.opcodes:
@@ -2006,15 +3947,22 @@ class Word(Named, LiteralValue):
       append('movwf', compiler['PREINC0'], access)
     elif name == 'OP_DUP':
       append('call', compiler['op_dup'], no_fast)
+    elif name == 'OP_SHIFT':
+      for instruction, ps in shift_code(params[0].static_value(), params[1]):
+        append(instruction, *ps)
+    elif name in ['OP_INTR_PROTECT', 'OP_INTR_UNPROTECT'] and \
+         compiler.use_interrupts and compiler.protect_temporaries is None:
+      # Decided once the interrupt handlers have been prepared
+      return [o]
     elif name == 'OP_INTR_PROTECT':
-      if compiler.use_interrupts:
+      if compiler.use_interrupts and compiler.protect_temporaries:
         append('btfsc', compiler['INTCON'], Number(7), access)
         append('bsf', compiler['temp_gie'], Number(0), access)
         append('bcf', compiler['INTCON'], Number(7), access)
       else:
         append('EMPTY')
     elif name == 'OP_INTR_UNPROTECT':
-      if compiler.use_interrupts:
+      if compiler.use_interrupts and compiler.protect_temporaries:
         append('btfsc', compiler['temp_gie'], Number(0), access)
         append('bsf', compiler['INTCON'], Number(7), access)
         append('bcf', compiler['temp_gie'], Number(0), access)
@@ -2030,6 +3978,15 @@ class Word(Named, LiteralValue):
     else:
       return [o]
 
+  def expanded(self, opcodes):
+    """Return the expansion of opcodes without recording any reference."""
+    references = self.references[:]
+    l = []
+    for o in opcodes:
+      l += self.expand_opcode(o, l and l[-1] or None)
+    self.references = references
+    return l
+
   def expand(self):
     new_opcodes = []
     prev = None
@@ -2039,12 +3996,21 @@ class Word(Named, LiteralValue):
         prev = new_opcodes[-1]
     self.opcodes = new_opcodes
 
+  def assemble_opcode(self, asm, o):
+    name, params = o
+    if is_internal_jump(o):
+      name, params = len(params) == 1 and 'bra' or 'goto', params[:1]
+    if name == 'LABEL':
+      asm.label(repr(params[0]))
+    elif name != 'COMMENT':
+      asm.instruction(name, [repr(p) for p in params])
+
   def output_opcode(self, outfd, o):
     name, params = o
     def write_insn(insn):
       outfd.write('\t%s\n' % insn)
     if is_internal_jump(o):
-      name = 'bra'
+      name, params = len(params) == 1 and 'bra' or 'goto', params[:1]
     if name in ['call', 'return'] and params[-1] == no_fast:
       params = params[:-1]
     if name == 'LABEL':
@@ -2065,6 +4031,502 @@ class Word(Named, LiteralValue):
   def static_value(self):
     return None
 
+def plus(*values):
+  """Add cycle counts, any unknown (None) one making the sum unknown."""
+  if None in values:
+    return None
+  return sum(values)
+
+class CycleAnalysis:
+  """Static best and worst case cycle counts of the emitted words, computed
+  on their final opcodes. The count of a word goes from its first
+  instruction up to and including its return, and includes the words it
+  calls, jumps or falls through to. Loops are only bounded when they come
+  from cfor; a word containing other loops, computed jumps or recursive
+  calls has no known worst case (None)."""
+
+  conditional_branches = ['bc', 'bn', 'bnc', 'bnn', 'bnov', 'bnz', 'bov',
+                          'bz']
+
+  skips = ['btfsc', 'btfss', 'cpfseq', 'cpfsgt', 'cpfslt', 'tstfsz',
+           'decfsz', 'dcfsnz', 'incfsz', 'infsnz']
+
+  def __init__(self, words):
+    self.words = [w for w in words if not w.substitute]
+    self.by_name = dict([(repr(w), w) for w in self.words])
+    self.costs = {}
+
+  def cost(self, word):
+    """Return the (best, worst) cycle counts of an emitted word."""
+    if word not in self.costs:
+      # Recursive calls have no known cost
+      self.costs[word] = (None, None)
+      edges = self.edges(word)
+      self.costs[word] = (self.path(word, edges, 0, True),
+                          self.path(word, edges, 0, False))
+    return self.costs[word]
+
+  def target_cost(self, word, target, cycles):
+    """Return the (best, worst) cost of calling or jumping to another word,
+    the jump itself costing cycles."""
+    if isinstance(target, Named):
+      w = self.by_name.get(repr(target))
+      if w is not None and w != word:
+        best, worst = self.cost(w)
+        return plus(best, cycles), plus(worst, cycles)
+    return None, None
+
+  def fall_through(self, word, skip = False):
+    """Return the (best, worst) cost of leaving an emitted word by its end
+    into the next word of the code section, the first instruction of which
+    gets skipped if skip is set."""
+    n = self.words.index(word) + 1
+    if n == len(self.words):
+      return None, None
+    following = self.words[n]
+    if not skip:
+      return self.target_cost(word, following, 0)
+    opcodes = following.opcodes
+    j = 0
+    while j < len(opcodes) and opcodes[j][0] in ['LABEL', 'COMMENT']:
+      j += 1
+    if j == len(opcodes):
+      return self.fall_through(following, True)
+    skipped = 1 + pic18.size(opcodes[j][0])
+    if j + 1 == len(opcodes):
+      best, worst = self.fall_through(following)
+    else:
+      edges = self.edges(following)
+      best = self.path(following, edges, j + 1, True)
+      worst = self.path(following, edges, j + 1, False)
+    return plus(best, skipped), plus(worst, skipped)
+
+  def edges(self, word):
+    """Return, for every opcode index, the list of (target, best, worst)
+    edges leaving it. The target None designates the word exit."""
+    opcodes = word.opcodes
+    labels = {word: 0}
+    for i, (name, params) in enumerate(opcodes):
+      if name == 'LABEL':
+        labels[params[0]] = i
+    pcl = compiler['PCL'].static_value()
+    result = []
+    for i, (name, params) in enumerate(opcodes):
+
+      def go(best, worst, k = i + 1, skip = False):
+        if k < len(opcodes):
+          return (k, best, worst)
+        following = self.fall_through(word, skip)
+        return (None, plus(following[0], best), plus(following[1], worst))
+
+      def jump(target, cycles):
+        if target in labels:
+          return (labels[target], cycles, cycles)
+        return (None,) + self.target_cost(word, target, cycles)
+
+      if name in ['LABEL', 'COMMENT']:
+        result.append([go(0, 0)])
+      elif name in CycleAnalysis.conditional_branches:
+        result.append([go(1, 1), jump(params[0], 2)])
+      elif name in ['bra', 'goto']:
+        result.append([jump(params[0], 2)])
+      elif name in CycleAnalysis.skips:
+        j = i + 1
+        while j < len(opcodes) and opcodes[j][0] in ['LABEL', 'COMMENT']:
+          j += 1
+        if j < len(opcodes):
+          skipped = 1 + pic18.size(opcodes[j][0])
+          result.append([go(1, 1), go(skipped, skipped, j + 1)])
+        else:
+          # The skipped instruction starts the next word
+          result.append([go(1, 1), go(0, 0, j, True)])
+      elif name in ['call', 'rcall']:
+        best, worst = self.target_cost(word, params[0], 2)
+        result.append([go(best, worst)])
+      elif name in ['return', 'retlw', 'retfie']:
+        result.append([(None, 2, 2)])
+      elif name == 'reset':
+        result.append([(None, 1, 1)])
+      elif jump_table(opcodes, i) is not None:
+        result.append([(j, 2, 2) for j in jump_table(opcodes, i)])
+      elif name in pic18.instructions and \
+           pic18.instructions[name][0] in ['fda', 'fa'] and \
+           params[0].static_value() == pcl and \
+           (len(params) < 3 or params[1] == dst_f):
+        # Computed jump
+        result.append([(None, None, None)])
+      else:
+        cycles = name in pic18.two_cycles and 2 or 1
+        result.append([go(cycles, cycles)])
+    return result
+
+  def walk(self, edges, start, extra, best, stop = []):
+    """Return the best or worst distances from start to every opcode index,
+    and to the exit as the last element, following forward edges only.
+    Entering an index costs the extra cycles recorded for it. The walk does
+    not go past the indices in stop. A distance is None if unreachable and
+    False if unknown."""
+    n = len(edges)
+    dist = [None] * (n + 1)
+    dist[start] = extra.get(start, 0)
+    for i in range(start, n):
+      if dist[i] is None or (i != start and i in stop):
+        continue
+      for t, b, w in edges[i]:
+        if t is None:
+          t = n
+        elif t <= i:
+          continue
+        if best:
+          cycles = b
+        else:
+          cycles = w
+        if cycles is None or dist[i] is False:
+          dist[t] = False
+        elif dist[t] is None:
+          dist[t] = dist[i] + cycles + extra.get(t, 0)
+        elif dist[t] is not False:
+          d = dist[i] + cycles + extra.get(t, 0)
+          if best:
+            dist[t] = min(dist[t], d)
+          else:
+            dist[t] = max(dist[t], d)
+    return dist
+
+  def loops(self, word, edges, best):
+    """Return the extra cycles spent at loop heads by the iterations that
+    a forward walk does not see, or None if a loop is unbounded."""
+    back = [(i, t, [w, b][best]) for i in range(len(edges))
+            for t, b, w in edges[i] if t is not None and t <= i]
+    back.sort(key = lambda x: x[0] - x[1])
+    extra = {}
+    for i, t, cycles in back:
+      labels = [o[1][0] for o in word.opcodes[t:i+1] if o[0] == 'LABEL']
+      bounded = [l for l in labels if l.loop_bound]
+      if best:
+        # Only loops with a known count are sure to iterate
+        if bounded and bounded[0].loop_exact:
+          iteration = self.walk(edges, t, extra, best)[i]
+          if iteration and cycles is not None:
+            extra[t] = extra.get(t, 0) + \
+                       (bounded[0].loop_bound - 1) * (iteration + cycles)
+        continue
+      if not bounded:
+        return None
+      iteration = self.walk(edges, t, extra, best)[i]
+      if iteration is None or iteration is False or cycles is None:
+        return None
+      extra[t] = extra.get(t, 0) + \
+                 (bounded[0].loop_bound - 1) * (iteration + cycles)
+    return extra
+
+  def path(self, word, edges, start, best, stop = []):
+    """Return the best or worst cycle count from start to the exit or to
+    an index in stop, or None if it is unknown."""
+    extra = self.loops(word, edges, best)
+    if extra is None:
+      return None
+    dist = self.walk(edges, start, extra, best, stop)
+    reached = [dist[i] for i in stop if i > start] + [dist[-1]]
+    reached = [d for d in reached if d is not None]
+    if False in reached or not reached:
+      return None
+    if best:
+      return min(reached)
+    return max(reached)
+
+  def protected_regions(self):
+    """Return the worst case duration of the regions where interrupts are
+    globally disabled, as a list of (word, cycles)."""
+    intcon = compiler['INTCON'].static_value()
+    def is_gie(o, op):
+      return o[0] == op and o[1][0].static_value() == intcon and \
+             o[1][1].static_value() == 7
+    result = []
+    for word in self.words:
+      starts = [i for i, o in enumerate(word.opcodes) if is_gie(o, 'bcf')]
+      if not starts:
+        continue
+      ends = [i for i, o in enumerate(word.opcodes) if is_gie(o, 'bsf')]
+      # Interrupts may be reenabled conditionally
+      ends += [i - 1 for i in ends if word.opcodes[i-1][0] in
+               CycleAnalysis.skips]
+      edges = self.edges(word)
+      worst = [self.path(word, edges, i, False, ends) for i in starts]
+      if None in worst:
+        result.append((word, None))
+      else:
+        result.append((word, max(worst)))
+    return result
+
+class StackAnalysis:
+  """Static maximum depths of the data stack (FSR0), the return stack (FSR2)
+  and the hardware call stack, computed on the final opcodes of the
+  emitted words. The effect of a word is a (data max, data net, return max,
+  return net, calls) tuple relative to its entry, in bytes for the software
+  stacks and in levels for the hardware one. It is None when the word
+  recurses, jumps to a computed address or contains a loop whose body
+  leaves something on a stack."""
+
+  def __init__(self, words):
+    self.words = [w for w in words if not w.substitute]
+    self.by_name = dict([(repr(w), w) for w in self.words])
+    self.effects = {}
+    self.unbounded = None
+    names = ['PREINC0', 'POSTINC0', 'POSTDEC0', 'PREINC2', 'POSTINC2',
+             'POSTDEC2', 'FSR0L', 'FSR0H', 'FSR2L', 'FSR2H', 'PCL']
+    self.addr = dict([(n, compiler[n].static_value()) for n in names])
+    self.moves = {}
+    for n, delta in [('PREINC', 1), ('POSTINC', 1), ('POSTDEC', -1)]:
+      self.moves[self.addr[n + '0']] = (delta, 0)
+      self.moves[self.addr[n + '2']] = (0, delta)
+
+  def effect(self, word, handler = False, start = 0):
+    """Return the stack effect of an emitted word, entered at the opcode
+    index start. An interrupt handler may switch the software stacks to
+    its own areas; the pushes made after the switch are then counted as
+    if they were on the main ones."""
+    key = (word, handler, start)
+    if key not in self.effects:
+      # Recursive calls have no known effect
+      self.effects[key] = None
+      self.effects[key] = self.walk(word, handler, start)
+      if self.effects[key] is None and self.unbounded is None:
+        self.unbounded = word
+    return self.effects[key]
+
+  def target_effect(self, word, target):
+    """Return the effect of calling or jumping to another word."""
+    if isinstance(target, Named):
+      w = self.by_name.get(repr(target))
+      if w is not None and w != word:
+        return self.effect(w)
+    return None
+
+  def fall_through(self, word, skip = False):
+    """Return the effect of leaving an emitted word by its end into the
+    next word of the code section, the first instruction of which gets
+    skipped if skip is set."""
+    k = self.words.index(word) + 1
+    if k == len(self.words):
+      return None
+    following = self.words[k]
+    if not skip:
+      return self.target_effect(word, following)
+    opcodes = following.opcodes
+    j = 0
+    while j < len(opcodes) and opcodes[j][0] in ['LABEL', 'COMMENT']:
+      j += 1
+    if j + 1 >= len(opcodes):
+      return self.fall_through(following, j == len(opcodes))
+    return self.effect(following, False, j + 1)
+
+  def walk(self, word, handler, start):
+    """Follow the opcodes of a word from index start, keeping at each
+    index the highest (data, data max, return, return max, calls) state
+    reaching it."""
+    opcodes = word.opcodes
+    labels = {word: 0}
+    for i, (name, params) in enumerate(opcodes):
+      if name == 'LABEL':
+        labels[params[0]] = i
+    n = len(opcodes)
+    states = [None] * n
+    states[start] = (0, 0, 0, 0, 0)
+    # Once a word sets a stack pointer by itself, the rest of its
+    # accesses through it are not pushes and pops on the stack
+    managed = [False, False]
+    fsr = [(self.addr['FSR0L'], self.addr['FSR0H']),
+           (self.addr['FSR2L'], self.addr['FSR2H'])]
+    # The states reaching the exit
+    exits = []
+
+    def apply(state, effect):
+      d, dmax, r, rmax, hw = state
+      return (d + effect[1], max(dmax, d + effect[0]), r + effect[3],
+              max(rmax, r + effect[2]), max(hw, effect[4]))
+
+    def join(i, state):
+      if state is None:
+        return False
+      if i < n and states[i] is None:
+        states[i] = state
+      elif i < n:
+        states[i] = tuple([max(a, b) for a, b in zip(states[i], state)])
+      else:
+        exits.append(state)
+      return True
+
+    for i, (name, params) in enumerate(opcodes):
+      state = states[i]
+      if state is None:
+        continue
+
+      def jump(target, state = state):
+        if target in labels:
+          t = labels[target]
+          if t <= i and states[t] is not None:
+            # A loop must not leave anything on the stacks
+            head = states[t]
+            return state[0] <= head[0] and state[2] <= head[2]
+          if t > i:
+            return join(t, state)
+          # Code not reached yet from start, which runs until its exit
+          effect = self.effect(word, handler, t)
+        else:
+          effect = self.target_effect(word, target)
+        return effect is not None and join(n, apply(state, effect))
+
+      def go(effect = (0, 0, 0, 0, 0), k = i + 1, skip = False):
+        if k < n:
+          return join(k, apply(state, effect))
+        following = self.fall_through(word, skip)
+        return following is not None and \
+               join(n, apply(apply(state, effect), following))
+
+      if name in ['LABEL', 'COMMENT']:
+        ok = go()
+      elif name in CycleAnalysis.conditional_branches:
+        ok = go() and jump(params[0])
+      elif name in ['bra', 'goto']:
+        ok = jump(params[0])
+      elif name in CycleAnalysis.skips:
+        j = i + 1
+        while j < n and opcodes[j][0] in ['LABEL', 'COMMENT']:
+          j += 1
+        effect = self.moved(name, params, managed)
+        if j < n:
+          ok = go(effect) and go(effect, j + 1)
+        else:
+          # The skipped instruction starts the next word
+          ok = go(effect) and go(effect, j, True)
+      elif name in ['call', 'rcall']:
+        if params[0] in labels:
+          effect = self.effect(word, handler, labels[params[0]])
+        else:
+          effect = self.target_effect(word, params[0])
+        ok = effect is not None and go(effect[:4] + (effect[4] + 1,))
+      elif name in ['return', 'retlw', 'retfie', 'reset']:
+        ok = join(n, state)
+      elif jump_table(opcodes, i) is not None:
+        ok = not [j for j in jump_table(opcodes, i) if not join(j, state)]
+      elif name in ['push', 'pop'] or \
+           written_register(name, params) == self.addr['PCL']:
+        # Computed jump or hardware stack manipulation
+        ok = False
+      else:
+        effect = self.moved(name, params, managed)
+        written = written_register(name, params)
+        for s in [0, 1]:
+          if written in fsr[s] and not handler:
+            managed[s] = True
+        ok = go(effect)
+      if not ok:
+        return None
+    reached = [s for s in states if s is not None] + exits
+    d, dmax, r, rmax, hw = [max(x) for x in zip(*reached)]
+    # A word which never returns leaves nothing behind
+    d = r = 0
+    if exits:
+      d, r = max([s[0] for s in exits]), max([s[2] for s in exits])
+    return (dmax, d, rmax, r, hw)
+
+  def moved(self, name, params, managed):
+    """Return the effect of the stack pointer updates made by the register
+    accesses of an instruction."""
+    if name == 'movff':
+      registers = params
+    elif name in pic18.instructions and \
+         pic18.instructions[name][0] in ['fda', 'fa', 'fba']:
+      registers = params[:1]
+    else:
+      registers = []
+    d = r = 0
+    for p in registers:
+      delta = self.moves.get(p.static_value(), (0, 0))
+      d += delta[0] * (not managed[0])
+      r += delta[1] * (not managed[1])
+    return (max(d, 0), d, max(r, 0), r, 0)
+
+class FoldingSimulator(pic18.Simulator):
+  """Simulator running a piece of code which may only work on the data
+  stack, the return stack and scratch registers. Any other access, or a
+  read of a stack byte it has not written itself, raises pic18.Error.
+  Other bytes start with a fill value; running the same code with several
+  of them tells whether it depends on their contents."""
+
+  scratch = [pic18.WREG, pic18.STATUS, pic18.PRODL, pic18.PRODH] + \
+            [r + i for r in pic18.FSRL for i in [0, 1]]
+
+  def __init__(self, program, base, fill):
+    pic18.Simulator.__init__(self, program)
+    self.ram = [fill] * 0x1000
+    self.ram[pic18.BSR] = 1
+    self.base = base
+    self.set_fsr(0, base)
+    self.set_fsr(2, 0xbf)
+    self.written = set()
+    self.visited = set()
+    self.looped = False
+
+  def push_value(self, value):
+    for b in [value & 0xff, (value >> 8) & 0xff]:
+      self.set_fsr(0, self.fsr(0) + 1)
+      self.ram[self.fsr(0)] = b
+      self.written.add(self.fsr(0))
+
+  def load(self, addr):
+    if addr is not None and addr not in self.written and \
+       addr >= compiler.free_access and \
+       addr not in FoldingSimulator.scratch:
+      raise pic18.Error('read of 0x%x' % addr)
+    return pic18.Simulator.load(self, addr)
+
+  def store(self, addr, value):
+    if addr is None or not (addr < compiler.free_access or
+                            self.base < addr < 0x100 or
+                            addr in FoldingSimulator.scratch):
+      raise pic18.Error('write to %s' % addr)
+    self.written.add(addr)
+    pic18.Simulator.store(self, addr, value)
+
+  def table_read(self, pre, post):
+    raise pic18.Error('table read')
+
+  def table_write(self, pre, post):
+    raise pic18.Error('table write')
+
+  def step(self):
+    if self.pc in self.visited:
+      self.looped = True
+    self.visited.add(self.pc)
+    pic18.Simulator.step(self)
+
+  def results(self):
+    """Return the values left above the base of the data stack."""
+    top = self.fsr(0)
+    if top < self.base or (top - self.base) % 2 or \
+       self.fsr(2) != 0xbf or self.ram[pic18.BSR] != 1 or self.halted:
+      raise pic18.Error('unbalanced stacks')
+    return [self.ram[a] | self.ram[a+1] << 8
+            for a in range(self.base + 1, top, 2)]
+
+class DepthSimulator(pic18.Simulator):
+  """Simulator recording the highest data stack, return stack and
+  hardware stack levels reached since the last call to watch()."""
+
+  def reset(self):
+    pic18.Simulator.reset(self)
+    self.watch()
+
+  def watch(self):
+    self.deepest = [self.fsr(0), self.fsr(2), len(self.stack)]
+
+  def step(self):
+    pic18.Simulator.step(self)
+    for i, level in enumerate([self.fsr(0), self.fsr(2), len(self.stack)]):
+      self.deepest[i] = max(self.deepest[i], level)
+
 class Input:
 
   def __init__(self, name, lines):
@@ -2177,15 +4639,94 @@ class Compiler:
     self.initialize_variables = False
     self.order = 0
     self.use_interrupts = False
+    self.protect_temporaries = True
     self.inline_list = []
+    self.placements = None
+    self.banks_switched = False
+    self.initial_values = []
+    self.loop_counters = []
+    self.free_access = 0x60
+    self.last_variable = None
+    self.grouping = None
     self.low_interrupt = None
     self.high_interrupt = None
+    self.variants = None
+    self.optimization = '1'
+    self.stats = None
+    self.fold_results = {}
+    self.fold_words = {}
+    self.fold_failures = set()
+    self.comparison = None
+    self.expressions = []
+    self.rewriting = False
+    self.emitted = []
+    self.benchmarks = []
+    self.flash_limit = None
+    self.profile = None
+    self.profile_file = None
+    self.measured_calls = {}
+    self.specializations = {}
+    self.clones = {}
+    self.specializing = False
+    self.timing = False
     PICIns.prefix = False
 
   def process(self):
     self.add_default_content()
+    self.compile()
+
+  def compile(self):
+    """Compile the input file on top of the predefined words and write the
+    assembly output."""
     self.include(self.infile)
-    self.output(open(self.asmfile, 'w'))
+    roots = self.link()
+    if roots is None:
+      return
+    layout = self.layout(roots)
+    body = StringIO()
+    self.deep_output(body, layout)
+    if self.stats is not None:
+      self.write_stats(os.path.splitext(self.targets()[0][2])[0] + '.json')
+    if self.flash_limit is not None:
+      for processor, start, asmfile in self.targets():
+        end = max(self.assemble(layout, start.static_value()).program()) + 1
+        if end > self.flash_limit.static_value():
+          warning('%s: program ends at 0x%x, beyond the flash limit' %
+                  (asmfile, end))
+    depths = self.stack_depths(layout)
+    if self.timing:
+      self.write_timing(os.path.splitext(self.targets()[0][2])[0] +
+                        '.timing', layout, depths)
+    if self.benchmarks:
+      asm = self.assemble(layout, self.targets()[0][1].static_value())
+      analysis = stacks = None
+      if self.timing:
+        words = sum([e for s, e in layout if s == 'code'], [])
+        analysis, stacks = CycleAnalysis(words), StackAnalysis(words)
+      for spec in self.benchmarks:
+        self.benchmark(asm, spec, analysis, stacks)
+    if self.profile_file:
+      outfd = open(self.profile_file, 'w')
+      try:
+        json.dump(self.measured_calls, outfd, indent = 2, sort_keys = True)
+        outfd.write('\n')
+      finally:
+        outfd.close()
+    for processor, start, asmfile in self.targets():
+      outfd = open(asmfile, 'w')
+      try:
+        self.output_prologue(outfd, processor, start)
+        outfd.write(body.getvalue())
+        self.output_epilogue(outfd)
+      finally:
+        outfd.close()
+
+  def targets(self):
+    """Return the (processor, start address, output file) triplets to
+    produce from a single compilation. Only the prologue depends on them."""
+    if self.variants:
+      return self.variants
+    return [(self.processor, self.start, self.asmfile)]
 
   def enable_interrupts(self):
     if self.first_dict:
@@ -2201,7 +4742,9 @@ class Compiler:
     self.add_asm_instructions()
     self.add_primitives()
     assert(self.here < 0x60)
+    self.free_access = self.here
     self.here = 0x100
+    self.last_variable = self.grouping = None
     self.initialize_variables = True
 
   def add_primitives(self):
@@ -2235,9 +4778,82 @@ class Compiler:
     else:
       return '<builtin>'
 
+  def source_position(self):
+    """Return the current position in the input, for definition_source()."""
+    return self.input, self.input.current_line, len(self.input_buffer)
+
+  def definition_source(self, word):
+    """Return the input name, first line number and lines of the body of
+    the word whose `;' was just read, or None if compiling the body again
+    later would not give the same code: the body is recursive, refers to
+    a previous definition of the word or was not read from one input."""
+    input, line, remaining = word.body_start
+    if input is not self.input or \
+       [p for n, params in word.opcodes[1:] for p in params
+        if p is word.opcodes[0][1][0]] or \
+       [r for r in word.references if getattr(r, 'name', None) == word.name]:
+      return None
+    lines = input.lines[line-1:input.current_line]
+    first = len(lines[0]) - remaining
+    last = len(lines[-1]) - len(self.input_buffer)
+    if len(lines) == 1:
+      lines = [lines[0][first:last]]
+    else:
+      lines = [lines[0][first:]] + lines[1:-1] + [lines[-1][:last]]
+    # Drop the final `;'
+    lines[-1] = lines[-1].rstrip()
+    if not lines[-1].endswith(';'):
+      return None
+    lines[-1] = lines[-1][:-1]
+    return input.name, line, lines
+
   def allot(self, n):
     self.here += n
 
+  def new_loop_counter(self):
+    """Allocate a byte of the access bank, next to the core temporaries, to
+    hold the counter of cfor loops. Return None if no room is left, or if
+    link() already placed variables there in a previous pass."""
+    placed = [a for a in (self.placements or {}).values() if a is not None]
+    if self.free_access >= 0x60 or [a for a in placed
+                                     if a <= self.free_access]:
+      return None
+    here, last, grouping = self.here, self.last_variable, self.grouping
+    self.here = self.free_access
+    self.push_object(self.current_object)
+    counter = Variable('loop-counter-%d' % len(self.loop_counters), 1,
+                       'NO_INIT')
+    self.pop_object()
+    self.free_access = self.here
+    self.here, self.last_variable, self.grouping = here, last, grouping
+    self.loop_counters.append(counter)
+    return counter
+
+  def place_variable(self, variable):
+    """Decide whether the new RAM variable may be moved by link(). The
+    variables between a create and the next one, as in a structure, are
+    laid out on purpose and stay where they are."""
+    variable.movable = variable.size > 0 and self.grouping is None and \
+                       variable.addr >= 0x100
+    if variable.size == 0:
+      if self.grouping and self.last_variable is not self.grouping:
+        # End of a structure, or buffer within it if allotted
+        variable.enclosing = self.grouping
+        self.grouping = None
+      else:
+        self.grouping = variable
+    self.last_variable = variable
+
+  def extend_variable(self):
+    """Give the bytes about to be allotted to the last variable, which
+    cannot be moved any longer."""
+    variable = self.last_variable
+    if variable:
+      variable.movable = False
+      if variable.size == 0:
+        self.grouping = variable.enclosing
+      self.last_variable = None
+
   def save_input(self):
     self.input_stack.append(self.input)
 
@@ -2284,7 +4900,7 @@ class Compiler:
       if x:
         word = x.group(2)
         if word == '\\':
-	  self.input_buffer = ''  # discard remainder of this line
+          self.input_buffer = ''  # discard remainder of this line
         else:
           self.input_buffer = self.input_buffer[len(word)+len(x.group(1))+1:]
           return word
@@ -2400,6 +5016,10 @@ class Compiler:
         return
       object = self.find(word)
       if object:
+        mark = self.fold_mark(object)
+        comparison = self.comparison_mark(object)
+        expression = self.expression_mark(object)
+        shift = self.shift_mark(object)
         if object.immediate:
           try:
             object.run()
@@ -2413,6 +5033,10 @@ class Compiler:
             self.add_call(object)
           else:
             self.ct_push(object)
+        self.fold(mark)
+        self.remember_shift(shift)
+        self.remember_expression(expression)
+        self.remember_comparison(comparison)
       else:
         number = parse_number(word)
         if number is None:
@@ -2424,31 +5048,106 @@ class Compiler:
         else:
                 self.ct_push(number)
 
-  def output(self, outfd):
+  def link(self):
+    """Resolve the program starting from the main word and return the list
+    of roots to output, or None if the compilation has been restarted."""
     global compiler
     # Finalize init_runtime
     self.current_object = self['init_runtime']
     self.state = 1
+    if self.use_interrupts and self.optimization in ['2', 's']:
+      self.protect_temporaries = None
     inlinable = [x for x in self.all_entities if x.can_inline()]
+    variables = [x for x in self.all_entities if isinstance(x, Variable)]
     refs = self.find_main(True).deep_references([])
     for i in refs:
       i.check_real()
-    if self.automatic_inlining:
+    # Drop the specialized versions which do not pay off before anything
+    # else gets chosen on the calls they took over
+    if self.optimization in ['2', 's']:
+      rejected = self.check_specializations()
+      if rejected:
+        stderror("Restarting without the specialized versions of:\n   %s" %
+                 "\n   ".join(["%s (%s)" % (x.name, x.definition)
+                                for x in rejected]))
+        stats = self.stats
+        if stats is not None:
+          stats = dict([(k, v) for k, v in stats.items()
+                        if k[0] == 'auto-inline'])
+        self.restart(self.inline_list, self.placements, stats)
+        return None
+    if self.automatic_inlining and self.optimization in ['2', 's']:
+      chosen = self.choose_inlining([x for x in refs if x in inlinable])
+      if chosen:
+        stderror("Restarting with automatic inlining of:\n   %s" %
+                  "\n   ".join(["%s (%s)%s" % (x.name, x.definition,
+                                                callers and ' into %s' %
+                                                ', '.join([c.name for c in
+                                                           callers]) or '')
+                                 for x, callers, saved in chosen]))
+        stats = self.stats
+        if stats is not None:
+          stats = dict([(k, v) for k, v in stats.items()
+                        if k[0] == 'auto-inline'])
+          for x, callers, saved in chosen:
+            entry = stats.setdefault(('auto-inline', x.name), [0, 0, 0])
+            entry[0] += 1
+            entry[1] += saved // 2
+            entry[2] += saved
+        inline_list = self.inline_list[:]
+        for x, callers, saved in chosen:
+          if callers:
+            inline_list += [(x.definition, c.definition) for c in callers]
+          else:
+            inline_list.append(x.definition)
+        self.restart(inline_list, self.placements, stats)
+        return None
+    elif self.automatic_inlining:
       to_inline = [x for x in refs if x in inlinable and x.should_inline()]
       if to_inline:
         stderror("Restarting with automatic inlining of:\n   %s" %
                   "\n   ".join(["%s (%s)" % (x.name, x.definition)
                                  for x in to_inline]))
-        outfd.close()
-        compiler = Compiler(self.processor, self.start, self.main,
-                             self.automatic_inlining, self.no_comments,
-                            self.infile, self.asmfile)
-        compiler.inline_list = self.inline_list + \
-                               [x.definition for x in to_inline]
-        if self.use_interrupts:
-          compiler.enable_interrupts()
-        compiler.process()
-        return
+        stats = self.stats
+        if stats is not None:
+          stats = dict([(k, v) for k, v in stats.items()
+                        if k[0] == 'auto-inline'])
+          for x in to_inline:
+            saved = len(x.opcodes) + x.referenced_by - \
+                    len(x.opcodes) * x.referenced_by
+            stats[('auto-inline', x.name)] = [1, saved, 2 * saved]
+        self.restart(self.inline_list + [x.definition for x in to_inline],
+                     self.placements, stats)
+        return None
+    if self.placements is None and self.optimization in ['2', 's']:
+      placements = self.place_variables(variables)
+      if placements:
+        stderror("Restarting with %d variables moved to the access bank "
+                 "and %d unused ones removed" %
+                 (len([x for x in placements.values() if x is not None]),
+                  len([x for x in placements.values() if x is None])))
+        stats = self.stats
+        if stats is not None:
+          stats = dict([(k, v) for k, v in stats.items()
+                        if k[0] == 'auto-inline'])
+        self.restart(self.inline_list, placements, stats)
+        return None
+    if self.optimization in ['2', 's']:
+      chosen = self.choose_specializations()
+      if chosen:
+        stderror("Restarting with specialized versions of:\n   %s" %
+                 "\n   ".join(["%s for %d (%s)" % (x.name, v, x.definition)
+                                for x, v, saved in chosen]))
+        for x, v, saved in chosen:
+          self.specializations[(x.definition, x.name, x.occurrence, v)] = \
+            saved
+        stats = self.stats
+        if stats is not None:
+          stats = dict([(k, v) for k, v in stats.items()
+                        if k[0] == 'auto-inline'])
+        self.restart(self.inline_list, self.placements, stats)
+        return None
+    self.add_initializations()
     if compiler.here > 0x100:
       compiler.current_object.opcodes = [('movlb', [Number(1)])] + \
                                          compiler.current_object.opcodes
@@ -2474,9 +5173,362 @@ class Compiler:
     if self.high_interrupt:
       self.high_interrupt.deep_references([])
       roots.append(self.high_interrupt)
-    self.output_prologue(outfd)
-    self.deep_output(outfd, roots)
-    self.output_epilogue(outfd)
+    if self.protect_temporaries is None:
+      self.protect_temporaries = self.handlers_clobber_temporaries()
+      for w in reachable_words(roots):
+        w.expand_protection()
+    return roots
+
+  def add_initializations(self):
+    """Add the initialization of the variables whose initial value is known
+    to init_runtime. Runs of consecutive bytes are copied from an image in
+    flash or cleared by a loop when this is shorter than storing every
+    byte."""
+    def stores(run):
+      return sum([v in [0, 0xff] and 1 or 2 for a, e, v in run])
+    bytes = []
+    for variable, size, value in self.initial_values:
+      for i in range(size):
+        e = i and Add(variable, Number(i)) or variable
+        bytes.append((e.static_value(), e, (value >> (8 * i)) & 0xff))
+    bytes.sort(key = lambda b: b[0])
+    runs = []
+    for b in bytes:
+      if runs and runs[-1][-1][0] + 1 == b[0] and len(runs[-1]) < 256:
+        runs[-1].append(b)
+      else:
+        runs.append([b])
+    # Long stretches of zeros are better cleared than copied
+    pieces = []
+    for run in runs:
+      start = 0
+      for i in range(len(run) + 1):
+        if i < len(run) and not run[i][2]:
+          continue
+        zeros = i
+        while zeros > start and not run[zeros - 1][2]:
+          zeros -= 1
+        if i - zeros >= 16:
+          pieces += [run[start:zeros], run[zeros:i]]
+          start = i
+      pieces.append(run[start:])
+    runs = [r for r in pieces if r]
+    # A copy loop takes 8 words plus the image, a clearing loop 6 words
+    direct, copies, clears = [], [], []
+    for run in runs:
+      if [v for a, e, v in run if v]:
+        if stores(run) > 8 + (len(run) + 1) // 2:
+          copies.append(run)
+          continue
+      elif stores(run) > 6:
+        clears.append(run)
+        continue
+      direct.append(run)
+    # The table pointer setup has to pay off as well
+    if sum([stores(r) - 8 - (len(r) + 1) // 2 for r in copies]) <= 6:
+      direct, copies = direct + copies, []
+    # Store the remaining bytes in definition order, high byte first
+    direct = set([a for r in direct for a, e, v in r])
+    for variable, size, value in self.initial_values:
+      for i in reversed(range(size)):
+        e = i and Add(variable, Number(i)) or variable
+        if e.static_value() in direct:
+          self.push(Number((value >> (8 * i)) & 0xff))
+          self.push(e)
+          self.eval('c!')
+    if copies:
+      image = FlashData(sum([[v for a, e, v in r] for r in copies], []),
+                        'initial values of variables', 'initial_values')
+      image.from_source = False
+      self.add_instruction('movlw', [Low(image)])
+      self.add_instruction('movwf', [self['TBLPTRL'], access])
+      self.add_instruction('movlw', [High(image)])
+      self.add_instruction('movwf', [self['TBLPTRH'], access])
+      self.add_instruction('clrf', [self['TBLPTRU'], access])
+      self.add_instruction('bcf', self['CFGS'] + [access])
+    for run in copies + clears:
+      self.add_instruction('lfsr', [Number(1), run[0][1]])
+      self.add_instruction('movlw', [Number(len(run) & 0xff)])
+      label = Label()
+      label.loop_bound = len(run)
+      label.loop_exact = True
+      self.add_instruction('LABEL', [label])
+      if run in copies:
+        self.add_instruction('tblrd*+', [])
+        self.add_instruction('movff', [self['TABLAT'], self['POSTINC1']])
+      else:
+        self.add_instruction('clrf', [self['POSTINC1'], access])
+      self.add_instruction('decfsz', [self['WREG'], dst_f, access])
+      self.add_instruction('bra', [label])
+
+  def call_counts(self, words, roots):
+    """Return how many times each call between the given words is expected
+    to run for one run of the roots, as a dict mapping (caller, callee)
+    pairs to a list of (instruction, count) call sites, along with the
+    words referenced otherwise than through a call. Calls within a loop
+    run loop_bound times, LOOP_WEIGHT times if the loop count is unknown.
+    Counts measured by --profile replace the estimates."""
+    sites = {}
+    others = []
+    for c in words:
+      positions = dict([(o[1][0], i) for i, o in enumerate(c.opcodes)
+                        if o[0] == 'LABEL'])
+      loops = {}
+      for j, (name, params) in enumerate(c.opcodes):
+        if name != 'LABEL' and params and params[0] in positions and \
+           positions[params[0]] < j:
+          loops[params[0]] = (positions[params[0]], j)
+      for i, (name, params) in enumerate(c.opcodes):
+        for k, x in enumerate(params):
+          if not isinstance(x, Word) or x not in words:
+            continue
+          if k or name not in ['call', 'rcall', 'goto']:
+            if x not in others:
+              others.append(x)
+            continue
+          weight = 1
+          for l, (start, end) in loops.items():
+            if start < i < end:
+              weight *= l.loop_bound or LOOP_WEIGHT
+          sites.setdefault((c, x), []).append((name, weight))
+    frequencies = dict([(r, 1) for r in roots])
+    def frequency(w):
+      if w not in frequencies:
+        frequencies[w] = 0
+        frequencies[w] = sum([frequency(c) * sum([n for i, n in l])
+                              for (c, x), l in sites.items() if x is w])
+      return frequencies[w]
+    for (c, x), l in sites.items():
+      measured = (self.profile or {}).get(x.name)
+      if measured is not None:
+        count = measured.get(c.name, 0)
+        sites[(c, x)] = [(i, float(count) / len(l)) for i, n in l]
+      else:
+        sites[(c, x)] = [(i, frequency(c) * n) for i, n in l]
+    return sites, others
+
+  def choose_inlining(self, candidates):
+    """Choose the words to inline automatically, as (word, callers, saved
+    bytes) triplets, callers being None when every call gets inlined and
+    the word dropped. Inlining which does not make the program larger is
+    always chosen; at -O2, the flash left below --flash-limit then goes to
+    the calls saving the most cycles per byte."""
+    roots = [x for x in [self.find_main(), self.low_interrupt,
+                         self.high_interrupt] if x]
+    words = reachable_words(roots)
+    sites, others = self.call_counts(words, roots)
+    # init_runtime is only complete once the program has been linked
+    others += self['init_runtime'].references
+    items = []
+    for t in candidates:
+      if t not in words or t in roots or t.inlined or not t.from_source or \
+         (t, t) in sites:
+        continue
+      size = opcodes_size(t.opcodes)[1] - 2
+      pairs = []
+      for (c, x), l in sites.items():
+        if x is not t:
+          continue
+        # The call and the return go away, a tail call leaves a return
+        growth = sum([size - (i == 'rcall' and 2 or 4) +
+                      (i == 'goto' and 2 or 0) for i, n in l])
+        gain = sum([n * ((i == 'goto' and 2 or 4) + INLINE_BONUS)
+                    for i, n in l])
+        pairs.append((c, growth, gain))
+      if not pairs and t in others:
+        continue
+      growth = sum([g for c, g, n in pairs])
+      if t not in others:
+        growth -= size + 2
+      items.append((t, pairs, growth, sum([n for c, g, n in pairs])))
+    chosen = [(t, None, -growth) for t, pairs, growth, gain in items
+              if growth <= 0]
+    budget = 0
+    if self.optimization == '2' and self.flash_limit is not None:
+      # What layout() will output, plus the vectors and some room for the
+      # startup code completed at the end of link()
+      output = []
+      for r in roots:
+        r.deep_references(output)
+      used = 0x1c + 32 + opcodes_size(self['init_runtime'].opcodes)[1]
+      for x in output:
+        if isinstance(x, Word):
+          used += opcodes_size(x.opcodes)[1]
+        elif isinstance(x, FlashData):
+          used += (len(x.data) + 1) & ~1
+      start = max([s.static_value() for p, s, a in self.targets()])
+      budget = self.flash_limit.static_value() - start - used
+    # Spend the budget on the best ratios of cycles gained per byte, the
+    # calls of a word being inlined everywhere or one caller at a time.
+    # Callers must stay small enough for bra to reach any of their labels.
+    # A word growing and being inlined in the same round would make the
+    # estimates wrong, later rounds take care of it.
+    offers = []
+    for t, pairs, growth, gain in items:
+      if growth > 0:
+        offers.append((t, True, pairs, growth, gain))
+        # Calls brought in by inlining are out of reach of the callers
+        # already chosen for this word
+        offers += [(t, False, [p], p[1], p[2]) for p in pairs
+                   if (t.definition, p[0].definition) not in self.inline_list]
+    offers.sort(key = lambda o: -float(o[4]) / max(o[3], 1))
+    sizes = dict([(w, opcodes_size(w.opcodes)[1]) for w in words])
+    taken = {}
+    moved = set([t for t, callers, saved in chosen])
+    grown = set([c for c, x in sites if x in moved])
+    for t, whole, pairs, growth, gain in offers:
+      done = taken.get(t, [])
+      if done is None or (not whole and pairs[0] in done):
+        continue
+      if whole:
+        pairs = [p for p in pairs if p not in done]
+        growth -= sum([g for c, g, n in done])
+      if gain <= 0 or growth > budget or t in grown or \
+         [c for c, g, n in pairs if c in taken or c in moved or
+          (g > 0 and sizes[c] + g > 2048)]:
+        continue
+      budget -= growth
+      for c, g, n in pairs:
+        sizes[c] += g
+        grown.add(c)
+      if whole:
+        taken[t] = None
+      else:
+        taken[t] = done + pairs
+    for t, pairs, growth, gain in items:
+      if t in taken:
+        if taken[t] is None:
+          chosen.append((t, None, -growth))
+        else:
+          chosen.append((t, [c for c, g, n in taken[t]],
+                         -sum([g for c, g, n in taken[t]])))
+    return chosen
+
+  def choose_specializations(self):
+    """Choose the words worth a version specialized for the constant on
+    the top of the stack, as (word, value, saved bytes) triplets: the
+    pushes go away from the calls, and the word itself when every call
+    uses the same constant. The version must end up no larger than that,
+    which check_specializations() verifies once it has been compiled."""
+    roots = [x for x in [self.find_main(), self.low_interrupt,
+                         self.high_interrupt] if x]
+    words = reachable_words(roots)
+    sites, others = self.call_counts(words, roots)
+    others += self['init_runtime'].references
+    calls = {}
+    for c in words:
+      for t, v in c.constant_calls:
+        calls[(t, v)] = calls.get((t, v), 0) + 1
+    chosen = []
+    for (t, v), n in calls.items():
+      if not isinstance(t, Word) or \
+         (t.definition, t.name, t.occurrence, v) in self.specializations or \
+         t not in words or \
+         t in roots or t.source is None or t.inlined or t.inw or t.outw or \
+         t.outz or (t, t) in sites or \
+         [r for r in t.references if isinstance(r, FlashData)]:
+        continue
+      saved = n * push_size(v)
+      if t not in others and \
+         n == sum([len(l) for (c, x), l in sites.items() if x is t]):
+        saved += opcodes_size(t.opcodes)[1]
+      elif n < 2:
+        continue
+      chosen.append((t, v, saved))
+    chosen.sort(key = lambda x: (x[0].order, x[1]))
+    return chosen
+
+  def check_specializations(self):
+    """Return the specialized versions tried since the last link which
+    turned out larger than the bytes they were to save, after marking the
+    others as kept."""
+    words = reachable_words([x for x in [self.find_main(), self.low_interrupt,
+                                         self.high_interrupt] if x])
+    rejected = []
+    for key, clone in sorted(self.clones.items()):
+      saved = self.specializations[key]
+      if saved is True:
+        continue
+      if clone in words and opcodes_size(clone.opcodes)[1] > saved:
+        self.specializations[key] = None
+        rejected.append(clone)
+      else:
+        self.specializations[key] = True
+    return rejected
+
+  def restart(self, inline_list, placements, stats):
+    """Compile the program again from scratch with the same options, with
+    the given words inlined and variables placed. The predefined words are
+    compiled again as well since those choices apply to them too."""
+    global compiler
+    compiler = Compiler(self.processor, self.start, self.main,
+                        self.automatic_inlining, self.no_comments,
+                        self.infile, self.asmfile)
+    compiler.inline_list = inline_list
+    compiler.placements = placements
+    compiler.variants = self.variants
+    compiler.optimization = self.optimization
+    compiler.stats = stats
+    compiler.benchmarks = self.benchmarks
+    compiler.timing = self.timing
+    compiler.flash_limit = self.flash_limit
+    compiler.profile = self.profile
+    compiler.profile_file = self.profile_file
+    compiler.specializations = self.specializations
+    if self.use_interrupts:
+      compiler.enable_interrupts()
+    compiler.process()
+
+  def place_variables(self, variables):
+    """Return the new location of the variables which can be moved, keyed
+    by definition and name: an address in the free part of the access
+    bank for the most referenced ones, None for those the program does not
+    use at all. Initializations in init_runtime do not count as uses."""
+    counts = {}
+    words = reachable_words([x for x in [self.find_main(), self.low_interrupt,
+                                         self.high_interrupt] if x])
+    for w in words:
+      for name, params in w.opcodes:
+        for p in params:
+          if isinstance(p, LiteralValue):
+            for v in variables_in(p):
+              counts[v] = counts.get(v, 0) + 1
+    candidates = [v for v in variables if v.movable]
+    candidates.sort(key = lambda v: (-counts.get(v, 0), v.order))
+    placements = {}
+    free = self.free_access
+    for v in candidates:
+      if v not in counts:
+        placements[(v.definition, v.name)] = None
+      elif free + v.size <= 0x60:
+        placements[(v.definition, v.name)] = free
+        free += v.size
+    return placements
+
+  def handlers_clobber_temporaries(self):
+    """Check whether an interrupt handler, or a word it may call, changes
+    without restoring it a core temporary also used by the interrupted
+    code or an FSR register. If not, intr-protect and intr-unprotect are
+    useless."""
+    fsrs = [self['FSR%d%s' % (i, h)].static_value()
+            for i in range(3) for h in 'LH']
+    gie = self['temp_gie'].static_value()
+    for handler, other in [(self.low_interrupt, None),
+                           (self.high_interrupt, self.low_interrupt)]:
+      if not handler:
+        continue
+      accessed = set()
+      for w in reachable_words([x for x in [self.find_main(), other] if x]):
+        for name, params in w.opcodes:
+          accessed.update(accessed_registers(name, params))
+      clobbered = clobbered_by(reachable_words([handler]))
+      if clobbered is None:
+        return True
+      for a in clobbered:
+        if a not in handler.saved_context and a != gie and \
+           ((a < self.free_access and a in accessed) or a in fsrs):
+          return True
+    return False
 
   def count_references(self, l):
     """Count references to each word within list l."""
@@ -2524,7 +5576,98 @@ class Compiler:
         r.append(i)
     return r
 
-  def deep_output(self, outfd, roots):
+  def tail_keys(self, word):
+    """Return the instructions ending word which may run from another
+    word, last one first, as the text they assemble to: the ones after the
+    last label, not jumping within word. Words ending without a jump, run
+    by interrupts or using computed jumps share nothing."""
+    opcodes = word.opcodes
+    if word.substitute or word.not_inlinable or not opcodes or \
+       opcodes[-1][0] not in ['goto', 'bra', 'return', 'retlw']:
+      return []
+    for i, (name, params) in enumerate(opcodes):
+      if name in ['push', 'pop', 'retfie'] or \
+         jump_table(opcodes, i) is not None or \
+         written_register(name, params) == compiler['PCL'].static_value():
+        return []
+    keys = []
+    for name, params in reversed(opcodes):
+      if name not in pic18.instructions or \
+         [p for p in params if isinstance(p, (Label, str))]:
+        break
+      keys.append((name, tuple([repr(p) for p in params])))
+    return keys
+
+  def merge_tails(self, words):
+    """Move the identical instructions ending several words to a new word
+    the others jump to, reorder() letting one of them fall through it,
+    and return the new words. The longest tails shared by the most words
+    go first. The bank BSR holds does not matter: a banked access coming
+    before any movlb of a tail needs the same bank in every word sharing
+    it. Done at -Os only."""
+    keys = dict([(w, self.tail_keys(w)) for w in words])
+    tails = []
+    while True:
+      # Walk the words grouped by common tails, one instruction deeper
+      # at each step, remembering the group saving the most bytes
+      best = None
+      groups = {}
+      for w in words + tails:
+        if keys[w]:
+          groups.setdefault(keys[w][0], []).append(w)
+      pending = [(1, groups[k]) for k in sorted(groups)
+                 if len(groups[k]) > 1]
+      while pending:
+        depth, group = pending.pop()
+        # A skip right before the tail would skip the jump instead
+        sharing = [w for w in group if not ends_with_skip(w.opcodes[:-depth])]
+        saved = (len(sharing) - 1) * \
+                (opcodes_size(group[0].opcodes[-depth:])[1] - 4)
+        if saved > 0 and (best is None or saved > best[0]):
+          best = saved, depth, sharing
+        groups = {}
+        for w in group:
+          if len(keys[w]) > depth:
+            groups.setdefault(keys[w][depth], []).append(w)
+        pending += [(depth + 1, groups[k]) for k in sorted(groups)
+                    if len(groups[k]) > 1]
+      if best is None:
+        return tails
+      saved, depth, sharing = best
+      # A word made of the tail only is used as it is, the other ones
+      # become equivalent to it
+      whole = [w for w in sharing
+               if not [o for o in w.opcodes[:-depth]
+                       if o[0] not in ['LABEL', 'COMMENT']]]
+      if whole:
+        tail = whole[0]
+        sharing.remove(tail)
+      else:
+        current_object = self.current_object
+        tail = Word('_tail_%d' % len(tails))
+        self.current_object = current_object
+        tail.definition = 'end of %s' % ', '.join([w.name for w in sharing])
+        tail.from_source = False
+        tail.prepared = tail.banks_selected = True
+        tail.order = self.order
+        self.order += 1
+        tail.occurrence = 0
+        tail.opcodes = []
+        for name, params in sharing[0].opcodes[-depth:]:
+          tail.add_instruction(name, params)
+        keys[tail] = self.tail_keys(tail)
+        tails.append(tail)
+      for w in sharing:
+        if w in whole:
+          w.substitute = tail
+          w.opcodes = [('COMMENT', ['replaced by equivalent %s' % tail])]
+        else:
+          w.opcodes = w.opcodes[:-depth] + [('goto', [tail])]
+        w.refers_to(tail)
+        keys[w] = self.tail_keys(w)
+
+  def layout(self, roots):
+    """Return the list of (section, entities) to output, in order."""
     l = []
     for r in roots:
       p = [x for x in r.deep_references([]) if not isinstance(x, Label)]
@@ -2532,38 +5675,273 @@ class Compiler:
         if i not in l:
           l.append(i)
     l.sort(key = lambda x: x.order)
+    if self.optimization == 's':
+      l += self.merge_tails([x for x in l if x.section == 'code' and
+                             x not in roots])
+    self.emitted = l
     sections = []
     for i in l:
       if i.section not in sections:
         sections.append(i.section)
+    result = []
     for s in sections:
-      self.output_section_header(outfd, s)
       g = l
-      if s == 'code':
+      if s == 'code' and self.optimization != '0':
         g = self.reorder([x for x in l if x.section == 'code'])
-      for i in g:
-        if i.section == s:
-          outfd.write('\n')
-          if not compiler.no_comments:
-            i.output_header(outfd)
-          i.output(outfd)
+      result.append((s, [i for i in g if i.section == s]))
+    return result
+
+  def deep_output(self, outfd, layout):
+    for s, entities in layout:
+      self.output_section_header(outfd, s)
+      for i in entities:
+        outfd.write('\n')
+        if not compiler.no_comments:
+          i.output_header(outfd)
+        i.output(outfd)
     outfd.write('\n')
 
+  def stack_depths(self, layout):
+    """Return the maximum data and return stack depths in bytes, and the
+    hardware stack depth in levels, reached from main and from the
+    interrupt handlers as (name, data, return, hardware) rows, None
+    meaning unknown. Warn when the stacks may overflow, and with the
+    timing report when they cannot be bounded."""
+    words = sum([e for s, e in layout if s == 'code'], [])
+    analysis = StackAnalysis(words)
+    roots = [('main', self.find(self.main), False)]
+    for kind, handler in [('high', self.high_interrupt),
+                          ('low', self.low_interrupt)]:
+      if handler:
+        roots.append(('%s-interrupt' % kind, handler, True))
+    rows = []
+    # Bytes pushed by the handlers onto the main software stacks
+    total = [0, 0, 0]
+    for name, word, handler in roots:
+      analysis.unbounded = None
+      word = word.real_instance()
+      effect = analysis.effect(word, handler)
+      if effect is None:
+        # Only worth a warning when the timing report was asked for
+        if self.timing:
+          warning('cannot bound the stack depths from %s (recursion, '
+                  'computed jump or unbalanced loop in %s)' %
+                  (name, (analysis.unbounded or word).name))
+        rows.append((name, None, None, None))
+        total = [None, None, None]
+        continue
+      depths = [effect[0], effect[2], effect[4]]
+      if handler:
+        # The interrupt itself uses a level
+        depths[2] += 1
+      rows.append((name,) + tuple(depths))
+      written = [written_register(o, p) for o, p in word.opcodes]
+      for i, stack, fsr, area in [(0, 'data', 0, 'secstack'),
+                                  (1, 'return', 2, 'secrstack')]:
+        area = self.first_dict.get('%s-%s' % (area, name.split('-')[0]))
+        if not handler or not area or \
+           (analysis.addr['FSR%dL' % fsr] not in written and
+            analysis.addr['FSR%dH' % fsr] not in written):
+          total[i] = plus(total[i], depths[i])
+          continue
+        # The handler switches to its own area, starting above its first
+        # byte
+        start = area.static_value()
+        end = min([e.static_value() for e in self.all_entities
+                   if isinstance(e, Variable) and
+                   e.static_value() > start] + [self.here])
+        if depths[i] > end - start - 1:
+          warning('%s stack of %s may grow to %d bytes and overflow %s '
+                  '(%d bytes available)' % (stack, name, depths[i],
+                                            area.name, end - start - 1))
+      total[2] = plus(total[2], depths[2])
+    data, rstack, hardware = total
+    if data is not None and data > 0xc0 - 0x60:
+      warning('data stack may grow to %d bytes and overflow into the '
+              'return stack at 0xc0 (%d bytes available)' %
+              (data, 0xc0 - 0x60))
+    if rstack is not None and self.here > 0x100 and rstack > 0x100 - 0xc0:
+      warning('return stack may grow to %d bytes and overwrite the '
+              'variables at 0x100 (%d bytes available)' %
+              (rstack, 0x100 - 0xc0))
+    if hardware is not None and hardware > 31:
+      warning('hardware stack may need %d levels out of 31' % hardware)
+    if len(roots) > 1:
+      rows.append(('total',) + tuple(total))
+    return rows
+
+  def write_timing(self, timingfile, layout, depths):
+    """Write the static cycle counts of the emitted words, the worst
+    case latency added to interrupts and the maximum stack depths."""
+    def show(cycles):
+      if cycles is None:
+        return '?'
+      return str(cycles)
+    words = sum([e for s, e in layout if s == 'code'], [])
+    analysis = CycleAnalysis(words)
+    outfd = open(timingfile, 'w')
+    try:
+      outfd.write('; Best and worst case cycles from the entry of each word '
+                  'to its return,\n; including the words it calls '
+                  '(? when unknown)\n')
+      for w in analysis.words:
+        best, worst = analysis.cost(w)
+        outfd.write('%-32s %8s %8s\n' % (w.name, show(best), show(worst)))
+      high = 0
+      if self.high_interrupt or self.low_interrupt:
+        outfd.write('\n; Interrupt handlers, including the jump from the '
+                    'vector\n')
+      for kind, handler in [('high', self.high_interrupt),
+                            ('low', self.low_interrupt)]:
+        if handler:
+          best, worst = analysis.cost(handler.real_instance())
+          outfd.write('%s-interrupt %-21s %8s %8s\n' %
+                      (kind, handler.name, show(plus(best, 2)),
+                       show(plus(worst, 2))))
+          if kind == 'high':
+            high = plus(worst, 2)
+      regions = analysis.protected_regions()
+      if regions:
+        outfd.write('\n; Worst case time spent with interrupts disabled\n')
+        for w, worst in regions:
+          outfd.write('%-41s %8s\n' % (w.name, show(worst)))
+      if self.use_interrupts:
+        protected = max([0] + [r[1] for r in regions if r[1] is not None])
+        if None in [r[1] for r in regions]:
+          protected = None
+        outfd.write('\n; Worst case latency added to interrupts\n')
+        outfd.write('%-41s %8s\n' % ('high priority', show(protected)))
+        outfd.write('%-41s %8s\n' % ('low priority',
+                                       show(plus(protected, high))))
+      outfd.write('\n; Maximum data and return stack bytes and hardware '
+                  'stack levels\n')
+      for name, data, rstack, hardware in depths:
+        outfd.write('%-23s %8s %8s %8s\n' % (name, show(data), show(rstack),
+                                             show(hardware)))
+    finally:
+      outfd.close()
+
+  def benchmark(self, asm, spec, analysis = None, stacks = None):
+    """Run init_runtime then the word at the end of spec in the simulator,
+    with the numbers preceding it on the data stack, and report the number
+    of cycles it took along with the resulting stack. With a cycle or a
+    stack analysis, also report the static bounds of the word and check
+    that the simulation lies within them."""
+    words = spec.split()
+    word = words and self.find(words[-1])
+    if not isinstance(word, Word) or word.real_instance() not in self.emitted:
+      raise Compiler.FATAL_ERROR("cannot benchmark `%s': not a word "
+                                 "of the program" % spec)
+    sim = DepthSimulator(asm.program())
+    try:
+      sim.pc = asm.symbols[repr(self['init_runtime'])]
+      sim.run(1000000, asm.symbols[repr(self.find_main())])
+      for w in words[:-1]:
+        n = parse_number(w)
+        if n is None:
+          raise Compiler.FATAL_ERROR("cannot benchmark `%s': %s is not a "
+                                     "number" % (spec, w))
+        for b in [n.value & 0xff, (n.value >> 8) & 0xff]:
+          sim.set_fsr(0, sim.fsr(0) + 1)
+          sim.ram[sim.fsr(0)] = b
+      sim.watch()
+      # The call itself takes a hardware stack level
+      entry = [sim.fsr(0), sim.fsr(2), len(sim.stack) + 1]
+      cycles = sim.call(asm.symbols[repr(word.real_instance())])
+    except pic18.Error as e:
+      raise Compiler.FATAL_ERROR("cannot benchmark `%s': %s" % (spec, e.msg))
+    self.count_calls(asm, sim.jumps)
+    stack = [sim.ram[a] | sim.ram[a+1] << 8
+             for a in range(0x60, sim.fsr(0), 2)]
+    bounds = ''
+    if analysis is not None:
+      # The simulation includes the call
+      best, worst = [plus(c, 2) for c in analysis.cost(word.real_instance())]
+      if (best is not None and cycles < best) or \
+         (worst is not None and cycles > worst):
+        raise Compiler.FATAL_ERROR("benchmark `%s' took %d cycles, out of "
+                                   "its static bounds %s to %s" %
+                                   (spec, cycles, best, worst))
+      bounds = ' (static %s to %s)' % (best is None and '?' or best,
+                                       worst is None and '?' or worst)
+    if stacks is not None:
+      depths = [d - e for d, e in zip(sim.deepest, entry)]
+      effect = stacks.effect(word.real_instance())
+      static = effect and [effect[0], effect[2], effect[4]] or [None] * 3
+      for kind, d, s in zip(['data', 'return', 'hardware'], depths, static):
+        if s is not None and d > s:
+          raise Compiler.FATAL_ERROR("benchmark `%s' reached a %s stack "
+                                     "depth of %d, beyond its static bound "
+                                     "of %d" % (spec, kind, d, s))
+      bounds += ', depths %s (static %s)' % \
+                ('/'.join([str(d) for d in depths]),
+                 '/'.join([s is None and '?' or str(s) for s in static]))
+    sys.stdout.write('%s: %d cycles%s, stack: %s\n' %
+                     (spec, cycles, bounds,
+                      ' '.join(['<%d>' % len(stack)] +
+                               [str(x) for x in stack])))
+    # Show what has been sent on the serial port
+    sys.stdout.write(sim.serial.decode('latin-1'))
+
+  def count_calls(self, asm, jumps):
+    """Add the calls and tail calls between words seen by the simulator
+    to self.measured_calls, which maps callee names to dicts giving the
+    number of calls made by each caller, as read by --profile."""
+    starts = [(asm.symbols[repr(w)], w) for w in self.emitted
+              if isinstance(w, Word) and repr(w) in asm.symbols]
+    starts.sort(key = lambda s: s[0])
+    callees = dict(starts)
+    for (address, target), n in jumps.items():
+      callee = callees.get(target)
+      callers = [w for a, w in starts if a < address]
+      if callee is None or not callers or callers[-1] is callee:
+        continue
+      calls = self.measured_calls.setdefault(callee.name, {})
+      calls[callers[-1].name] = calls.get(callers[-1].name, 0) + n
+
+  def assemble(self, layout, start):
+    """Assemble the program from the opcode lists and return a
+    pic18.Assembler holding the symbols and the program memory."""
+    asm = pic18.Assembler()
+    for s, entities in layout:
+      for i in entities:
+        if s in ['constants', 'memory']:
+          asm.equ(repr(i), repr(i.value))
+    asm.org(start)
+    asm.instruction('goto', [repr(self['init_runtime'])])
+    for offset, handler in [(8, self.high_interrupt),
+                            (0x18, self.low_interrupt)]:
+      asm.org(start + offset)
+      if handler:
+        asm.instruction('goto', [repr(handler)])
+      else:
+        asm.instruction('reset')
+    for s, entities in layout:
+      for i in entities:
+        if s == 'code' and not i.substitute:
+          asm.label(repr(i))
+          for o in i.opcodes:
+            i.assemble_opcode(asm, o)
+        elif s == 'static data':
+          asm.label(repr(i))
+          asm.db(i.data)
+    return asm
+
   def output_section_header(self, outfd, name):
     t = '---------------------------------------------------------'
     outfd.write('\n;%s\n; Section: %s\n;%s\n' % (t, name, t))
 
-  def output_prologue(self, outfd):
-    outfd.write("\tprocessor pic%s\n" % (self.processor or DEFAULT_PROCESSOR))
+  def output_prologue(self, outfd, processor, start):
+    outfd.write("\tprocessor pic%s\n" % (processor or DEFAULT_PROCESSOR))
     outfd.write("\tradix dec\n")
-    outfd.write("\torg %s\n" % self.start)
+    outfd.write("\torg %s\n" % start)
     outfd.write("\tgoto %s\n" % self['init_runtime'])
-    outfd.write("\torg %s\n" % (self.start + 8))
+    outfd.write("\torg %s\n" % (start + 8))
     if self.high_interrupt:
       outfd.write("\tgoto %s\n" % self.high_interrupt)
     else:
       outfd.write("\treset\n")
-    outfd.write("\torg %s\n" % (self.start + 0x18))
+    outfd.write("\torg %s\n" % (start + 0x18))
     if self.low_interrupt:
       outfd.write("\tgoto %s\n" % self.low_interrupt)
     else:
@@ -2573,7 +5951,9 @@ class Compiler:
     outfd.write("END\n")
 
   def warning(self, str):
-    warning('%s: %s' % (self.current_location(), str))
+    # Compiling a specialized version reads the same source once again
+    if not self.specializing:
+      warning('%s: %s' % (self.current_location(), str))
 
   def error(self, str):
     raise Compiler.COMPILATION_ERROR('%s: %s' % (self.current_location(), str))
@@ -2582,9 +5962,12 @@ class Compiler:
     self.current_object.add_instruction(instruction, params)
 
   def add_call(self, target):
+    target = self.specialized(target)
     if target.inw:
       self['>w'].run()
-    if target.inlined:
+    if target.inlined or \
+       ((target.definition, self.current_object.definition) in
+        self.inline_list and target.can_inline()):
       self.inline_call(target)
     else:
       self.add_instruction('call', [target, no_fast])
@@ -2594,24 +5977,401 @@ class Compiler:
       self.add_instruction('MARKER_ZSET', [])
       self.add_instruction('OP_NORMALIZE', [])
 
+  # Primitives whose generated code only depends on the data stack
+  pure_primitives = ['+', '-', '*', '1+', '1-', '=', '0=', '0<>']
+
+  def fold_mark(self, object):
+    """Return what fold() needs to try evaluating the code object is about
+    to compile, or None if it cannot be folded. Done at -O2 and -Os only."""
+    if self.optimization not in ['2', 's'] or not self.state or \
+       not isinstance(self.current_object, Word):
+      return None
+    if isinstance(object, Word) and not object.immediate:
+      if object.inw or object.outw or object.outz or \
+         object == self.current_object:
+        return None
+    elif object.name not in Compiler.pure_primitives:
+      return None
+    return self.current_object, self.current_object.opcodes[:]
+
+  def fold(self, mark):
+    """Replace the code compiled since fold_mark() and the literals it
+    works on by the literals it leaves, if it is only a computation on
+    the data stack."""
+    if mark is None:
+      return
+    word, before = mark
+    if self.current_object is not word or not self.state:
+      return
+    after = word.opcodes
+    p = 0
+    while p < min(len(before), len(after)) and before[p] == after[p]:
+      p += 1
+    q = p
+    while q > 0 and is_static_push(after[q-1]):
+      q -= 1
+    code = after[q:]
+    if not code or not is_static_push(code[0]) or \
+       not [o for o in code if not is_static_push(o)]:
+      return
+    # A computation which failed once is not retried on other literals
+    n = 0
+    while is_static_push(code[n]):
+      n += 1
+    shape = n, tuple(self.fold_lines(code[n:])[0])
+    if shape in self.fold_failures:
+      return
+    values = self.evaluate(code)
+    if values is None:
+      self.fold_failures.add(shape)
+      return
+    # Cells are signed, as the literals read by the front end
+    word.opcodes = after[:q] + [('OP_PUSH', [Number(v & 0x8000 and
+                                                  v - 0x10000 or v)])
+                                for v in values]
+    if self.stats is not None:
+      self.record('fold', word, code, word.opcodes[q:])
+
+  def shift_count(self, object):
+    """Return the count and kind of the constant shift object does, or
+    None. Words only made of such a shift count as well."""
+    if object is self.first_dict.get('2*'):
+      return 1, 'l'
+    if object is self.first_dict.get('2/'):
+      return 1, 'a'
+    if not isinstance(object, Word) or object == self.current_object or \
+       object.inw or object.outw or object.outz:
+      return None
+    body = [o for o in object.opcodes if o[0] not in ['LABEL', 'COMMENT']]
+    if len(body) == 2 and body[0][0] == 'OP_SHIFT' and \
+       body[1] == ('return', [no_fast]):
+      return body[0][1][0].static_value(), body[0][1][1]
+    return None
+
+  def shift_mark(self, object):
+    """Return what remember_shift() needs if object shifts the top of the
+    stack by a constant count. Done at -O2 and -Os only."""
+    if self.optimization not in ['2', 's'] or not self.state or \
+       not isinstance(self.current_object, Word):
+      return None
+    shift = self.shift_count(object)
+    if shift is None:
+      return None
+    word = self.current_object
+    return word, word.opcodes[:], word.references[:], shift
+
+  def remember_shift(self, mark):
+    """Replace the code compiled since shift_mark() by a single shift,
+    merged with a shift in the same direction just before."""
+    if mark is None:
+      return
+    word, before, references, (count, kind) = mark
+    if word is not self.current_object or \
+       word.opcodes[:len(before)] != before:
+      return
+    word.opcodes = before
+    word.references = references
+    self.add_shift(count, kind)
+
+  def add_shift(self, count, kind):
+    """Shift the top of the stack by count bits in the direction given by
+    kind (see shift_code())."""
+    name, params = self.last_instruction()
+    if name == 'OP_SHIFT' and params[1] == kind:
+      self.rewind()
+      count += params[0].static_value()
+    if count > 0:
+      self.add_instruction('OP_SHIFT', [Number(count), kind])
+
+  # Comparisons which an if can test without building a flag, with the
+  # kind of test and whether the operands must be swapped
+  comparisons = {'=': ('eq', False), '<>': ('ne', False),
+                 '<': ('lt', False), '>': ('lt', True),
+                 '>=': ('ge', False), '<=': ('ge', True),
+                 'U<': ('ult', False), 'U>': ('ult', True),
+                 'U>=': ('uge', False), 'U<=': ('uge', True),
+                 '0=': ('zeq', None), '0<>': ('zne', None),
+                 '0<': ('zlt', None), '0>=': ('zge', None)}
+
+  def comparison_mark(self, object):
+    """Return what remember_comparison() needs if object is a comparison
+    which may be fused with a following if. Done at -O2 and -Os only."""
+    if self.optimization not in ['2', 's'] or not self.state or \
+       not isinstance(self.current_object, Word) or \
+       object.name not in Compiler.comparisons:
+      return None
+    word = self.current_object
+    return word, object.name, word.opcodes[:], word.references[:]
+
+  def remember_comparison(self, mark):
+    """Record the operands of the comparison compiled since
+    comparison_mark() if they can be read without using the data stack."""
+    if mark is None:
+      return
+    word, name, before, references = mark
+    if word is not self.current_object:
+      return
+    kind, swap = Compiler.comparisons[name]
+    if swap is None:
+      operands = before and [comparison_operand(before[-1])]
+      if not operands or operands[0] is None:
+        operands, prefix = [None], before
+      else:
+        prefix = before[:-1]
+    else:
+      operands = [comparison_operand(o) for o in before[-2:]]
+      if len(operands) < 2 or None in operands:
+        return
+      if swap:
+        operands.reverse()
+      prefix = before[:-2]
+    self.comparison = word, word.opcodes[:], kind, operands, prefix, \
+                      references
+
+  def last_comparison(self):
+    """Return the kind, operands, preceding code and references of the
+    comparison remember_comparison() recorded if it is the last code
+    compiled."""
+    if self.comparison is None:
+      return None
+    word, after, kind, operands, prefix, references = self.comparison
+    self.comparison = None
+    if word is not self.current_object or word.opcodes != after:
+      return None
+    return kind, operands, prefix[:], references[:]
+
+  # Words whose result low byte only depends on the low bytes of their
+  # operands, with their number of operands
+  byte_operations = {'+': 2, '-': 2, 'and': 2, 'or': 2, 'xor': 2,
+                     '1+': 1, '1-': 1, '2*': 1, 'invert': 1, 'negate': 1,
+                     'lsb': 1}
+
+  def expression_mark(self, object):
+    """Return what remember_expression() needs if object is an operation
+    which may be computed on bytes. Done at -O2 and -Os only."""
+    if self.optimization not in ['2', 's'] or not self.state or \
+       not isinstance(self.current_object, Word) or \
+       object.name not in Compiler.byte_operations:
+      return None
+    word = self.current_object
+    return word, object.name, word.opcodes[:], word.references[:]
+
+  def byte_expression(self, opcodes, end):
+    """Return the start, expression tree and references before the code
+    pushing the value ending at end in opcodes, if it can be computed in W.
+    References are None for a single opcode."""
+    if end == 0:
+      return None
+    leaf = byte_operand(opcodes[end-1])
+    if leaf:
+      return end-1, leaf, None
+    for word, start, after, tree, references in reversed(self.expressions):
+      if word is self.current_object and len(after) == end and \
+         opcodes[:end] == after:
+        return start, tree, references
+    return None
+
+  def remember_expression(self, mark):
+    """Record the expression tree computed since expression_mark() if its
+    low byte can be computed in W, and compute it that way right away if
+    its value always fits in a byte."""
+    if mark is None:
+      return
+    word, name, before, references = mark
+    if word is not self.current_object:
+      return
+    b = self.byte_expression(before, len(before))
+    if b is None:
+      return
+    start, b, b_references = b
+    if Compiler.byte_operations[name] == 2:
+      a = self.byte_expression(before, start)
+      if a is None:
+        return
+      start, a, a_references = a
+      tree = name, a, b
+      references = a_references or b_references or references
+    else:
+      references = b_references or references
+      unary = {'1+': ('+', b, ('lit', 1, None)),
+               '1-': ('-', b, ('lit', 1, None)),
+               'invert': ('xor', b, ('lit', 0xffff, None)),
+               'negate': ('-', ('lit', 0, None), b)}
+      tree = unary.get(name, (name, b))
+    if tree == ('lsb', b) and b[0] in ['c@', '@']:
+      word.opcodes = word.opcodes[:start]
+      self.add_instruction('OP_CFETCH', [b[1]])
+      return
+    code = byte_code(tree)
+    if not code or constant_tree(tree):
+      return
+    if byte_valued(tree):
+      word.opcodes = word.opcodes[:start]
+      word.references = references[:]
+      for instruction, params in code:
+        self.add_instruction(instruction, params)
+      self.add_instruction('OP_PUSH_W')
+    self.expressions = [e for e in self.expressions[-7:] if e[0] is word] + \
+                       [(word, start, word.opcodes[:], tree, references)]
+
+  def last_expression(self):
+    """Return the start, expression tree and references before the code
+    of the last value pushed if it is a recorded expression, or None."""
+    opcodes = self.current_object.opcodes
+    expression = self.byte_expression(opcodes, len(opcodes))
+    if expression is None or expression[2] is None:
+      return None
+    return expression
+
+  def evaluate(self, code):
+    """Run code in the simulator and return the values it leaves on the
+    data stack, or None if it does anything else than computing them."""
+    word = self.current_object
+    opcodes = word.expanded(code)
+    if opcodes[-1][0].startswith('MARKER_'):
+      return None
+    lines, called = self.fold_lines(opcodes + [('return', [no_fast])])
+    key = tuple(lines), tuple(called)
+    if key not in self.fold_results:
+      self.fold_results[key] = self.simulate(word, lines, called)
+    return self.fold_results[key]
+
+  def fold_lines(self, opcodes):
+    """Return the assembler lines for opcodes and the words they call."""
+    lines, called = [], []
+    for name, params in opcodes:
+      if is_internal_jump((name, params)):
+        name = 'bra'
+      if name == 'LABEL':
+        lines.append((None, repr(params[0])))
+      elif name != 'COMMENT' and not name.startswith('MARKER_'):
+        lines.append((name, tuple([isinstance(p, str) and p or
+                                   p.static_value() is None and repr(p) or
+                                   str(p.static_value()) for p in params])))
+        called += [p for p in params if isinstance(p, Word)]
+    return lines, called
+
+  def simulate(self, word, lines, called):
+    """Assemble lines followed by the words they call, and return the
+    values left on the data stack, or None if running it does anything
+    else than computing them."""
+    asm = pic18.Assembler()
+
+    def emit(lines):
+      for name, params in lines:
+        if name is None:
+          asm.label(params)
+        else:
+          asm.instruction(name, list(params))
+
+    emitted = []
+    try:
+      asm.org(0)
+      emit(lines)
+      for w in called:
+        if w in emitted:
+          continue
+        if w == word or not w.opcodes:
+          return None
+        emitted.append(w)
+        if w not in self.fold_words:
+          self.fold_words[w] = self.fold_lines(w.expanded(w.opcodes))
+        asm.label(repr(w))
+        emit(self.fold_words[w][0])
+        called += self.fold_words[w][1]
+      program = asm.program()
+      results = []
+      for base, fill in [(0x5f, 0x00), (0x7f, 0xff), (0x6f, 0xa5)]:
+        sim = FoldingSimulator(program, base, fill)
+        sim.call(0, 20000)
+        results.append(sim.results())
+    except pic18.Error:
+      return None
+    if [r for r in results if r != results[0]] or \
+       (not results[0] and sim.looped):
+      return None
+    return results[0]
+
+  def specialized(self, target):
+    """Return the version of target specialized for the constant pushed
+    just before, dropping the push, or target itself."""
+    opcode = self.last_instruction()
+    if not self.clones or not is_static_push(opcode):
+      return target
+    clone = self.clones.get((target.definition, target.name,
+                             target.occurrence,
+                             opcode[1][0].static_value() & 0xffff))
+    if clone is None:
+      return target
+    self.rewind()
+    return clone
+
+  def specialize(self, word):
+    """Compile the versions of word chosen by choose_specializations(),
+    which push their constant before running the body of word again so
+    that it gets folded into the code using it."""
+    values = sorted([v for (d, n, o, v), saved in
+                     self.specializations.items()
+                     if (d, n, o) == (word.definition, word.name,
+                                      word.occurrence) and
+                     saved is not None])
+    if not values or word.source is None:
+      return
+    name, line, lines = word.source
+    input_buffer = self.input_buffer
+    self.specializing = True
+    for v in values:
+      end_label = Label()
+      clone = Word('%s@%d' % (word.name, v))
+      clone.definition = '%s for %d' % (word.definition, v)
+      clone.end_label = end_label
+      self.state = 1
+      self.push(Number(v))
+      input = Input(name, [''] * (line - 1) + lines)
+      input.current_line = line - 1
+      self.save_input()
+      self.run(input)
+      self.restore_input()
+      self.add_instruction('LABEL', [clone.end_label])
+      self.add_instruction('return', [no_fast])
+      self.state = 0
+      clone.order = self.order
+      self.order += 1
+      clone.occurrence = word.occurrence
+      self.all_entities.append(clone)
+      if clone.definition in self.inline_list and clone.can_inline():
+        clone.inlined = True
+      self.clones[(word.definition, word.name, word.occurrence, v)] = clone
+    self.specializing = False
+    self.input_buffer = input_buffer
+    self.current_object = word
+
   def inline_call(self, target):
+    if self.stats is not None:
+      start = self.current_object.opcodes[:]
     # Collect labels
     labels = [o[1][0] for o in target.opcodes if o[0] == 'LABEL']
     # Build replacement map
     rep = {}
     for l in labels:
       rep[l] = Label()
+      rep[l].loop_bound = l.loop_bound
+      rep[l].loop_exact = l.loop_exact
     # Replace label in every opcode(they are alone as parameters)
     # as we inline them. The final return must not be inlined.
     # Also, warn if external goto or return are detected; we do not perform
     # this check in inline assembly code.
     removable_end = True
+    # Code words have no end label
+    end_label = getattr(target, 'end_label', None)
     for n, p in target.opcodes[:-1]:
-      if is_internal_jump((n, p)) and p == target.end_label:
+      if is_internal_jump((n, p)) and p == [end_label]:
         removable_end = False
       if is_external_jump((n, p)):
         self.warning('inlining of %s uses a non-local jump' % target.name)
-      if p and p[0] in rep:
+      if n == 'OP_JUMP_TABLE':
+        self.add_instruction(n, [rep.get(l, l) for l in p])
+      elif p and p[0] in rep:
         self.add_instruction(n, [rep[p[0]]] + p[1:])
       else:
         self.add_instruction(n, p)
@@ -2622,11 +6382,88 @@ class Compiler:
       # Check that the latest opcode was a return or an inlined call to return.
       assert(target.opcodes[-1][0] == 'return')
       name, params = compiler.last_instruction()
-      if name == 'LABEL' and params == [rep[target.end_label]]:
+      if name == 'LABEL' and end_label in rep and params == [rep[end_label]]:
         compiler.rewind()
     # Transfer dependencies from target to current object
     for r in target.references:
       self.current_object.refers_to(r)
+    if self.stats is not None:
+      self.record('inline %s' % target.name, self.current_object,
+                  start + [('call', [target, no_fast])],
+                  self.current_object.opcodes)
+
+  def record(self, rule, word, before, after):
+    """Record that an optimization rule fired in word, turning opcodes
+    before into opcodes after."""
+    if isinstance(word, Word):
+      before = word.expanded(before)
+      after = word.expanded(after)
+    n0, b0 = opcodes_size(before)
+    n1, b1 = opcodes_size(after)
+    entry = self.stats.setdefault((rule, word), [0, 0, 0])
+    entry[0] += 1
+    entry[1] += n0 - n1
+    entry[2] += b0 - b1
+
+  def measure_rewrite(self, rule, run, args):
+    """Run a primitive performing static rewrites and record whether it
+    replaced the previous opcodes by a better sequence."""
+    word = self.current_object
+    if self.rewriting or self.state == 0 or not isinstance(word, Word):
+      run(*args)
+      return
+    before = word.opcodes[:]
+    self.rewriting = True
+    try:
+      run(*args)
+    finally:
+      self.rewriting = False
+    after = word.opcodes
+    n = 0
+    while n < min(len(before), len(after)) and before[n] is after[n]:
+      n += 1
+    if n == len(before):
+      # Nothing has been rewritten
+      return
+    generic = static_rewrites[rule]
+    if generic.startswith('OP_'):
+      generic = [(generic, [])]
+    else:
+      generic = [('call', [self[generic], no_fast])]
+    self.record(rule, word, before[n:] + generic, after[n:])
+
+  def write_stats(self, statsfile):
+    """Write the optimization statistics of the emitted words as JSON,
+    keyed by their Forth names. Words sharing a name add up."""
+    kept = self.emitted + [x for x in self.all_entities if x.inlined]
+    rules = {}
+    words = {}
+    total = {'fired': 0, 'instructions': 0, 'bytes': 0}
+    for (rule, word), (fired, instructions, size) in self.stats.items():
+      if rule != 'auto-inline':
+        if word not in kept:
+          continue
+        word = word.name
+      entry = {'fired': fired, 'instructions': instructions, 'bytes': size}
+      w = words.setdefault(word, {}).setdefault(rule, {'fired': 0,
+                                                       'instructions': 0,
+                                                       'bytes': 0})
+      if rule.startswith('inline '):
+        rule = 'inline'
+      r = rules.setdefault(rule, {'fired': 0, 'instructions': 0, 'bytes': 0})
+      for k in entry:
+        w[k] += entry[k]
+        r[k] += entry[k]
+        total[k] += entry[k]
+    outfd = open(statsfile, 'w')
+    try:
+      json.dump({'file': self.infile, 'optimization': self.optimization,
+                 'total': total, 'rules': rules, 'words': words},
+                outfd, indent = 1, separators = (',', ': '),
+                sort_keys = True)
+      outfd.write('\n')
+    finally:
+      outfd.close()
 
   def tos_to_addr_byte(self, addr):
     self.pop_w()
@@ -2716,62 +6553,281 @@ def set_start_cb(option, opt, value, parser):
     raise optparse.OptionValueError("%s is not a valid address" % value)
   setattr(parser.values, 'start', s)
 
+def set_flash_limit_cb(option, opt, value, parser):
+  s = parse_number(value)
+  if s is None:
+    raise optparse.OptionValueError("%s is not a valid address" % value)
+  setattr(parser.values, 'flash_limit', s)
+
+def add_variant_cb(option, opt, value, parser):
+  parser.values.variants.append(parse_variant(value))
+
+def read_manifest(path):
+  """Return the list of programs named in a manifest file, one per line.
+  Empty lines and lines starting with a backslash are ignored."""
+  files = []
+  for line in open(path).readlines():
+    line = line.strip()
+    if line and not line.startswith('\\'):
+      files.append(line)
+  return files
+
+def output_names(opts, infile):
+  """Return the assembly and hex file names for a given input file."""
+  asmfile = os.path.splitext(infile)[0] + '.asm'
+  hexfile = os.path.splitext(infile)[0] + '.hex'
+  if opts.outfile:
+    if opts.compile_only:
+      asmfile = opts.outfile
+    else:
+      hexfile = opts.outfile
+  return asmfile, hexfile
+
+def run_gpasm(asmfile, hexfile):
+  """Run gpasm on asmfile and return its exit status."""
+  pid = os.fork()
+  if pid == 0:
+    try:
+      os.execlp('gpasm', 'gpasm', '-o', hexfile, asmfile)
+    except OSError as e:
+      error('cannot run gpasm: %s' % e)
+    os._exit(127)
+  _pid, status = os.waitpid(pid, 0)
+  return status != 0
+
+def parse_variant(spec):
+  """Parse a build variant specification made of comma separated
+  processor=MODEL, start=ADDR, auto-inline and name=NAME items."""
+  variant = {'processor': None, 'start': None, 'automatic_inlining': None,
+             'name': None}
+  for item in spec.split(','):
+    key, _, value = item.strip().partition('=')
+    if key in ['processor', 'p']:
+      variant['processor'] = value
+    elif key in ['start', 's']:
+      variant['start'] = parse_number(value)
+      if variant['start'] is None:
+        raise optparse.OptionValueError("%s is not a valid address" % value)
+    elif key in ['auto-inline', 'a']:
+      variant['automatic_inlining'] = value not in ['0', 'no']
+    elif key == 'name':
+      variant['name'] = value
+    else:
+      raise optparse.OptionValueError("unknown variant item %s" % item)
+  return variant
+
+def variant_jobs(opts, infile):
+  """Split the plain program and the variants requested for infile into
+  jobs sharing the same front-end settings. Each job is a (file, automatic
+  inlining, targets) triplet, targets being (processor, start, asmfile)
+  triplets. A restart at -O2 or -Os happens once per job, not per target."""
+  base = os.path.splitext(infile)[0]
+  jobs = [(infile, opts.automatic_inlining,
+           [(opts.processor, opts.start, output_names(opts, infile)[0])])]
+  for v in opts.variants:
+    processor = v['processor'] or opts.processor
+    start = v['start'] if v['start'] is not None else opts.start
+    inlining = v['automatic_inlining']
+    if inlining is None:
+      inlining = opts.automatic_inlining
+    name = v['name']
+    if name is None:
+      name = '%s-%s' % (processor or DEFAULT_PROCESSOR, start)
+      if inlining:
+        name += '-a'
+    target = (processor, start, '%s-%s.asm' % (base, name))
+    for j in jobs:
+      if j[1] == inlining:
+        j[2].append(target)
+        break
+    else:
+      jobs.append((infile, inlining, [target]))
+  return jobs
+
+def compile_program(opts, job):
+  """Compile and assemble a (file, automatic inlining, targets) job on top
+  of the global compiler, which must already contain the predefined words.
+  Return a non-zero value on failure."""
+  infile, inlining, targets = job
+  asmfile, hexfile = output_names(opts, infile)
+  compiler.infile = infile
+  compiler.asmfile = asmfile
+  compiler.automatic_inlining = inlining
+  compiler.variants = targets
+  try:
+    compiler.compile()
+  except Compiler.Error as e:
+    error(e.msg)
+    return 1
+  except EnvironmentError as e:
+    error(str(e))
+    return 1
+  if opts.compile_only:
+    return 0
+  if targets:
+    return any([run_gpasm(a, os.path.splitext(a)[0] + '.hex')
+                for _p, _s, a in targets])
+  return run_gpasm(asmfile, hexfile)
+
+def wait_program(running):
+  """Wait for one of the running compilations and return non-zero if it
+  failed."""
+  pid, status = os.wait()
+  infile = running.pop(pid)
+  if status != 0:
+    error('compilation of %s failed' % infile)
+  return status != 0
+
+def batch(opts, jobs):
+  """Build the predefined words once then compile every job in a forked
+  copy of the compiler, running at most opts.jobs of them at once."""
+  try:
+    compiler.add_default_content()
+  except Compiler.Error as e:
+    error(e.msg)
+    return 1
+  running = {}
+  failed = 0
+  for job in jobs:
+    while len(running) >= max(opts.jobs, 1):
+      failed |= wait_program(running)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+      status = 1
+      try:
+        status = compile_program(opts, job)
+      except Exception:
+        # os._exit() would otherwise lose the reason of the failure
+        traceback.print_exc()
+      finally:
+        sys.stderr.flush()
+        os._exit(status)
+    running[pid] = job[0]
+  while running:
+    failed |= wait_program(running)
+  return failed
+
 def main():
   global compiler
-  parser = optparse.OptionParser(usage = '%prog [options] FILE')
+  parser = optparse.OptionParser(usage = '%prog [options] FILE...')
   parser.add_option('-a', '--auto-inline', action = 'store_true',
                      default = False, dest = 'automatic_inlining',
                      help = 'turn on automatic inlining')
+  parser.add_option('-B', '--bench', metavar = 'SPEC', dest = 'benchmarks',
+                    action = 'append', default = [],
+                    help = 'simulate the word at the end of SPEC with the '
+                    'numbers before it on the stack and report its cycles, '
+                    'e.g. -B "3 4 max"')
   parser.add_option('-c', '--compile', action = 'store_true',
                      default = False, dest = 'compile_only',
                      help = 'compile only, do not link')
+  parser.add_option('--flash-limit', metavar = 'ADDR', type = 'string',
+                    action = 'callback', callback = set_flash_limit_cb,
+                    dest = 'flash_limit', default = None,
+                    help = 'warn if the program goes beyond ADDR, and at -O2 '
+                    'use the room left below it to inline the most '
+                    'executed calls')
   parser.add_option('-i', '--interrupts', dest = 'enable_interrupts',
                      action = 'store_true', default = False,
                      help = 'enable interrupts usage')
+  parser.add_option('-j', '--jobs', metavar = 'N', type = 'int',
+                    default = 1, dest = 'jobs',
+                    help = 'compile up to N programs in parallel [1]')
   parser.add_option('-m', '--main', dest = 'root', metavar = 'WORD',
                      default = 'main',
                      help = 'main word [main]')
+  parser.add_option('-M', '--manifest', metavar = 'FILE', dest = 'manifest',
+                    action = 'append', default = [],
+                    help = 'also compile the programs listed in FILE')
   parser.add_option('-N', '--no-comments', dest = 'no_comments',
                     default = False, action = 'store_true')
+  parser.add_option('-O', '--optimize', metavar = 'LEVEL', default = '1',
+                    type = 'choice', choices = ['0', '1', '2', 's'],
+                    dest = 'optimization',
+                    help = 'set optimization level: 0 (fast compilation), '
+                    '1, 2 (speed) or s (size); 2 and s imply -a [1]')
   parser.add_option('-o', '--output', metavar = 'FILE', dest = 'outfile',
                      help = 'set output file name', default = None)
+  parser.add_option('--profile', metavar = 'FILE', dest = 'profile',
+                    default = None,
+                    help = 'use the call counts of FILE, as written by '
+                    '--write-profile, to choose the calls to inline')
   parser.add_option('-p', '--processor', metavar = 'MODEL',
                      default = None,
                      help = 'set processor type [%s]' % DEFAULT_PROCESSOR)
+  parser.add_option('-S', '--stats', action = 'store_true',
+                    default = False, dest = 'stats',
+                    help = 'write optimization statistics as JSON '
+                    'next to the assembly file')
   parser.add_option('-s', '--start', default = parse_number('0x2000'),
                      action = 'callback', callback = set_start_cb,
                      metavar = 'ADDR', type = 'string', dest = 'start',
                      help = 'set starting address [0x2000]')
+  parser.add_option('-T', '--timing', action = 'store_true',
+                    default = False, dest = 'timing',
+                    help = 'write static cycle counts of the words and the '
+                    'interrupt latency next to the assembly file')
+  parser.add_option('--write-profile', metavar = 'FILE',
+                    dest = 'profile_file', default = None,
+                    help = 'write the number of calls between words made '
+                    'while running the benchmarks to FILE')
+  parser.add_option('-x', '--variant', metavar = 'SPEC', type = 'string',
+                    action = 'callback', callback = add_variant_cb,
+                    dest = 'variants', default = [],
+                    help = 'also build the variant described by SPEC '
+                    'next to the program, e.g. '
+                    'processor=18f258,start=0,auto-inline,name=boot')
   opts, args = parser.parse_args()
-  if len(args) != 1:
+  for manifest in opts.manifest:
+    try:
+      args += read_manifest(manifest)
+    except IOError as e:
+      parser.error('cannot read manifest %s: %s' % (manifest, e))
+  if not args:
     parser.print_help()
     sys.exit(1)
-  infile = args[0]
-  # Do the real job
-  asmfile = os.path.splitext(infile)[0] + '.asm'
-  hexfile = os.path.splitext(infile)[0] + '.hex'
-  if opts.outfile:
-    if opts.compile_only:
-      asmfile = opts.outfile
-    else:
-      hexfile = opts.outfile
+  if (len(args) > 1 or opts.variants) and opts.outfile:
+    parser.error('--output cannot be used with several outputs')
+  if opts.optimization in ['2', 's']:
+    opts.automatic_inlining = True
   compiler = Compiler(opts.processor, opts.start, opts.root,
                        opts.automatic_inlining, opts.no_comments,
-                       infile, asmfile)
+                       None, None)
+  compiler.optimization = opts.optimization
+  if opts.stats:
+    compiler.stats = {}
+  compiler.benchmarks = opts.benchmarks
+  compiler.timing = opts.timing
+  compiler.flash_limit = opts.flash_limit
+  compiler.profile_file = opts.profile_file
+  if opts.profile:
+    try:
+      infd = open(opts.profile)
+      try:
+        compiler.profile = json.load(infd)
+      finally:
+        infd.close()
+    except (IOError, ValueError) as e:
+      parser.error('cannot read profile %s: %s' % (opts.profile, e))
   if opts.enable_interrupts:
     compiler.enable_interrupts()
+  # Do the real job
+  if opts.variants:
+    sys.exit(batch(opts, sum([variant_jobs(opts, f) for f in args], [])))
+  if len(args) > 1:
+    sys.exit(batch(opts, [(f, opts.automatic_inlining, None)
+                          for f in args]))
+  compiler.infile = args[0]
+  compiler.asmfile, hexfile = output_names(opts, args[0])
   try:
     compiler.process()
   except Compiler.Error as e:
     error(e.msg)
     sys.exit(1)
-  if not opts.compile_only:
-    if os.fork() == 0:
-      os.execlp('gpasm', 'gpasm', '-o', hexfile, asmfile)
-    else:
-      _pid, status = os.wait()
-      if status != 0:
-        sys.exit(1)
+  if not opts.compile_only and run_gpasm(compiler.asmfile, hexfile):
+    sys.exit(1)
 
 if __name__ == '__main__':
   main()
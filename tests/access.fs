@@ -0,0 +1,21 @@
+create buffer 300 allot
+
+create header
+  cvariable kind
+  cvariable length
+create end-header
+
+variable total
+variable unused
+cvariable hits
+variable last
+
+: header-size end-header header - ;
+: count-hit hits c@ 1+ hits c! ;
+: add ( n -- ) dup last ! total @ + total ! count-hit ;
+: main
+  0 total ! 0 hits c!
+  3 kind c! header-size length c!
+  kind c@ add length c@ add buffer c@ add
+  total @ hits c@ +
+;
@@ -0,0 +1,26 @@
+create near-vars
+  cvariable near
+  cvariable count
+create near-end
+create buffer 300 allot
+create far-vars
+  cvariable far1
+  cvariable far2
+  cvariable far3
+create far-end
+near 0 bit flag
+far1 1 bit fflag
+
+: step ( n -- )
+  near c!
+  flag bit-set? if far2 c@ 1+ far2 c! then
+  fflag bit-set? if count c@ 1+ count c! then
+  fflag bit-clr? if far3 c@ 1- far3 c! then
+  near c@ 3 and 0= if far1 c@ 2 + far1 c! then
+;
+
+: main
+  0 far1 c! 0 far2 c! 0 far3 c! 0 count c!
+  8 cfor count c@ far3 c@ + step cnext
+  begin far1 c@ far2 c! again
+;
@@ -0,0 +1,11 @@
+variable total
+variable checks
+
+: step ( n -- n ) dup total @ + total ! 1+ ;
+: check ( -- ) total @ 0< if checks @ 1+ checks ! then ;
+: report ( -- ) check total @ 2/ total ! check ;
+: main
+  0 total ! 0 checks !
+  0 50 cfor step cnext 10 cfor step cnext drop
+  report report total @
+;
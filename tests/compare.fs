@@ -0,0 +1,13 @@
+variable total
+cvariable count
+cvariable level
+
+: test1 count c@ 10 < if 1 level c! then ;
+: test2 level c@ count c@ U>= if 2 level c! then ;
+: test3 total @ 1000 < if 3 level c! then ;
+: test4 -5 total @ < if 4 level c! then ;
+: test5 total @ 0x1234 <> if 5 level c! then ;
+: test6 total @ 0< if 6 level c! then ;
+: test7 begin count c@ 20 U> until ;
+: test8 begin total @ 1- dup total ! 0>= while 8 level c! repeat ;
+: main test1 test2 test3 test4 test5 test6 test7 test8 ;
@@ -0,0 +1,8 @@
+cvariable count
+cvariable level
+
+: test1 count c@ if 2 level c! then ;
+: test2 level c@ 0x0f and if 4 count c! then ;
+: test3 level c@ 1- level c! level c@ 0x80 and if 1 count c! then ;
+: test4 level c@ cfor count c@ 1+ count c! cnext ;
+: main test1 test2 test3 test4 ;
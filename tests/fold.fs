@@ -0,0 +1,12 @@
+: sq dup * ; inline
+variable x
+: main
+  0x12 0x30 or x !
+  5 negate x !
+  3 2* 1+ x !
+  100 7 / x !
+  5 sq x !
+  1 2 3 rot x ! x ! x !
+  x @ 1 or x !
+  100 255 < 0xff and x !
+;
@@ -0,0 +1,9 @@
+variable a
+variable b
+cvariable flags
+
+: test1 5 + a ! a @ 3 + b ! ;
+: test2 a @ b ! a @ b ! ;
+: test3 0x10 flags c! flags c@ 0x10 or flags c! ;
+: test4 0x10 flags c! flags c@ a @ + b ! ;
+: main test1 test2 test3 test4 ;
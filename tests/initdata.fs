@@ -0,0 +1,12 @@
+create primes 2 , 3 , 5 , 7 , 11 , 13 , 17 , 19 , 23 , 29 , 31 , 37 ,
+create counts 0 , 0 , 0 , 0 , 0 , 0 , 0 , 0 , 0 , 0 ,
+variable total
+-1 value mask
+
+: sum-primes ( -- n ) 0 primes 12 cfor dup @ rot + swap 2 + cnext drop ;
+: tally ( n -- ) 2* counts + dup @ 1+ swap ! ;
+: main
+  sum-primes mask and total !
+  3 tally 3 tally 9 tally
+  total @ counts 6 + @ + counts 18 + @ +
+;
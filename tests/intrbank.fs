@@ -0,0 +1,17 @@
+\ The handler calls through execute, so it may change anything, while
+\ main runs with another bank than bank 1 selected
+
+create buffer 300 allot
+variable big
+variable hook
+
+: tick ( -- ) big @ 1+ big ! ;
+
+: low
+  save-context
+  big 250 + @ 1+ big 250 + !
+  hook @ execute
+  restore-context
+; low-interrupt
+
+: main ['] tick hook ! begin big @ 1+ big ! again ;
@@ -0,0 +1,9 @@
+variable a
+variable b
+variable count
+
+: high save-context count @ 1+ count ! restore-context ; high-interrupt
+: low save-context a @ b @ * a ! restore-context ; low-interrupt
+
+: test1 a @ b @ swap * b ! ;
+: main test1 ;
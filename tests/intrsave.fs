@@ -0,0 +1,20 @@
+variable a
+variable b
+variable count
+
+: handle-high count @ 1+ count ! ;
+: handle-low a @ b @ * a ! 3 b c! ;
+
+: high
+  save-context
+  handle-high
+  restore-context
+; high-interrupt
+
+: low
+  save-context
+  handle-low
+  restore-context
+; low-interrupt
+
+: main begin a @ b @ * b ! again ;
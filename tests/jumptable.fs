@@ -0,0 +1,24 @@
+variable result
+
+: dense ( n/w -- )
+  switchw
+    3 casew 30 result !
+    4 casew 40 result !
+    5 casew 50 result !
+    6 casew 60 result !
+    8 casew 80 result !
+    9 casew 90 result !
+    10 casew 100 result !
+    defaultw 999 result !
+  endswitchw
+; inw no-inline
+
+: sparse ( n/w -- )
+  switchw
+    1 casew 10 result !
+    20 casew 20 result !
+    40 casew 30 result !
+  endswitchw
+; inw no-inline
+
+: main 7 dense 20 sparse ;
@@ -0,0 +1,16 @@
+variable total
+create samples 16 allot
+
+: clear-samples ( -- ) samples 16 cfor 0 over c! 1+ cnext drop ;
+: sum-samples ( -- n )
+  0 samples 16 cfor dup c@ rot + swap 1+ cnext drop ;
+: grid ( -- ) 4 cfor 3 cfor total @ 1+ total ! cnext cnext ;
+: triple ( n -- n ) 3 cfor 1+ cnext ;
+: indices ( -- n ) 0 5 cfor cr@ + cnext ;
+: wait ( n -- ) for next ;
+: count-up ( -- ) 300 for total @ 1+ total ! next ;
+: main
+  0 total ! clear-samples grid
+  total @ triple indices + sum-samples +
+  1000 wait count-up total @ +
+;
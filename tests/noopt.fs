@@ -0,0 +1,3 @@
+: foo dup if drop 3 else 1+ then ; no-inline
+: bar foo foo ; no-inline
+: main bar begin foo again ;
@@ -0,0 +1,21 @@
+variable a
+variable b
+
+: 4* 2* 2* ;
+: 16* 4* 4* ;
+: 5<< 2* 16* ;
+: 16/ 2/ 2/ 2/ 2/ ;
+: 5>> 2/ 16/ ;
+
+: test1 a @ 5<< b ! ;
+: test2 a @ 5>> b ! ;
+: test3 a @ 2* b ! ;
+: test4 a @ 2/ 2/ b ! ;
+: test5 a @ 3 lshift b ! ;
+: test6 a @ 12 rshift b ! ;
+: test7 a @ 9 lshift b ! ;
+: test8 a @ 2/ 2/ 2/ 2/ 2/ 2/ 2/ 2/ 2/ 2/ b ! ;
+: test9 a @ b @ rshift b ! ;
+: set-a ( n -- ) a ! a @ 4 lshift b ! ; inline
+: test10 3 set-a ;
+: main test1 test2 test3 test4 test5 test6 test7 test8 test9 test10 ;
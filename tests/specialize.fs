@@ -0,0 +1,13 @@
+variable count
+
+: strobe ( mask -- ) LATB c! count @ 1+ count ! 0 LATB c! ;
+: bump ( n -- ) count @ + count ! ;
+: select ( n -- ) dup 0= if drop 0x10 else 0x20 + then LATB c! ;
+: add ( n -- ) count @ + count ! ; : sub ( n -- ) count @ swap - count ! ;
+: main
+  1 strobe 2 bump 0 select
+  1 strobe 1 bump 0 select
+  1 strobe 2 bump 3 select
+  5 add 5 add 5 add 5 sub 5 sub
+  count @ 8 <
+;
@@ -0,0 +1,38 @@
+needs lib/tty-rs232.fs
+
+\ Signed comparisons as in lib/arithmetic.fs, copied next to the pushes
+\ of their operands. 2dupxor>w reads back the bytes above the stack,
+\ which the stack cache must not cancel at -O2 and -Os
+
+variable x
+
+: cf ( x -- x ) dup if ."  -- ERROR" then ;
+: ct ( x -- x ) dup 0= if ."  -- ERROR" then ;
+
+code inline-2dupxor>w ( u1 u2 -- h[u1]^h[u2]/w )
+  POSTDEC0 ,f ,a movf
+  POSTDEC0 ,f ,a movf
+  POSTINC0 ,w ,a movf
+  PREINC0 ,w ,a xorwf
+  return
+;code inline
+: inline< ( n1 n2 -- flag )
+  inline-2dupxor>w WREG 7 bit-set? if drop 0< else U< then ; inline
+: inline>= ( n1 n2 -- flag )
+  inline-2dupxor>w WREG 7 bit-set? if drop 0>= else U>= then ; inline
+
+\ Leave x1 and x2 above the top of the stack
+: dirty ( x1 x2 -- ) 2drop ; no-inline
+
+: main
+  cr
+  0x7f7f x !
+  x @ x @ dirty 1 x !
+  ." 1 1 >= : " x @ 1 inline>= ct . cr
+  ." 1 0x4680 < : " x c@ 0x4680 inline< ct . cr
+  -3 x !
+  ." -3 253 < : " x @ x c@ inline< ct . cr
+  ." 253 -3 < : " x c@ x @ inline< cf . cr
+  ." 253 -3 >= : " x c@ x @ inline>= ct . cr
+  .s cr
+;
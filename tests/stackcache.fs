@@ -0,0 +1,9 @@
+variable level
+cvariable flags
+cvariable total
+
+: test1 flags c@ 0= if 1 level ! then ;
+: test2 level c@ 0x10 and flags c! ;
+: test3 total c@ flags c@ + total c! ;
+: test4 total c@ flags c@ + level ! ;
+: main test1 test2 test3 test4 ;
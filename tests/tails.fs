@@ -0,0 +1,8 @@
+variable a
+variable b
+
+: x1 ( -- ) 1 a ! b @ 1+ b ! ;
+: x2 ( -- ) 2 a ! b @ 1+ b ! ;
+: x3 ( -- ) a @ if 3 a ! then b @ 1+ b ! ;
+: x4 ( -- ) b @ 1+ b ! ;
+: main x1 x2 x3 x4 x1 x2 x3 x4 b @ ;
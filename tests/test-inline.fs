@@ -0,0 +1,30 @@
+needs lib/tty-rs232.fs
+
+\ Run with a flash limit at -O2, which then inlines the calls saving the
+\ most cycles per byte, one caller at a time or everywhere
+
+variable x
+cvariable cv
+
+: clip ( n -- n' ) dup 0< if drop 0 then dup 100 > if drop 100 then ;
+: bump ( -- ) x @ 1+ x ! ;
+: twice ( n -- 2n ) dup + ;
+: mix ( a b -- n ) >r twice r> - clip ;
+: count-down ( n -- ) cfor bump 1 cv c+! cnext ;
+: tail-bump ( n -- n+1 ) bump 1+ ;
+
+: show ( n -- ) . space x @ . space cv c@ . cr ;
+
+: main
+  cr
+  0 x ! 0 cv c!
+  -5 clip show
+  50 clip show
+  500 clip show
+  10 3 mix show
+  3 100 mix show
+  80 5 mix show
+  4 count-down 0 show
+  7 tail-bump tail-bump show
+  20 cfor 2 1 mix drop cnext 0 show
+;
@@ -0,0 +1,13 @@
+needs lib/tty-rs232.fs
+
+\ Every call passes the same constant, which ends up as a literal in the
+\ specialized version at -O2 and -Os
+
+variable count
+
+: rr ( n -- ) >r count @ r> + count ! ;
+
+: main
+  cr
+  0 count ! 300 rr 300 rr count @ . cr
+;
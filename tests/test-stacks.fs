@@ -0,0 +1,17 @@
+\ Bounded stack use only, so that the simulated depths of main can be
+\ checked against their static bounds
+
+variable total
+
+\ The quotation is called through an internal label
+: bump ( n -- n+1 n ) [[ 1 + ]] keep ;
+: stash ( a b -- a a b ) >r dup r> ;
+: sum3 ( a b c -- n ) + + ;
+: nested ( n -- n' ) dup stash sum3 bump + ;
+
+: main
+  9 bump +
+  2 nested
+  3 cfor total @ 1+ total ! cnext
+  total @
+;
@@ -0,0 +1,15 @@
+\ Bounded code only, so that the simulated cycles of main can be checked
+\ against both of its static bounds
+
+variable total
+
+: triple ( n -- n ) 3 cfor 1+ cnext ;
+: grid ( -- ) 4 cfor 3 cfor total @ 1+ total ! cnext cnext ;
+: halve-even ( n -- n' ) dup 1 and if 2* else 2/ then ;
+
+: main
+  0 total ! grid
+  5 ?dup + triple
+  0 ?dup 7 halve-even 8 halve-even + +
+  total @ +
+;
@@ -0,0 +1,20 @@
+needs lib/tty-rs232.fs
+
+cvariable ca
+cvariable cb
+
+\ Change ca in memory while W still holds its previous value
+: t1 ( -- ) ca c@ cb c! 1 ca c+! ca c@ cb c! ;
+: t2 ( -- ) ca c@ cb c! -1 ca c+! ca c@ cb c! ;
+: t3 ( -- ) ca c@ cb c! 0 ca c! ca c@ cb c! ;
+: t4 ( -- ) ca c@ cb c! ca 0 bit-set ca c@ cb c! ;
+
+: show ( -- ) ca c@ . space cb c@ . cr ;
+
+: main
+  cr
+  5 ca c! t1 show
+  t2 show
+  t3 show
+  6 ca c! t4 show
+;
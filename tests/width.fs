@@ -0,0 +1,13 @@
+cvariable count
+cvariable level
+cvariable mask
+variable total
+
+: test1 count c@ 1+ count c! ;
+: test2 level c@ count c@ + level c! ;
+: test3 count c@ 3 + mask c@ xor level c! ;
+: test4 level c@ count c@ - 1- mask c! ;
+: test5 total @ lsb 2* count c! ;
+: test6 count c@ mask c@ or total ! ;
+: test7 level c@ invert 0x0f and mask c! ;
+: main test1 test2 test3 test4 test5 test6 test7 ;
@@ -0,0 +1,10 @@
+cvariable mode
+cvariable count
+
+: init
+  0x80 T0CON c!
+  mode c@ if 0x80 T1CON c! else 0x80 T3CON c! then
+  0x80 T2CON c!
+  0x07 ADCON1 c! ;
+: reset-count 0x10 count c! count c@ mode c! ;
+: main init reset-count ;